@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2015, S3IT, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+"""
+Benchmark make-crushmap.py on synthetic crush maps.
+
+For each size, a crush map with about that many OSDs is written by
+`fakecrush`, with `--rows` rows of `--racks` racks each, and as many
+hosts of `--osds` OSDs per rack as needed. Weights are scaled down
+where needed to keep the weight of the root within what crush can
+represent. For each step the wall time and the peak memory used
+while the step runs, above what was already in use when it started,
+are reported. Every measurement runs in a separate process, so that
+memory usage of one run does not affect the others. Memory is read
+from /proc, so the benchmark only runs on Linux.
+
+Available steps:
+
+parse
+    `CrushMap.parse` of the text map
+transform
+    `split_hdd_and_ssd`, on the parsed map
+emit
+    `CrushMap.pprint` of the transformed map
+encode
+    `CrushMap.encode` of the transformed map, i.e. the compiled map
+    written by `make-crushmap.py --binary`
+decode
+    `CrushMap.decode` of the compiled map
+simulate
+    placement of the PGs of a pool using the `replicated_rule` of the
+    transformed map, see `make-crushmap.py --simulate`
+
+Steps whose dependencies are missing (e.g. numpy) are skipped.
+"""
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import argparse
+import imp
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import fakecrush
+
+STEPS = ['parse', 'transform', 'emit', 'encode', 'decode', 'simulate']
+
+RULE = 'replicated_rule'
+
+# bucket weights are 16.16 fixed point, leave some room for rounding
+MAX_WEIGHT = 60000.0
+
+
+def load_tool(filename):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    name = os.path.basename(filename).replace('-', '_').replace('.py', '')
+    return imp.load_source(name, path)
+
+
+def current_rss():
+    """Current resident memory of this process, in KiB"""
+    with open('/proc/self/statm') as fd:
+        pages = int(fd.read().split()[1])
+    return pages * resource.getpagesize() / 1024
+
+
+def reset_peak_rss():
+    """Reset the peak resident memory of this process
+
+    Returns False if the kernel cannot do it (Linux older than 4.0).
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fd:
+            fd.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """Peak resident memory of this process since the last reset, in KiB"""
+    with open('/proc/self/status') as fd:
+        for line in fd:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+
+
+class RssSampler(threading.Thread):
+    """Poll the resident memory of this process, keeping the highest value
+
+    Used where the peak cannot be reset: allocations freed between two
+    samples are missed.
+    """
+
+    def __init__(self, interval=0.001):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.peak = current_rss()
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def stop(self):
+        self._done.set()
+        self.join()
+        return max(self.peak, current_rss())
+
+
+def run_step(step, path, opts):
+    """Run `step` on the crush map in `path`, returns the size of its result
+
+    Setup which is not part of the measurement is done by calling
+    `start()`, which resets the clock and the peak memory usage.
+    """
+    tool = load_tool('make-crushmap.py')
+    measure = {}
+
+    def start():
+        measure['rss'] = current_rss()
+        if not reset_peak_rss():
+            measure['sampler'] = RssSampler()
+            measure['sampler'].start()
+        measure['start'] = time.time()
+
+    if step == 'simulate':
+        # fail early, before the setup, if numpy is missing
+        import crushsim
+    m = tool.CrushMap()
+    with open(path) as stream:
+        if step == 'parse':
+            start()
+        m.parse(stream)
+    if step == 'parse':
+        result = len(m.devices) + len(m.buckets)
+    elif step == 'decode':
+        data = m.encode()
+        m = tool.CrushMap()
+        start()
+        m.decode(data)
+        result = len(m.devices) + len(m.buckets)
+    else:
+        if step == 'transform':
+            start()
+        m = tool.split_hdd_and_ssd(m)
+        if step == 'transform':
+            result = len(m.devices) + len(m.buckets)
+        elif step == 'emit':
+            stream = tempfile.TemporaryFile()
+            start()
+            m.pprint(stream)
+            result = stream.tell()
+        elif step == 'encode':
+            start()
+            result = len(m.encode())
+        elif step == 'simulate':
+            start()
+            sim = crushsim.Simulator(m)
+            osds = sim.map_pgs(RULE, opts.pg_num, opts.size, opts.pool)
+            result = int((osds != crushsim.NONE).sum())
+        else:
+            raise ValueError("Unknown step %s" % step)
+
+    elapsed = time.time() - measure['start']
+    if 'sampler' in measure:
+        peak = measure['sampler'].stop()
+    else:
+        peak = peak_rss()
+    return {'result': result,
+            'seconds': elapsed,
+            'memory': max(0, peak - measure['rss']) / 1024.0}
+
+
+def measure(step, path, opts):
+    """Run `step` in a child process, and returns its measurements"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            sys.stdout = open(os.devnull, 'w')
+            data = run_step(step, path, opts)
+        except ImportError as err:
+            data = {'skipped': str(err)}
+        except Exception as err:
+            data = {'error': '%s: %s' % (err.__class__.__name__, err)}
+        os.write(wfd, json.dumps(data))
+        os._exit(0)
+    os.close(wfd)
+    output = []
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        output.append(chunk)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(str.join('', output))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--sizes', metavar='N', type=int, nargs='+',
+                        default=[10**2, 10**3, 10**4, 10**5],
+                        help='Number of OSDs of the synthetic maps. '
+                        'Default: %(default)s')
+    parser.add_argument('-t', '--steps', metavar='STEP', nargs='+',
+                        choices=STEPS, default=STEPS,
+                        help='Steps to benchmark. Default: all of them')
+    parser.add_argument('--rows', type=int, default=2,
+                        help='Rows of the maps. Default: %(default)s')
+    parser.add_argument('--racks', type=int, default=5,
+                        help='Racks of each row. Default: %(default)s')
+    parser.add_argument('--osds', type=int, default=10,
+                        help='OSDs of each host. Default: %(default)s')
+    parser.add_argument('--ssds', type=int, default=1,
+                        help='SSDs among the OSDs of each host. '
+                        'Default: %(default)s')
+    parser.add_argument('--alg', default='straw2',
+                        choices=('list', 'tree', 'straw', 'straw2'),
+                        help='Algorithm of the buckets. Default: %(default)s')
+    parser.add_argument('--pg-num', type=int, default=4096,
+                        help='PGs of the simulated pool. '
+                        'Default: %(default)s')
+    parser.add_argument('--size', type=int, default=3,
+                        help='Replicas of the simulated pool. '
+                        'Default: %(default)s')
+    parser.add_argument('--pool', type=int, default=1,
+                        help='Id of the simulated pool. Default: %(default)s')
+    opts = parser.parse_args()
+
+    print("%-10s %8s %8s %10s %8s %8s" % (
+        'step', 'osds', 'hosts', 'result', 'seconds', 'peak MB'))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'crushmap.txt')
+        for size in opts.sizes:
+            racks = opts.rows * opts.racks
+            hosts = max(1, -(-size // (racks * opts.osds)))
+            scale = min(1.0, MAX_WEIGHT / (racks * hosts * opts.osds *
+                                           max(fakecrush.HDD_WEIGHTS)))
+            with io.open(path, 'wb') as stream:
+                osds = fakecrush.generate(
+                    stream, opts.rows, opts.racks, hosts, opts.osds,
+                    opts.ssds, alg=opts.alg, scale=scale, seed=size)
+            for step in opts.steps:
+                data = measure(step, path, opts)
+                if 'skipped' in data or 'error' in data:
+                    print("%-10s %8d %8d  %s" % (
+                        step, osds, racks * hosts, data.get('skipped') and
+                        'skipped (%s)' % data['skipped'] or data['error']))
+                    continue
+                print("%-10s %8d %8d %10d %8.2f %8.1f" % (
+                    step, osds, racks * hosts, data['result'],
+                    data['seconds'], data['memory']))
+                sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2015, S3IT, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+"""
+Benchmark the RBD tools of this repository without a Ceph cluster.
+
+Each tool is run against a synthetic pool created with `fakeceph`,
+and for each pool size the wall time, the number of librados/librbd
+calls, the maximum number of rbd images open at the same time and the
+growth of the peak memory usage are reported. Every
+measurement runs in a separate process, so that memory usage of one
+run does not affect the others.
+
+Available tools:
+
+layering-graph
+    `build_layering_graph` of cleanup-deleted-os-images.py
+layering-graph-parents
+    `build_layering_graph_from_parents` of cleanup-deleted-os-images.py
+layering-graph-metadata
+    `build_layering_graph_from_metadata` of cleanup-deleted-os-images.py
+layering-graph-crawl
+    `build_layering_graph_from_crawl` of cleanup-deleted-os-images.py,
+    i.e. the `rbdgraph` crawler shared with rbd-image-tree
+layering-graph-cached
+    `build_layering_graph_cached` of cleanup-deleted-os-images.py, on
+    a warm cache
+deletion-plan
+    `deletion_plan` of cleanup-deleted-os-images.py, on the graph
+    built by `build_layering_graph`
+stream-plan
+    `stream_deletion_plans` of cleanup-deleted-os-images.py, crawl
+    and plan included
+image-tree
+    `build_graph` of rbd-image-tree, on all the images of the pool
+image-tree-stream
+    `write_graph` of rbd-image-tree, on all the images of the pool,
+    in DOT format
+spurious-scan
+    `list_rbd_images` and `find_orphans` of cleanup-spurious-images.py,
+    with in-memory OpenStack inventories
+
+Tools whose dependencies are missing (e.g. pygraphviz) are skipped.
+"""
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import argparse
+import imp
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import fakeceph
+
+TOOLS = ['layering-graph', 'layering-graph-parents', 'layering-graph-metadata',
+         'layering-graph-crawl', 'layering-graph-cached', 'deletion-plan', 'stream-plan',
+         'image-tree', 'image-tree-stream', 'spurious-scan']
+
+POOL = 'cinder'
+
+
+def load_tool(filename):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), filename)
+    name = os.path.basename(filename).replace('-', '_').replace('.py', '')
+    return imp.load_source(name, path)
+
+
+def current_rss():
+    """Current resident memory of this process, in KiB"""
+    try:
+        with open('/proc/self/statm') as fd:
+            pages = int(fd.read().split()[1])
+        return pages * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_tool(tool, cluster, opts):
+    """Run `tool` on `cluster`, returns the number of nodes it produced
+
+    Setup which is not part of the measurement is done by calling
+    `start()`, which resets the call counters and the clock.
+    """
+    ioctx = fakeceph.Rados().open_ioctx(POOL)
+    measure = {}
+
+    def start():
+        cluster.calls.clear()
+        measure['rss'] = current_rss()
+        measure['start'] = time.time()
+
+    if tool.startswith('layering-graph') or tool == 'deletion-plan':
+        cleanup = load_tool('cleanup-deleted-os-images.py')
+        if tool == 'layering-graph-cached':
+            tmpdir = tempfile.mkdtemp()
+            try:
+                # images last modified a day ago, so that their cache
+                # entries can be trusted
+                for image in cluster.ids.values():
+                    image.mtime -= 86400
+                cache = os.path.join(tmpdir, 'cache')
+                cleanup.build_layering_graph_cached(ioctx, POOL, cache,
+                                                    jobs=opts.jobs)
+                start()
+                graph = cleanup.build_layering_graph_cached(
+                    ioctx, POOL, cache, jobs=opts.jobs)
+            finally:
+                shutil.rmtree(tmpdir)
+        elif tool == 'layering-graph-parents':
+            start()
+            graph = cleanup.build_layering_graph_from_parents(
+                ioctx, POOL, jobs=opts.jobs)
+        elif tool == 'layering-graph-metadata':
+            start()
+            graph = cleanup.build_layering_graph_from_metadata(
+                ioctx, POOL, jobs=opts.jobs)
+        elif tool == 'layering-graph-crawl':
+            start()
+            graph = cleanup.build_layering_graph_from_crawl(
+                ioctx, POOL, jobs=opts.jobs)
+        else:
+            if tool == 'layering-graph':
+                start()
+            graph = cleanup.build_layering_graph(ioctx, POOL, jobs=opts.jobs)
+            if tool == 'deletion-plan':
+                start()
+                graph = [node for component in cleanup.deletion_plan(graph)
+                         for node in component]
+        result = len(graph)
+    elif tool == 'stream-plan':
+        cleanup = load_tool('cleanup-deleted-os-images.py')
+        stream = tempfile.TemporaryFile()
+        start()
+        cleanup.stream_deletion_plans(ioctx, POOL, stream, jobs=opts.jobs)
+        stream.seek(0)
+        result = sum(len(json.loads(line)['component']) for line in stream)
+    elif tool == 'image-tree':
+        tree = load_tool('rbd-image-tree')
+        volumes = fakeceph.RBD().list(ioctx)
+        treeopts = argparse.Namespace(pool=POOL, full=False)
+        ioctxs = tree.IoctxPool(fakeceph.Rados())
+        start()
+        result = len(tree.build_graph(treeopts, ioctxs, volumes,
+                                      jobs=opts.jobs))
+    elif tool == 'image-tree-stream':
+        tree = load_tool('rbd-image-tree')
+        volumes = fakeceph.RBD().list(ioctx)
+        treeopts = argparse.Namespace(pool=POOL, full=False)
+        ioctxs = tree.IoctxPool(fakeceph.Rados())
+        stream = tempfile.TemporaryFile()
+        start()
+        result = tree.write_graph(treeopts, ioctxs, volumes, stream,
+                                  jobs=opts.jobs)
+    elif tool == 'spurious-scan':
+        spurious = load_tool('cleanup-spurious-images.py')
+        # pretend that one resource out of ten has been deleted
+        inventories = dict((service, set()) for service in spurious.SERVICES)
+        for i, name in enumerate(fakeceph.RBD().list(ioctx)):
+            info = spurious.classify(name)
+            if info and i % 10:
+                inventories[info[1]].add(info[2])
+        start()
+        result = len(spurious.find_orphans(
+            spurious.list_rbd_images(fakeceph.Rados(), [POOL]), inventories))
+    else:
+        raise ValueError("Unknown tool %s" % tool)
+
+    elapsed = time.time() - measure['start']
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return {'result': result,
+            'seconds': elapsed,
+            'calls': dict(cluster.calls),
+            'handles': cluster.peak_open_images,
+            'memory': max(0, peak - measure['rss']) / 1024.0}
+
+
+def measure(tool, images, opts):
+    """Run `tool` in a child process, and returns its measurements"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        try:
+            cluster = fakeceph.FakeCluster(latency=opts.latency)
+            cluster.populate(POOL, images, depth=opts.depth,
+                             fanout=opts.fanout, snapshots=opts.snapshots,
+                             deleted=opts.deleted, seed=images)
+            cluster.install()
+            sys.stdout = open(os.devnull, 'w')
+            data = run_tool(tool, cluster, opts)
+        except ImportError as err:
+            data = {'skipped': str(err)}
+        except Exception as err:
+            data = {'error': '%s: %s' % (err.__class__.__name__, err)}
+        os.write(wfd, json.dumps(data))
+        os._exit(0)
+    os.close(wfd)
+    output = []
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        output.append(chunk)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(str.join('', output))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-s', '--sizes', metavar='N', type=int, nargs='+',
+                        default=[10**3, 10**4, 10**5],
+                        help='Number of images of the synthetic pools. '
+                        'Default: %(default)s')
+    parser.add_argument('-t', '--tools', metavar='TOOL', nargs='+',
+                        choices=TOOLS, default=TOOLS,
+                        help='Tools to benchmark. Default: all of them')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='Depth of the clone trees. Default: %(default)s')
+    parser.add_argument('--fanout', type=int, default=2,
+                        help='Clones of each snapshot. Default: %(default)s')
+    parser.add_argument('--snapshots', type=int, default=1,
+                        help='Snapshots of each image with clones. '
+                        'Default: %(default)s')
+    parser.add_argument('--deleted', type=float, default=0.5,
+                        help='Fraction of images deleted by glance. '
+                        'Default: %(default)s')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds taken by each librados/librbd call. '
+                        'Default: %(default)s')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Concurrency of the tools supporting it. '
+                        'Default: %(default)s')
+    opts = parser.parse_args()
+
+    print("%-24s %8s %10s %8s %10s %8s %8s  %s" % (
+        'tool', 'images', 'result', 'seconds', 'calls', 'handles', 'peak MB',
+        'calls by type'))
+    for images in opts.sizes:
+        for tool in opts.tools:
+            data = measure(tool, images, opts)
+            if 'skipped' in data or 'error' in data:
+                print("%-24s %8d  %s" % (
+                    tool, images, data.get('skipped') and
+                    'skipped (%s)' % data['skipped'] or data['error']))
+                continue
+            calls = data['calls']
+            print("%-24s %8d %10d %8.2f %10d %8d %8.1f  %s" % (
+                tool, images, data['result'], data['seconds'],
+                sum(calls.values()), data['handles'], data['memory'],
+                str.join(' ', ['%s=%d' % item for item in sorted(calls.items())])))
+            sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
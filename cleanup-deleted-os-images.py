@@ -51,12 +51,23 @@ __docformat__ = 'reStructuredText'
 __author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
 
 import argparse
+from array import array
 import cPickle as pickle
+from itertools import izip
+import json
+from multiprocessing.pool import ThreadPool
 import networkx as nx
+import os
 import rados
+import random
 import rbd
+import struct
 import unittest
 import sys
+import threading
+import time
+
+import rbdgraph
 
 
 DELETE_PATTERN = 'to_be_deleted_by_glance'
@@ -98,19 +109,252 @@ class TestCase(unittest.TestCase):
 
         self.assertTrue(nx.is_isomorphic(g1, to_delete), "Graphs are not isomorphic")
 
-def build_layering_graph(ioctx, pool, filter_volumes = lambda x: True):
-    """Returns a netowrkx DAG of all the rbd volumes and snapshots"""
+    def test_shared_descendant(self):
+        # A node reachable from two parents is only deletable if both
+        # of its parents' subtrees are.
+        #
+        #   a_d   b_d
+        #     \   /  \
+        #      c_d    d
+        graph = nx.DiGraph()
+        graph.add_edges_from([('a_d', 'c_d'), ('b_d', 'c_d'), ('b_d', 'd')])
+
+        to_delete = find_subgraphs_to_delete(graph, delete_pattern='_d')
+
+        self.assertEqual(sorted(to_delete.nodes()), ['a_d', 'c_d'])
+        self.assertEqual(to_delete.edges(), [('a_d', 'c_d')])
+
+    def test_snapshots_of_deleted_volume(self):
+        graph = nx.DiGraph()
+        graph.add_path(['vol_d', 'vol_d@snap', 'clone_d'])
+        graph.add_path(['vol_d', 'vol_d@snap2', 'clone'])
+
+        to_delete = find_subgraphs_to_delete(graph, delete_pattern='_d')
+
+        # vol_d must stay, as one of its snapshots has a live clone
+        self.assertEqual(sorted(to_delete.nodes()), ['clone_d', 'vol_d@snap'])
+
+    def test_deep_chain(self):
+        graph = nx.DiGraph()
+        graph.add_path(['n%d_d' % i for i in range(5000)])
+
+        to_delete = find_subgraphs_to_delete(graph, delete_pattern='_d')
+        self.assertEqual(len(to_delete), 5000)
+
+        graph.add_edge('n4999_d', 'alive')
+        to_delete = find_subgraphs_to_delete(graph, delete_pattern='_d')
+        self.assertEqual(len(to_delete), 0)
+
+    def test_components_do_not_overlap(self):
+        #   a   b   e
+        #    \ / \
+        #     c   d
+        graph = nx.DiGraph()
+        graph.add_edges_from([('a', 'c'), ('b', 'c'), ('b', 'd')])
+        graph.add_node('e')
+
+        components = find_connected_components(graph)
+
+        nodes = [n for g in components for n in g]
+        self.assertEqual(sorted(nodes), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(sorted(len(g) for g in components), [1, 4])
+
+    def test_matches_definition(self):
+        # A node can be deleted iff it and all its descendants match
+        for seed in range(20):
+            graph = make_synthetic_graph(200, chain=0.3, deleted=0.8, seed=seed)
+            to_delete = find_subgraphs_to_delete(graph)
+            for node in graph:
+                expected = all(DELETE_PATTERN in n for n in
+                               nx.descendants(graph, node) | set([node]))
+                self.assertEqual(node in to_delete, expected, node)
+
+    def test_compact_graph_plan(self):
+        for seed in range(20):
+            graph = make_synthetic_graph(300, chain=0.3, deleted=0.8, seed=seed)
+            compact = CompactGraph()
+            for node in graph:
+                compact.add_node(node)
+            for u, v in graph.edges():
+                compact.add_edge(u, v)
+
+            expected = deletion_plan(graph)
+            plan = deletion_plan(compact)
+
+            self.assertEqual(sorted(sorted(c) for c in plan),
+                             sorted(sorted(c) for c in expected))
+            for component in plan:
+                # clones must be deleted before their parents
+                position = dict((n, i) for i, n in enumerate(component))
+                for u, v in graph.subgraph(component).edges():
+                    self.assertTrue(position[v] < position[u])
+
+    def test_crawl_strategies_agree(self):
+        import fakeceph
+        import shutil
+        import tempfile
+        cluster = fakeceph.FakeCluster()
+        cluster.populate('cinder', 500, depth=4, fanout=2, deleted=0.5, seed=1)
+        tmpdir = tempfile.mkdtemp()
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            with cluster.patch(globals()), cluster.patch(vars(rbdgraph)):
+                ioctx = rados.Rados().open_ioctx('cinder')
+                expected = build_layering_graph(ioctx, 'cinder')
+                cache = os.path.join(tmpdir, 'cache')
+                crawl = os.path.join(tmpdir, 'crawl')
+                with open(crawl, 'w') as fd:
+                    graphs = [
+                        build_layering_graph(ioctx, 'cinder', jobs=4),
+                        build_layering_graph_from_parents(ioctx, 'cinder',
+                                                          jobs=4),
+                        build_layering_graph_from_metadata(ioctx, 'cinder',
+                                                           jobs=4),
+                        build_layering_graph_cached(ioctx, 'cinder', cache),
+                        build_layering_graph_cached(ioctx, 'cinder', cache),
+                        build_layering_graph_from_crawl(ioctx, 'cinder',
+                                                        jobs=4, record=fd),
+                    ]
+                with open(crawl) as fd:
+                    graphs.append(build_layering_graph_from_infos(
+                        rbdgraph.read_crawl(fd), 'cinder'))
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(tmpdir)
+        for graph in graphs:
+            self.assertEqual(sorted(graph.nodes()), sorted(expected.nodes()))
+            self.assertEqual(sorted(graph.edges()), sorted(expected.edges()))
+
+    def test_parents_clone_in_other_pool(self):
+        import fakeceph
+        cluster = fakeceph.FakeCluster()
+        image = 'image_' + DELETE_PATTERN
+        cluster.create('images', image)
+        cluster.create_snap('images', image, 'snap', protected=True)
+        cluster.clone('images', image, 'snap', 'vms', 'disk')
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            with cluster.patch(globals()), cluster.patch(vars(rbdgraph)):
+                ioctx = rados.Rados().open_ioctx('images')
+                expected = build_layering_graph(ioctx, 'images')
+                graph = build_layering_graph_from_parents(ioctx, 'images')
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(sorted(graph.edges()), sorted(expected.edges()))
+        self.assertEqual(deletion_plan(graph), [])
+
+    def test_crawl_cache_same_second(self):
+        import fakeceph
+        import shutil
+        import tempfile
+        cluster = fakeceph.FakeCluster()
+        cluster.populate('cinder', 50, depth=2, fanout=2, seed=3)
+        tmpdir = tempfile.mkdtemp()
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            with cluster.patch(globals()), cluster.patch(vars(rbdgraph)):
+                ioctx = rados.Rados().open_ioctx('cinder')
+                cache = os.path.join(tmpdir, 'cache')
+                build_layering_graph_cached(ioctx, 'cinder', cache)
+                # most likely within the same second as the crawl
+                name = rbd.RBD().list(ioctx)[0]
+                cluster.create_snap('cinder', name, 'late', protected=True)
+                graph = build_layering_graph_cached(ioctx, 'cinder', cache)
+                expected = build_layering_graph(ioctx, 'cinder')
+        finally:
+            sys.stdout = stdout
+            shutil.rmtree(tmpdir)
+        self.assertIn('%s@late' % name, graph)
+        self.assertEqual(sorted(graph.edges()), sorted(expected.edges()))
+
+    def test_stream_deletion_plans(self):
+        import fakeceph
+        from StringIO import StringIO
+        cluster = fakeceph.FakeCluster()
+        cluster.populate('cinder', 500, depth=4, fanout=2, deleted=0.7, seed=2)
+        filter_volumes = lambda name: not name.startswith('volume-')
+        stream = StringIO()
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            with cluster.patch(globals()):
+                ioctx = rados.Rados().open_ioctx('cinder')
+                expected = deletion_plan(build_layering_graph(
+                    ioctx, 'cinder', filter_volumes))
+                stream_deletion_plans(ioctx, 'cinder', stream, filter_volumes,
+                                      jobs=4)
+        finally:
+            sys.stdout = stdout
+        plan = [json.loads(line)['component']
+                for line in stream.getvalue().splitlines()]
+        self.assertTrue(expected)
+        self.assertEqual(sorted(sorted(c) for c in plan),
+                         sorted(sorted(c) for c in expected))
+
+    def test_plan_roundtrip(self):
+        import tempfile
+        plan = [['b_d@snap', 'a_d@snap', 'a_d'], ['c_d']]
+        with tempfile.NamedTemporaryFile() as fd:
+            save_plan(fd, 'cinder', plan)
+            self.assertEqual(load_plan(fd.name, 'cinder'), plan)
+            self.assertRaises(ValueError, load_plan, fd.name, 'glance')
+        self.assertEqual(parse_size('500M'), 500 * 2**20)
+        self.assertEqual(parse_size('1.5GB'), 3 * 2**29)
+
+
+def _crawl_map(func, items, jobs=1, threads=None):
+    """Apply `func` to all `items`, using up to `jobs` threads.
+
+    Results are returned in the same order as `items`, so that the
+    graph built out of them does not depend on the concurrency level.
+    If `threads` is given, it is the `ThreadPool` to use, which avoids
+    the cost of starting a new one when this is called many times.
+    """
+    if threads is not None and len(items) > 1:
+        return threads.map(func, items, chunksize=1)
+    if jobs <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(func, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _list_snaps(ioctx, name):
+    print("Checking volume %s" % name)
+    volume = rbd.Image(ioctx, name, read_only=True)
+    try:
+        return [snap['name'] for snap in volume.list_snaps()]
+    finally:
+        volume.close()
+
+
+def _list_children(ioctx, name, snapname):
+    print("Checking snapshot %s@%s" % (name, snapname))
+    volume = rbd.Image(ioctx, name, snapshot=snapname, read_only=True)
+    try:
+        return list(volume.list_children())
+    finally:
+        volume.close()
+
+
+def build_layering_graph(ioctx, pool, filter_volumes=lambda x: True, jobs=1,
+                         graph_class=nx.DiGraph):
+    """Returns a netowrkx DAG of all the rbd volumes and snapshots
+
+    Up to `jobs` images are opened concurrently on the shared
+    `ioctx`. The resulting graph is the same regardless of the value
+    of `jobs`. Pass ``graph_class=CompactGraph`` to get a compact
+    graph instead of a networkx one.
+    """
     rbd_inst = rbd.RBD()
 
     # List all "interesting" volumes. By default, all volumes.
     volumenames = [vol for vol in rbd_inst.list(ioctx) if filter_volumes(vol)]
 
-    # These are used for caching
-    snapshots = []
-    volumes = {}
-
     # Build an empty graph
-    graph = nx.DiGraph()
+    graph = graph_class()
 
     # To compute a graph of all the interesting rbd volumes, we need first
     # to list all the volumes. For each one of them, we find all the
@@ -119,49 +363,485 @@ def build_layering_graph(ioctx, pool, filter_volumes = lambda x: True):
 
     # Analyze rbd volumes and collect their snapshots, and add edges
     # volume -> snapshot
-    for name in volumenames:
-        print("Checking volume %s" % name)
-        volume = rbd.Image(ioctx, name, read_only=True)
-        volumes[name] = volume
-        color='black'
+    snaps = _crawl_map(lambda name: _list_snaps(ioctx, name),
+                       volumenames, jobs)
+    snapshots = []
+    for name, snapnames in zip(volumenames, snaps):
         graph.add_node(name)
-
-        for snap in volume.list_snaps():
-            snapname = name + '@' + snap['name']
-            snapshots.append({'volume': name,
-                              'snap': snap['name']})
-            graph.add_node(snapname)
-            graph.add_edge(name, snapname)
+        for snapname in snapnames:
+            snapshots.append((name, snapname))
+            graph.add_node('%s@%s' % (name, snapname))
+            graph.add_edge(name, '%s@%s' % (name, snapname))
 
     # Analyze snapshots and add edges snapshot -> volume
-    for snap in snapshots:
-        vol = snap['volume']
-        snapname = snap['snap']
-        print("Checking snapshot %s@%s" % (vol, snapname))
+    children = _crawl_map(lambda snap: _list_children(ioctx, *snap),
+                          snapshots, jobs)
+    for (vol, snapname), clones in zip(snapshots, children):
+        for volpool, name in clones:
+            if volpool != pool:
+                print("WARNING: Image %s@%s has clone on a different pool: %s"
+                      % (vol, snapname, volpool))
+            graph.add_edge('%s@%s' % (vol, snapname), name)
+    return graph
+
+
+def _image_info(ioctx, name, snaps=True):
+    """Return the snapshot names and the parent of image `name`
+
+    Both are read in the same open of the image. The parent is a
+    ``(pool, image, snapshot)`` tuple, or None if the image is not a
+    clone.
+    """
+    print("Checking volume %s" % name)
+    image = rbd.Image(ioctx, name, read_only=True)
+    try:
+        snapnames = [snap['name'] for snap in image.list_snaps()] if snaps else []
+        try:
+            parent = tuple(image.parent_info())
+        except rbd.ImageNotFound:
+            parent = None
+        return snapnames, parent
+    finally:
+        image.close()
+
+
+def build_layering_graph_from_parents(ioctx, pool,
+                                      filter_volumes=lambda x: True, jobs=1,
+                                      graph_class=nx.DiGraph,
+                                      delete_pattern=DELETE_PATTERN):
+    """Returns the same DAG as `build_layering_graph`, opening each image once
+
+    Instead of reopening every snapshot to call `list_children()`,
+    every image of the pool is opened only once to read both its
+    snapshots and its parent, and the snapshot -> clone edges are
+    built bottom-up from the parents. Images which are not
+    "interesting" are opened too, as they may be clones of an
+    interesting one, but only their parent is read.
+
+    Clones living in a different pool cannot be found this way, as
+    only the images of `pool` are inspected: the snapshots of the
+    interesting images matching `delete_pattern`, which are the only
+    ones that can be planned for deletion, are still asked for their
+    children, and their clones in other pools are added to the graph.
+    """
+    rbd_inst = rbd.RBD()
 
-        volume = rbd.Image(ioctx, vol, snapshot=snapname, read_only=True)
-        volumes['%s@%s' % (vol, snapname)] = volume
+    names = rbd_inst.list(ioctx)
+    interesting = [filter_volumes(name) for name in names]
+    infos = _crawl_map(lambda args: _image_info(ioctx, *args),
+                       zip(names, interesting), jobs)
 
-        for volpool, name in volume.list_children():
+    graph = graph_class()
+
+    # Add edges volume -> snapshot for all the interesting volumes
+    for name, wanted, (snapnames, parent) in zip(names, interesting, infos):
+        if not wanted:
+            continue
+        graph.add_node(name)
+        for snapname in snapnames:
+            graph.add_node('%s@%s' % (name, snapname))
+            graph.add_edge(name, '%s@%s' % (name, snapname))
+
+    # Add edges snapshot -> clone, from the clone side
+    for name, (snapnames, parent) in zip(names, infos):
+        if parent is None:
+            continue
+        parentpool, parentname, parentsnap = parent
+        snapname = '%s@%s' % (parentname, parentsnap)
+        if parentpool == pool and snapname in graph:
+            graph.add_edge(snapname, name)
+
+    # Add edges snapshot -> clone in another pool, for the snapshots
+    # which could otherwise be deleted
+    snapshots = [(vol, snapname)
+                 for vol, wanted, (snapnames, parent)
+                 in zip(names, interesting, infos)
+                 if wanted and delete_pattern in vol
+                 for snapname in snapnames]
+    children = _crawl_map(lambda snap: _list_children(ioctx, *snap),
+                          snapshots, jobs)
+    for (vol, snapname), clones in zip(snapshots, children):
+        for volpool, name in clones:
             if volpool != pool:
                 print("WARNING: Image %s@%s has clone on a different pool: %s"
                       % (vol, snapname, volpool))
-            graph.add_edge('%s@%s' % (name, snapname), name)
+                graph.add_edge('%s@%s' % (vol, snapname), name)
     return graph
 
 
-def find_connected_components(graph):
-    subgraphs = []
+def build_layering_graph_from_infos(infos, pool,
+                                    filter_volumes=lambda x: True,
+                                    graph_class=nx.DiGraph):
+    """Returns the same DAG as `build_layering_graph`, out of a crawl
+
+    `infos` are the `rbdgraph.ImageInfo` records of the images, as
+    yielded by `rbdgraph.crawl` or read back with
+    `rbdgraph.read_crawl`, e.g. from a file written by ``rbd-image-tree
+    --save-crawl``. Images of other pools are ignored.
+    """
+    graph = graph_class()
+    clones = []
+    for info in infos:
+        if info.pool != pool or not filter_volumes(info.name):
+            continue
+        graph.add_node(info.name)
+        for snapname, protected in info.snapshots:
+            snap = '%s@%s' % (info.name, snapname)
+            graph.add_node(snap)
+            graph.add_edge(info.name, snap)
+            for volpool, name in info.children.get(snapname, []):
+                if volpool != pool:
+                    print("WARNING: Image %s has clone on a different "
+                          "pool: %s" % (snap, volpool))
+                clones.append((snap, name))
+    # Add edges snapshot -> clone once all the volumes are in the graph,
+    # like `build_layering_graph` does
+    for snap, name in clones:
+        graph.add_edge(snap, name)
+    return graph
+
+
+def build_layering_graph_from_crawl(ioctx, pool, filter_volumes=lambda x: True,
+                                    jobs=1, graph_class=nx.DiGraph,
+                                    record=None):
+    """Returns the same DAG as `build_layering_graph`, using `rbdgraph`
+
+    All the images of `pool` are crawled with `rbdgraph.crawl`, which
+    opens each image once and each snapshot once. If `record` is given,
+    the crawl is also written to it (cfr. `rbdgraph.record_crawl`), so
+    that it can be used again with `--load-crawl`, here or by
+    `rbd-image-tree`.
+    """
+    ioctxs = rbdgraph.IoctxPool(None, {pool: ioctx})
+    images = rbdgraph.ImageCache(ioctxs)
+    roots = [(pool, name) for name in rbd.RBD().list(ioctx)]
+    try:
+        infos = rbdgraph.crawl(images, roots, lambda p: p == pool, jobs)
+        if record is not None:
+            infos = rbdgraph.record_crawl(infos, record)
+        return build_layering_graph_from_infos(infos, pool, filter_volumes,
+                                               graph_class)
+    finally:
+        images.close()
+
+
+# Number of omap entries to fetch with a single librados read
+OMAP_PAGE = 4096
+
+
+def _decode_string(data, offset=0):
+    """Decode a length-prefixed string, as encoded by Ceph"""
+    length = struct.unpack_from('<I', data, offset)[0]
+    offset += 4
+    return data[offset:offset + length], offset + length
+
+
+def _omap_items(ioctx, oid, prefix='', page=OMAP_PAGE):
+    """Yields the omap items of `oid` whose key starts with `prefix`
+
+    Items are fetched in pages of `page` entries. A missing object is
+    considered empty.
+    """
+    start_after = ''
+    while True:
+        with rados.ReadOpCtx() as read_op:
+            items, ret = ioctx.get_omap_vals(read_op, start_after, prefix, page)
+            try:
+                ioctx.operate_read_op(read_op, oid)
+            except rados.ObjectNotFound:
+                return
+            items = list(items)
+        for key, value in items:
+            yield key, value
+        if len(items) < page:
+            return
+        start_after = items[-1][0]
+
+
+def _read_header_snaps(ioctx, image_id):
+    """Returns the snapshots of image `image_id`, read from its header
+
+    Each snapshot is a ``snapshot_<id>`` omap key of the header, whose
+    value is a `cls_rbd_snap` structure: after the 6 bytes encoding
+    header, it starts with the snapshot id and name.
+    """
+    snaps = []
+    for key, value in _omap_items(ioctx, 'rbd_header.%s' % image_id,
+                                  'snapshot_'):
+        snap_id = struct.unpack_from('<Q', value, 6)[0]
+        name, _ = _decode_string(value, 14)
+        snaps.append((snap_id, name))
+    return sorted(snaps)
+
+
+def _read_children(ioctx):
+    """Returns all the clone relationships recorded in `rbd_children`
+
+    Returns a dictionary mapping ``(pool_id, image_id, snap_id)`` of
+    the parent snapshots to the ids of their clones in this pool.
+    """
+    children = {}
+    for key, value in _omap_items(ioctx, 'rbd_children'):
+        pool_id = struct.unpack_from('<q', key)[0]
+        image_id, offset = _decode_string(key, 8)
+        snap_id = struct.unpack_from('<Q', key, offset)[0]
+        count = struct.unpack_from('<I', value)[0]
+        offset = 4
+        ids = []
+        for i in xrange(count):
+            child_id, offset = _decode_string(value, offset)
+            ids.append(child_id)
+        children[pool_id, image_id, snap_id] = ids
+    return children
+
+
+def build_layering_graph_from_metadata(ioctx, pool,
+                                       filter_volumes=lambda x: True, jobs=1,
+                                       graph_class=nx.DiGraph):
+    """Returns the same DAG as `build_layering_graph`, reading rbd metadata
+
+    Instead of opening images and snapshots, the pool-level metadata
+    objects maintained by librbd are read directly with librados:
+
+    * the `rbd_directory` omap maps the names of the images to their
+      ids;
+    * the `rbd_children` omap maps each parent snapshot to its clones;
+    * the header omap of each interesting image lists its snapshots.
+
+    The first two are read in a few paged reads for the whole pool;
+    header reads are spread over `jobs` threads. Format 1 images are
+    not in the omap of `rbd_directory`, and are opened as usual: they
+    cannot be cloned anyway.
+
+    Only clones recorded in the `rbd_children` object of `pool` are
+    found: clones living in other pools are not.
+    """
+    rbd_inst = rbd.RBD()
+
+    ids = {}
+    for key, value in _omap_items(ioctx, 'rbd_directory', 'name_'):
+        ids[key[len('name_'):]] = _decode_string(value)[0]
+    names = dict((image_id, name) for name, image_id in ids.items())
+
+    volumenames = [vol for vol in rbd_inst.list(ioctx) if filter_volumes(vol)]
+
+    def _snaps(name):
+        if name in ids:
+            return _read_header_snaps(ioctx, ids[name])
+        return [(None, snapname) for snapname in _list_snaps(ioctx, name)]
+    snaps = _crawl_map(_snaps, volumenames, jobs)
+    children = _read_children(ioctx)
+    pool_id = ioctx.get_pool_id()
+
+    graph = graph_class()
+    for name, snapshots in zip(volumenames, snaps):
+        graph.add_node(name)
+        for snap_id, snapname in snapshots:
+            graph.add_node('%s@%s' % (name, snapname))
+            graph.add_edge(name, '%s@%s' % (name, snapname))
+
+    for name, snapshots in zip(volumenames, snaps):
+        for snap_id, snapname in snapshots:
+            for child_id in children.get((pool_id, ids.get(name), snap_id), []):
+                if child_id in names:
+                    graph.add_edge('%s@%s' % (name, snapname), names[child_id])
+    return graph
+
+
+CACHE_VERSION = 2
+
+# Allowed difference, in seconds, between the clocks of the OSDs and
+# of this host
+CLOCK_SKEW = 5
+
+
+def _image_marker(ioctx, name):
+    """Returns a ``(key, marker)`` pair for image `name`
+
+    `key` is the id of the image, which does not change when the image
+    is renamed. `marker` is the size and the modification time of the
+    image header, which changes whenever snapshots or the parent of
+    the image are modified. Both are read with plain librados calls,
+    without opening the image.
+
+    librados only returns the modification time in whole seconds, so
+    a header modified in the same second as it was read keeps the same
+    marker: see `build_layering_graph_cached`.
+    """
+    try:
+        # rbd_id.<name> contains the id encoded as a length-prefixed string
+        data = ioctx.read('rbd_id.%s' % name)
+        length = struct.unpack('<I', data[:4])[0]
+        key = data[4:4 + length]
+        header = 'rbd_header.%s' % key
+    except rados.ObjectNotFound:
+        # format 1 image: no id, the header is named after the image
+        key = name
+        header = '%s.rbd' % name
+    try:
+        size, mtime = ioctx.stat(header)
+        marker = (size, int(time.mktime(mtime)))
+    except rados.ObjectNotFound:
+        marker = None
+    return key, marker
+
+
+def _query_image(ioctx, name, full=True):
+    """Returns the parent, snapshots and children of image `name`
+
+    If `full` is False only the parent is read, which is enough to
+    know which images the clones depend on.
+    """
+    snapnames, parent = _image_info(ioctx, name, snaps=full)
+    entry = {'parent': parent, 'snaps': None, 'children': None}
+    if full:
+        entry['snaps'] = snapnames
+        entry['children'] = dict(
+            (snapname, _list_children(ioctx, name, snapname))
+            for snapname in snapnames)
+    return entry
+
+
+def load_crawl_cache(path, pool):
+    """Returns the crawl cache stored in `path`, or an empty one"""
+    try:
+        with open(path, 'rb') as fd:
+            cache = pickle.load(fd)
+    except IOError:
+        cache = None
+    if (not cache or cache.get('version') != CACHE_VERSION
+            or cache.get('pool') != pool):
+        cache = {'version': CACHE_VERSION, 'pool': pool, 'images': {},
+                 'started': 0}
+    return cache
+
+
+def save_crawl_cache(path, cache):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fd:
+        pickle.dump(cache, fd, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
 
-    # Find subgraphs (connected components)
+def build_layering_graph_cached(ioctx, pool, cachefile,
+                                filter_volumes=lambda x: True, jobs=1,
+                                graph_class=nx.DiGraph):
+    """Returns the same DAG as `build_layering_graph`, using a crawl cache
 
-    # Find roots (nodes with only out edges)
-    roots = [n for n,d in graph.in_degree().items() if d == 0]
-    for g in roots:
-        nodes = nx.shortest_path(graph, source=g).keys()
-        sub = graph.subgraph(nodes)
-        subgraphs.append(sub)
-    return subgraphs
+    The cache stored in `cachefile` maps the id of every image of the
+    pool to its name, snapshots, parent and children, together with
+    the header modification time of the image. Only images which have
+    been added, renamed or modified since the last run are queried
+    again, together with the images they are (or were) cloned from,
+    whose list of children may have changed. The cache is then
+    updated.
+
+    Modification times only have a resolution of one second, hence
+    images modified less than `CLOCK_SKEW` seconds before the last
+    run started are queried again too, as they could have been
+    modified again after being read, without changing their marker.
+
+    Clones living in other pools do not modify anything in `pool`, so
+    new cross-pool clones of unmodified images are not noticed.
+    """
+    rbd_inst = rbd.RBD()
+    cache = load_crawl_cache(cachefile, pool)
+    cached = cache['images']
+
+    # markers older than this can be trusted by the next run
+    started = int(time.time()) - CLOCK_SKEW
+    names = rbd_inst.list(ioctx)
+    interesting = dict((name, filter_volumes(name)) for name in names)
+    markers = dict(zip(names, _crawl_map(
+        lambda name: _image_marker(ioctx, name), names, jobs)))
+    keys = dict((name, markers[name][0]) for name in names)
+
+    removed = set(cached) - set(keys.values())
+    dirty = set()
+    for name in names:
+        entry = cached.get(keys[name])
+        if (entry is None
+                or entry['name'] != name
+                or entry['marker'] != markers[name][1]
+                or (entry['marker'] is not None
+                    and entry['marker'][1] >= cache['started'])
+                or (interesting[name] and entry['children'] is None)):
+            dirty.add(name)
+
+    # Images whose parent changed: the children of the old parent
+    # must be listed again.
+    parents = set()
+    for key in removed:
+        parents.add(cached[key]['parent'])
+    for name in dirty:
+        entry = cached.get(keys[name])
+        if entry is not None:
+            parents.add(entry['parent'])
+
+    print("Crawl cache: %d images unchanged, %d to check, %d removed"
+          % (len(names) - len(dirty), len(dirty), len(removed)))
+
+    def _refresh(names):
+        names = sorted(names)
+        entries = _crawl_map(
+            lambda name: _query_image(ioctx, name, interesting[name]),
+            names, jobs)
+        for name, entry in zip(names, entries):
+            entry['name'] = name
+            entry['marker'] = markers[name][1]
+            cached[keys[name]] = entry
+
+    _refresh(dirty)
+    for name in dirty:
+        parents.add(cached[keys[name]]['parent'])
+
+    # ...and so must the children of the new parents
+    again = set()
+    for parent in parents:
+        if parent is None:
+            continue
+        parentpool, parentname, parentsnap = parent
+        if parentpool == pool and parentname in keys \
+                and parentname not in dirty and interesting[parentname]:
+            again.add(parentname)
+    _refresh(again)
+
+    for key in removed:
+        del cached[key]
+    cache['started'] = started
+    save_crawl_cache(cachefile, cache)
+
+    graph = graph_class()
+    for name in names:
+        if not interesting[name]:
+            continue
+        entry = cached[keys[name]]
+        graph.add_node(name)
+        for snapname in entry['snaps']:
+            graph.add_node('%s@%s' % (name, snapname))
+            graph.add_edge(name, '%s@%s' % (name, snapname))
+    for name in names:
+        if not interesting[name]:
+            continue
+        entry = cached[keys[name]]
+        for snapname in entry['snaps']:
+            for volpool, child in entry['children'][snapname]:
+                if volpool != pool:
+                    print("WARNING: Image %s@%s has clone on a different "
+                          "pool: %s" % (name, snapname, volpool))
+                graph.add_edge('%s@%s' % (name, snapname), child)
+    return graph
+
+
+def find_connected_components(graph):
+    """Returns the weakly connected components of `graph` as subgraphs
+
+    Components are computed in a single linear pass, and every node
+    belongs to exactly one of them, even when several roots share
+    some descendants.
+    """
+    return [graph.subgraph(nodes)
+            for nodes in nx.weakly_connected_components(graph)]
 
 
 def graph_can_be_deleted(graph):
@@ -186,58 +866,469 @@ def graph_can_be_deleted(graph):
 
 
 def find_subgraphs_to_delete(graph, delete_pattern=DELETE_PATTERN):
-    # this doesn't work: it can also find the root even if there are
-    # subtree starting from the root that cannot be deleted.
-    leafs = [n for n,d in graph.out_degree().items() if d == 0]
-    want_to_delete = {}
-    to_visit_again = set()
-    for leaf in leafs:
-        if delete_pattern not in leaf:
-            want_to_delete[leaf] = False
+    """Returns the subgraph of `graph` made of the nodes that can be deleted
+
+    A node can be deleted if its name matches `delete_pattern` and all
+    of its descendants can be deleted. Nodes are visited in reverse
+    topological order, so that all the successors of a node are
+    already decided when the node is visited: this only needs a
+    single pass over nodes and edges.
+    """
+    deletable = set()
+    for node in reversed(list(nx.topological_sort(graph))):
+        if delete_pattern not in node:
             continue
-        else:
-            want_to_delete[leaf] = True
-
-        # Now, go up
-        subtree = graph.subgraph(nx.ancestors(graph, leaf))
-        currently_deleting = True
-        for node in reversed(nx.topological_sort(subtree)):
-            # * If node has been visited already, skip to next leaf
-            # * (avoid visiting ancestors twice)
-            #
-            # * If node cannot be deleted, continue and mark all nodes
-            #   as cannot be deleted.
-            #
-            # * If node has been never visited, and it should be deleted,
-            #
-            #   - if has other outlets, add it to the list of nodes to
-            #     check later on
-            #   - if has no other outles, mark it for deletion and
-            #     continue
-            if node in want_to_delete:
-                # We already visited this node, we should stop.
-                break
-            if delete_pattern not in leaf or currently_deleting is False:
-                # None of the ancestors should be deleted
-                want_to_delete[node] = False
-                currently_deleting = False
+        if all(succ in deletable for succ in graph[node]):
+            deletable.add(node)
+    return graph.subgraph(deletable)
+
+
+class CompactGraph(object):
+    """Memory efficient DAG of rbd volumes and snapshots
+
+    Supports the subset of the `nx.DiGraph` interface used to build
+    the graph (`add_node`, `add_edge`, ``in`` and `len`). Node names
+    are interned to consecutive integer ids and stored back to back
+    in a single byte buffer, and edges are kept in `array` objects.
+    Once `freeze` is called (which `deletion_plan` does), edges are
+    converted to CSR form and the name index is dropped: the graph can
+    then only be traversed, and names are decoded only when the
+    deletion plan is produced.
+    """
+
+    def __init__(self):
+        self._ids = {}
+        self._names = bytearray()
+        self._name_offsets = array('l', [0])
+        # edges, as two parallel arrays until the graph is frozen
+        self._src = array('l')
+        self._dst = array('l')
+        # CSR successors of u: succ[offsets[u]:offsets[u+1]]
+        self._offsets = None
+        self._succ = None
+
+    def __len__(self):
+        return len(self._name_offsets) - 1
+
+    def __contains__(self, name):
+        if self._ids is None:
+            raise TypeError("Cannot look up names in a frozen CompactGraph")
+        return name in self._ids
+
+    def add_node(self, name):
+        if self._ids is None:
+            raise TypeError("Cannot modify a frozen CompactGraph")
+        node = self._ids.get(name)
+        if node is None:
+            node = self._ids[name] = len(self)
+            self._names.extend(name)
+            self._name_offsets.append(len(self._names))
+        return node
+
+    def add_edge(self, u, v):
+        self._src.append(self.add_node(u))
+        self._dst.append(self.add_node(v))
+
+    def name(self, node):
+        return str(self._names[self._name_offsets[node]:
+                               self._name_offsets[node + 1]])
+
+    def number_of_edges(self):
+        self.freeze()
+        return len(self._succ)
+
+    def successors(self, node):
+        return self._succ[self._offsets[node]:self._offsets[node + 1]]
+
+    def freeze(self):
+        """Convert edges to CSR form and drop the name index"""
+        if self._succ is not None:
+            return
+        size = len(self)
+        # counting sort of the edges by source node
+        start = array('l', [0]) * (size + 1)
+        for u in self._src:
+            start[u + 1] += 1
+        for u in xrange(size):
+            start[u + 1] += start[u]
+        fill = array('l', start)
+        unsorted = array('l', [0]) * len(self._src)
+        for u, v in izip(self._src, self._dst):
+            unsorted[fill[u]] = v
+            fill[u] += 1
+        # drop duplicated edges, like nx.DiGraph does
+        self._offsets = array('l', [0]) * (size + 1)
+        self._succ = array('l')
+        for u in xrange(size):
+            self._succ.extend(sorted(set(unsorted[start[u]:start[u + 1]])))
+            self._offsets[u + 1] = len(self._succ)
+        self._src = self._dst = None
+        self._ids = None
+
+    def topological_sort(self):
+        """Returns an array of node ids in topological order"""
+        self.freeze()
+        indegree = array('l', [0]) * len(self)
+        for v in self._succ:
+            indegree[v] += 1
+        order = array('l', [u for u in xrange(len(self)) if indegree[u] == 0])
+        i = 0
+        while i < len(order):
+            u = order[i]
+            i += 1
+            for v in self.successors(u):
+                indegree[v] -= 1
+                if indegree[v] == 0:
+                    order.append(v)
+        if len(order) != len(self):
+            raise nx.NetworkXUnfeasible("Graph contains a cycle.")
+        return order
+
+    def find_deletable(self, delete_pattern=DELETE_PATTERN, order=None):
+        """Returns a bytearray flagging the nodes that can be deleted
+
+        Same rule as `find_subgraphs_to_delete`: a node can be
+        deleted if its name matches and all its descendants can be
+        deleted.
+        """
+        if order is None:
+            order = self.topological_sort()
+        deletable = bytearray(len(self))
+        names, offsets = self._names, self._name_offsets
+        for u in reversed(order):
+            if names.find(delete_pattern, offsets[u], offsets[u + 1]) < 0:
+                continue
+            if all(deletable[v] for v in self.successors(u)):
+                deletable[u] = 1
+        return deletable
+
+    def deletion_plan(self, delete_pattern=DELETE_PATTERN):
+        """Returns the components of deletable nodes, in deletion order
+
+        Components are found with a union-find over the deletable
+        nodes. A single topological sort of the whole graph is done:
+        its restriction to a component is a topological sort of that
+        component.
+        """
+        order = self.topological_sort()
+        deletable = self.find_deletable(delete_pattern, order)
+        parent = array('l', xrange(len(self)))
+
+        def find(u):
+            root = u
+            while parent[root] != root:
+                root = parent[root]
+            while parent[u] != root:
+                parent[u], u = root, parent[u]
+            return root
+
+        for u in xrange(len(self)):
+            if not deletable[u]:
+                continue
+            # successors of a deletable node are deletable too
+            for v in self.successors(u):
+                ru, rv = find(u), find(v)
+                if ru != rv:
+                    parent[rv] = ru
+
+        components = {}
+        roots = []
+        for u in reversed(order):
+            if deletable[u]:
+                root = find(u)
+                if root not in components:
+                    components[root] = array('l')
+                    roots.append(root)
+                components[root].append(u)
+        return [[self.name(u) for u in components[root]] for root in roots]
+
+
+def deletion_plan(graph, delete_pattern=DELETE_PATTERN):
+    """Returns the components of `graph` that can be deleted
+
+    Each component is a list of node names, in the order they must be
+    deleted (clones before their parents). `graph` can be either a
+    networkx graph or a `CompactGraph`.
+    """
+    if isinstance(graph, CompactGraph):
+        return graph.deletion_plan(delete_pattern)
+    to_delete = find_subgraphs_to_delete(graph, delete_pattern)
+    # Note: in networkx 1.9 you also have reverse=True
+    return [list(reversed(list(nx.topological_sort(g))))
+            for g in find_connected_components(to_delete)]
+
+
+def save_plan(stream, pool, plan):
+    """Write `plan` to `stream`, one JSON object per component"""
+    for component in plan:
+        stream.write(json.dumps({'pool': pool, 'component': component}))
+        stream.write('\n')
+        stream.flush()
+
+
+def load_plan(path, pool):
+    """Returns the list of components of the plan saved in `path`"""
+    plan = []
+    with open(path) as fd:
+        for line in fd:
+            if not line.strip():
                 continue
+            data = json.loads(line)
+            if data['pool'] != pool:
+                raise ValueError("Plan %s is for pool %s, not %s"
+                                 % (path, data['pool'], pool))
+            plan.append([str(node) for node in data['component']])
+    return plan
+
+
+def parse_size(value):
+    """Parse a size like ``100M`` or ``2G`` into a number of bytes"""
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+class Throttle(object):
+    """Token bucket limiting the rate of some quantity across threads
 
-            # Apparently, DELETE_PATTERN is in leaf, we are currently
-            # deleting and this is the first time we visit the node.
-            if len(subtree.edges(node)) == 1:
-                # This is the only children.
-                want_to_delete[node] = True
+    Requests larger than the bucket are allowed, but the caller then
+    has to wait until the debt is paid back. A `rate` of 0 or None
+    disables the throttle.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, amount=1):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate,
+                               self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / float(self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Journal(object):
+    """Append-only record of the nodes already deleted"""
+
+    def __init__(self, path):
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as fd:
+                self.done.update(line.rstrip('\n') for line in fd)
+        self._fd = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def record(self, node):
+        with self._lock:
+            self._fd.write(node + '\n')
+            self._fd.flush()
+            os.fsync(self._fd.fileno())
+            self.done.add(node)
+
+    def close(self):
+        self._fd.close()
+
+
+def _delete_node(ioctx, node, ops, bandwidth):
+    """Delete snapshot or image `node`, if it still exists
+
+    Every step is skipped if it was already done, so that an
+    interrupted deletion can be safely retried.
+    """
+    name, _, snapname = node.partition('@')
+    try:
+        image = rbd.Image(ioctx, name, read_only=not snapname)
+    except rbd.ImageNotFound:
+        return
+    try:
+        if snapname:
+            sizes = dict((snap['name'], snap['size'])
+                         for snap in image.list_snaps())
+            if snapname not in sizes:
+                return
+            ops.consume()
+            bandwidth.consume(sizes[snapname])
+            if image.is_protected_snap(snapname):
+                image.unprotect_snap(snapname)
+            image.remove_snap(snapname)
+            return
+        size = image.size()
+    finally:
+        image.close()
+    ops.consume()
+    bandwidth.consume(size)
+    rbd.RBD().remove(ioctx, name)
+
+
+def execute_plan(ioctx, plan, journal, jobs=1, max_ops=None, max_bytes=None,
+                 delete_pattern=DELETE_PATTERN):
+    """Delete all the nodes of `plan`, without asking for confirmation
+
+    Up to `jobs` components are deleted concurrently, each one in
+    the order given by the plan. Deletions are throttled to
+    `max_ops` operations and `max_bytes` bytes (of image or snapshot
+    size) per second across all threads. Nodes already recorded in
+    `journal` are skipped, and every deleted node is recorded there.
+    If a deletion fails, the rest of its component is left alone, as
+    it may still be needed by the node which could not be deleted.
+
+    Returns the list of nodes that could not be deleted.
+    """
+    ops = Throttle(max_ops)
+    bandwidth = Throttle(max_bytes)
+
+    def _delete_component(component):
+        for node in component:
+            if node in journal.done:
+                continue
+            if delete_pattern not in node:
+                print("ERROR: refusing to delete %s, as it was not deleted "
+                      "by OpenStack. Skipping the rest of its component."
+                      % node)
+                return node
+            try:
+                print("Deleting %s" % node)
+                _delete_node(ioctx, node, ops, bandwidth)
+            except Exception as err:
+                print("ERROR: cannot delete %s: %s. Skipping the rest of "
+                      "its component." % (node, err))
+                return node
+            journal.record(node)
+
+    failed = _crawl_map(_delete_component, plan, jobs)
+    return [node for node in failed if node is not None]
+
+
+def _crawl_tree(ioctx, pool, root, filter_volumes=lambda x: True, jobs=1,
+                graph_class=nx.DiGraph, threads=None):
+    """Returns the layering DAG of the clone tree rooted at image `root`
+
+    The tree is crawled breadth first, and the images of each level
+    are inspected concurrently on up to `jobs` threads (or on the
+    `threads` pool, see `_crawl_map`). All the images
+    of the tree are crawled, but like in `build_layering_graph` only
+    the interesting ones are added to the graph, together with their
+    snapshots and clones.
+    """
+    graph = graph_class()
+    frontier = [root]
+    while frontier:
+        entries = _crawl_map(lambda name: _query_image(ioctx, name),
+                             frontier, jobs, threads)
+        clones = []
+        for name, entry in zip(frontier, entries):
+            wanted = filter_volumes(name)
+            if wanted:
+                graph.add_node(name)
+            for snapname in entry['snaps']:
+                snapnode = '%s@%s' % (name, snapname)
+                if wanted:
+                    graph.add_node(snapnode)
+                    graph.add_edge(name, snapnode)
+                for volpool, child in entry['children'][snapname]:
+                    if volpool != pool:
+                        if wanted:
+                            print("WARNING: Image %s has clone on a "
+                                  "different pool: %s" % (snapnode, volpool))
+                            graph.add_edge(snapnode, child)
+                        continue
+                    if wanted:
+                        graph.add_edge(snapnode, child)
+                    clones.append(child)
+        frontier = clones
+    return graph
+
+
+def stream_deletion_plans(ioctx, pool, stream, filter_volumes=lambda x: True,
+                          jobs=1, graph_class=nx.DiGraph,
+                          delete_pattern=DELETE_PATTERN):
+    """Write the deletion plan of `pool` to `stream`, one clone tree at a time
+
+    Every image of the pool is checked for a parent. Images without
+    a parent in `pool` are the roots of clone trees: each tree is
+    crawled with `_crawl_tree`, and the plan of its deletable
+    components is written to `stream` with `save_plan` as soon as the
+    tree is complete. Only one tree at a time is kept in memory.
+
+    As there are no edges between different trees, the result is the
+    same plan `deletion_plan` computes on the whole graph.
+    """
+    rbd_inst = rbd.RBD()
+    names = rbd_inst.list(ioctx)
+    batch = max(1, jobs) * 16
+    threads = ThreadPool(jobs) if jobs > 1 else None
+    try:
+        for start in xrange(0, len(names), batch):
+            chunk = names[start:start + batch]
+            infos = _crawl_map(
+                lambda name: _image_info(ioctx, name, snaps=False),
+                chunk, jobs, threads)
+            for name, (snapnames, parent) in zip(chunk, infos):
+                if parent is not None and parent[0] == pool:
+                    # reached when crawling the tree of its root
+                    continue
+                tree = _crawl_tree(ioctx, pool, name, filter_volumes, jobs,
+                                   graph_class, threads)
+                save_plan(stream, pool, deletion_plan(tree, delete_pattern))
+    finally:
+        if threads is not None:
+            threads.close()
+            threads.join()
+
+
+def make_synthetic_graph(nodes, chain=0.5, deleted=0.9, seed=None,
+                         graph_class=nx.DiGraph):
+    """Returns a random layering DAG with `nodes` nodes
+
+    Each node but the first is a clone of a previous one: with
+    probability `chain` of the node just created, building long clone
+    chains, otherwise of a random one. A fraction `deleted` of the
+    nodes are named as if they were deleted by glance.
+    """
+    rnd = random.Random(seed)
+    names = []
+    graph = graph_class()
+    for i in xrange(nodes):
+        name = 'image-%d' % i
+        if rnd.random() < deleted:
+            name += '_' + DELETE_PATTERN
+        graph.add_node(name)
+        if names:
+            if rnd.random() < chain:
+                graph.add_edge(names[-1], name)
             else:
-                to_visit_again.add(node)
-                break
+                graph.add_edge(rnd.choice(names), name)
+        names.append(name)
+    return graph
+
 
-    to_delete = [i for i in want_to_delete if want_to_delete.get(i)]
-    if to_visit_again:
-        # Remove nodes we already visited and call again this function.
-        sub = graph.subgraph([g for g in graph if g not in to_delete])
-        to_delete.extend(find_subgraphs_to_delete(sub, delete_pattern=delete_pattern).nodes())
-    return graph.subgraph(to_delete)
+def run_benchmark(sizes=(10**5, 3 * 10**5, 10**6)):
+    """Time the deletion plan on synthetic graphs of growing size"""
+    print("%-8s %10s %10s %10s %10s %12s" % (
+        'graph', 'nodes', 'edges', 'deletable', 'seconds', 'nodes/s'))
+    for size in sizes:
+        for graph_class in nx.DiGraph, CompactGraph:
+            graph = make_synthetic_graph(size, seed=size,
+                                         graph_class=graph_class)
+            edges = graph.number_of_edges()
+            start = time.time()
+            plan = deletion_plan(graph)
+            elapsed = time.time() - start
+            print("%-8s %10d %10d %10d %10.2f %12.0f" % (
+                'compact' if graph_class is CompactGraph else 'networkx',
+                len(graph), edges, sum(len(c) for c in plan),
+                elapsed, len(graph) / elapsed))
 
 
 if __name__ == "__main__":
@@ -263,29 +1354,168 @@ if __name__ == "__main__":
                         default=None,
                         help='Instead of building the graph from ceph, '
                         'use the supplied file.')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        default=1,
+                        help='Number of images to inspect concurrently '
+                        'while building the graph. Higher values put more '
+                        'load on monitors and OSDs. Default: %(default)s')
+    parser.add_argument('--strategy',
+                        choices=['children', 'parents', 'metadata', 'crawl'],
+                        default='children',
+                        help='How to find clones. "children" opens every '
+                        'snapshot to list its clones. "parents" opens every '
+                        'image of the pool only once and reads its parent. '
+                        '"metadata" reads the rbd metadata objects of the '
+                        'pool directly, without opening images. The '
+                        'last two will not see clones living in other '
+                        'pools. "crawl" uses the crawler shared with '
+                        'rbd-image-tree, which can be saved with '
+                        '--save-crawl. Default: %(default)s')
+    parser.add_argument('--save-crawl', metavar='FILE',
+                        default=None,
+                        help='Also save the crawled images to FILE, to be '
+                        'used later with --load-crawl, also by '
+                        'rbd-image-tree. Implies "--strategy crawl".')
+    parser.add_argument('--load-crawl', metavar='FILE',
+                        default=None,
+                        help='Instead of crawling the pool, build the graph '
+                        'out of the images saved to FILE with --save-crawl, '
+                        'here or by rbd-image-tree.')
+    parser.add_argument('--compact', action='store_true',
+                        help='Use a compact graph representation, which '
+                        'needs much less memory on pools with millions of '
+                        'images and snapshots.')
+    parser.add_argument('--cache', metavar='FILE',
+                        default=None,
+                        help='Keep a crawl cache in FILE. Only images added, '
+                        'removed or modified since the previous run are '
+                        'inspected again. Implies "--strategy children". '
+                        'Default: do not use a cache.')
     parser.add_argument('-f', '--force',
                         action='store_true',
                         help='Instead of printing rbd commands to cleanup '
                         'deleted images, actually delete them.')
+    parser.add_argument('--write-plan', metavar='FILE',
+                        default=None,
+                        help='Write the deletion plan to FILE, one JSON '
+                        'object per connected component. Once reviewed, '
+                        'the plan can be executed with --execute.')
+    parser.add_argument('--stream', action='store_true',
+                        help='Crawl the pool one clone tree at a time, and '
+                        'append the deletion plan of each tree to the '
+                        '--write-plan FILE as soon as the tree has been '
+                        'crawled. Memory usage is bounded by the largest '
+                        'tree.')
+    parser.add_argument('--execute', metavar='PLAN',
+                        default=None,
+                        help='Delete, without asking for confirmation, all '
+                        'the images and snapshots listed in PLAN, as '
+                        'written by --write-plan. Up to --jobs components '
+                        'are deleted concurrently.')
+    parser.add_argument('--journal', metavar='FILE',
+                        default=None,
+                        help='Record deleted images and snapshots in FILE, '
+                        'so that an interrupted --execute can be resumed. '
+                        'Default: PLAN.journal')
+    parser.add_argument('--max-ops', metavar='N', type=float,
+                        default=None,
+                        help='With --execute, delete at most N images or '
+                        'snapshots per second. Default: no limit.')
+    parser.add_argument('--max-bytes', metavar='SIZE', type=parse_size,
+                        default=None,
+                        help='With --execute, delete at most SIZE bytes of '
+                        'images or snapshots per second, e.g. 500M. '
+                        'Default: no limit.')
     parser.add_argument('--run-tests', action='store_true', help='Run tests')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Time the deletion plan on synthetic graphs '
+                        'of 10^5 to 10^6 nodes')
     cfg = parser.parse_args()
+    if cfg.stream and not cfg.write_plan:
+        parser.error("--stream requires --write-plan")
+    if cfg.stream and (cfg.load or cfg.save or cfg.cache):
+        parser.error("--stream cannot be used with --load, --save or --cache")
+    if cfg.save_crawl or cfg.load_crawl:
+        if cfg.stream or cfg.cache or cfg.load:
+            parser.error("--save-crawl and --load-crawl cannot be used with "
+                         "--stream, --cache or --load")
+        cfg.strategy = 'crawl'
 
     if cfg.run_tests:
         sys.argv=[sys.argv[0]]
         unittest.main()
         sys.exit(0)
 
+    if cfg.benchmark:
+        run_benchmark()
+        sys.exit(0)
+
+    if cfg.execute:
+        ioctx = cluster_connect(cfg.pool, cfg.conf, cfg.user)
+        plan = load_plan(cfg.execute, cfg.pool)
+        journal = Journal(cfg.journal or cfg.execute + '.journal')
+        try:
+            failed = execute_plan(ioctx, plan, journal, jobs=cfg.jobs,
+                                  max_ops=cfg.max_ops,
+                                  max_bytes=cfg.max_bytes)
+        finally:
+            journal.close()
+        if failed:
+            print("Could not delete: %s" % str.join(' ', failed))
+            sys.exit(1)
+        sys.exit(0)
+
+    def _filter_volumes_and_disks(x):
+        return not x.startswith('volume-') and not x.endswith('_disk')
+    graph_class = CompactGraph if cfg.compact else nx.DiGraph
+
+    if cfg.stream:
+        ioctx = cluster_connect(cfg.pool, cfg.conf, cfg.user)
+        with open(cfg.write_plan, 'w') as fd:
+            stream_deletion_plans(ioctx, cfg.pool, fd,
+                                  filter_volumes=_filter_volumes_and_disks,
+                                  jobs=cfg.jobs, graph_class=graph_class)
+        print("Deletion plan written to %s" % cfg.write_plan)
+        sys.exit(0)
+
     # Build the graph of volumes/snapshots
+    ioctx = None
     if cfg.load:
         graph = pickle.load(open(cfg.load))
+    elif cfg.load_crawl:
+        with open(cfg.load_crawl) as fd:
+            graph = build_layering_graph_from_infos(
+                rbdgraph.read_crawl(fd), cfg.pool,
+                filter_volumes=_filter_volumes_and_disks,
+                graph_class=graph_class)
+    elif cfg.strategy == 'crawl':
+        ioctx = cluster_connect(cfg.pool, cfg.conf, cfg.user)
+        record = open(cfg.save_crawl, 'w') if cfg.save_crawl else None
+        try:
+            graph = build_layering_graph_from_crawl(
+                ioctx, cfg.pool, filter_volumes=_filter_volumes_and_disks,
+                jobs=cfg.jobs, graph_class=graph_class, record=record)
+        finally:
+            if record:
+                record.close()
     else:
-        def _filter_volumes_and_disks(x):
-            return not x.startswith('volume-') and not x.endswith('_disk')
         ioctx = cluster_connect(cfg.pool, cfg.conf, cfg.user)
-        rbd_inst = rbd.RBD()
 
-        graph = build_layering_graph(ioctx, cfg.pool,
-                                     filter_volumes=_filter_volumes_and_disks)
+        if cfg.cache:
+            graph = build_layering_graph_cached(
+                ioctx, cfg.pool, cfg.cache,
+                filter_volumes=_filter_volumes_and_disks, jobs=cfg.jobs,
+                graph_class=graph_class)
+        else:
+            if cfg.strategy == 'parents':
+                build_graph = build_layering_graph_from_parents
+            elif cfg.strategy == 'metadata':
+                build_graph = build_layering_graph_from_metadata
+            else:
+                build_graph = build_layering_graph
+            graph = build_graph(ioctx, cfg.pool,
+                                filter_volumes=_filter_volumes_and_disks,
+                                jobs=cfg.jobs, graph_class=graph_class)
 
     # Save the graph, for later postprocessing
     if cfg.save:
@@ -300,13 +1530,21 @@ if __name__ == "__main__":
     # for sub in subgraphs:
     #     if graph_can_be_deleted(sub):
     #         to_delete.append(sub)
-    subgraphs = find_subgraphs_to_delete(graph)
-    to_delete = find_connected_components(subgraphs)
+    to_delete = deletion_plan(graph)
+
+    if cfg.write_plan:
+        with open(cfg.write_plan, 'w') as fd:
+            save_plan(fd, cfg.pool, to_delete)
+        print("Deletion plan written to %s" % cfg.write_plan)
 
     # Cleanup connected components
-    for g in to_delete:
-        # Note: in networkx 1.9 you also have reverse=True
-        for n in reversed(nx.topological_sort(g)):
+    if cfg.force:
+        # graphs loaded from a file need a connection to delete images
+        if ioctx is None:
+            ioctx = cluster_connect(cfg.pool, cfg.conf, cfg.user)
+        rbd_inst = rbd.RBD()
+    for component in to_delete:
+        for n in component:
             if not cfg.force:
                 if '@' in n:
                     print("rbd -p %s snap unprotect %s" % (cfg.pool, n))
@@ -322,8 +1560,9 @@ if __name__ == "__main__":
                         print("Deleting image %s and all its snapshots" % n)
                         image = rbd.Image(ioctx, n)
                         for snap in image.list_snaps():
-                            image.unprotect_snap(snap)
-                            image.remove_snap(snap)
+                            if image.is_protected_snap(snap['name']):
+                                image.unprotect_snap(snap['name'])
+                            image.remove_snap(snap['name'])
                         del image
                         rbd_inst.remove(ioctx, n)
                     else:
@@ -19,6 +19,44 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 """
+Find rbd images which do not belong to any OpenStack resource, and
+print the commands needed to delete them.
+
+Images of all the pools given with `--pool` are listed over a single
+connection to the cluster, and classified by name, using the same
+patterns as `rbd-image-tree`:
+
++--------------------------+------------------+---------+
+| name                     | kind             | service |
++--------------------------+------------------+---------+
+| volume-<uuid>            | cinder volume    | cinder  |
+| <uuid>_disk_clone_<hex>  | VM snapshot      | (none)  |
+| <uuid>_disk*             | ephemeral disk   | nova    |
+| <uuid>                   | glance image     | glance  |
++--------------------------+------------------+---------+
+
+VM snapshots are glance images which outlive the VM they were taken
+from, and whose glance ID cannot be told from their name: they are
+never reported. Other images, and images already renamed by glance,
+are ignored too.
+
+The whole inventory (of all tenants) of each service owning some of
+the images is fetched once, with a few paginated requests, and joined
+with the rbd images by UUID. Candidate orphans are then checked again,
+one by one, before being reported.
+
+With `--cache FILE` the inventories are saved to FILE and reused for
+`--cache-ttl` seconds, so that repeated runs only list the rbd images
+and look up the candidate orphans, which are always checked again,
+even with `--no-verify`. Use `--refresh-cache` to fetch the
+inventories again regardless of their age.
+
+Where the credentials do not allow listing the volumes of all tenants,
+use `--per-volume`: every rbd volume is then looked up by UUID, with up
+to `--jobs` concurrent requests sharing a pool of keep-alive HTTP
+connections. Transient failures (connection errors, 413, 429 and 5xx
+replies) are retried with exponential backoff, and `--max-rate` limits
+the number of requests per second sent to the API.
 """
 __docformat__ = 'reStructuredText'
 __author__ = 'Hanieh Rajabi <hanieh.rajabi@gmail.com>'
@@ -26,14 +64,24 @@ __author__ = 'Hanieh Rajabi <hanieh.rajabi@gmail.com>'
 import os
 import argparse
 import cPickle as pickle
+from collections import namedtuple
+from functools import partial
+from multiprocessing.pool import ThreadPool
 import rados
+import random
 import rbd
 import sys
 import re
 import sys
 import logging
+import threading
+import time
+import unittest
+import uuid as uuidlib
+import requests
 from keystoneclient.auth.identity import v3
 from keystoneclient import session
+import keystoneclient.exceptions as kex
 from keystoneclient.v3 import client as keystone_client
 
 from cinderclient import client as cinder_client
@@ -41,7 +89,32 @@ import cinderclient.exceptions as cex
 
 log = logging.getLogger()
 log.addHandler(logging.StreamHandler())
-volume_re = re.compile('^volume-(?P<uuid>\w{8}-\w{4}-\w{4}-\w{4}-\w{12})')
+
+# Names of the rbd images created by OpenStack, shared with the other
+# rbd tools
+from rbdgraph import re_image, re_vol, re_ephemeral, re_image_snapshot
+
+# Kind of rbd image, pattern of its name and service owning it. The
+# first matching pattern wins. VM snapshots are glance images, but the
+# UUID in their name is the one of the VM, hence they cannot be
+# checked.
+KINDS = [
+    ('volume', re_vol, 'cinder'),
+    ('image_snapshot', re_image_snapshot, None),
+    ('instance', re_ephemeral, 'nova'),
+    ('image', re_image, 'glance'),
+]
+
+INVENTORY_CACHE_VERSION = 1
+
+RbdImage = namedtuple('RbdImage', ['pool', 'name', 'kind', 'service', 'uuid'])
+
+# HTTP status codes worth retrying
+TRANSIENT_CODES = (408, 413, 429, 500, 502, 503, 504)
+CONNECTION_ERRORS = (requests.exceptions.ConnectionError,
+                     requests.exceptions.Timeout,
+                     kex.ConnectionError,
+                     cex.ConnectionError)
 
 class EnvDefault(argparse.Action):
     # This is took from
@@ -58,23 +131,580 @@ class EnvDefault(argparse.Action):
         setattr(namespace, self.dest, values)
 
 
-def make_session(opts):
-    """Create a Keystone session"""
+def make_session(opts, pool_size=10):
+    """Create a Keystone session
+
+    HTTP connections are kept alive, and up to `pool_size` of them are
+    reused by concurrent requests.
+    """
     auth = v3.Password(auth_url=opts.os_auth_url,
                        username=opts.os_username,
                        password=opts.os_password,
                        project_name=opts.os_project_name,
                        user_domain_name=opts.os_user_domain_name,
                        project_domain_name=opts.os_project_domain_name)
-    sess = session.Session(auth=auth)
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    http.mount('http://', adapter)
+    http.mount('https://', adapter)
+    sess = session.Session(auth=auth, session=http)
     return sess
 
 
-def cluster_connect(pool, conffile, rados_id):
+class RateLimiter(object):
+    """Let at most `rate` calls per second through `wait()`
+
+    The limiter is shared by all the threads. A `rate` of None means no
+    limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            when = max(now, self.next)
+            self.next = when + self.interval
+        if when > now:
+            time.sleep(when - now)
+
+
+def is_transient(err):
+    """True if the request failing with `err` can be retried"""
+    if isinstance(err, CONNECTION_ERRORS):
+        return True
+    code = getattr(err, 'code', None) or getattr(err, 'http_status', None)
+    return code in TRANSIENT_CODES
+
+
+def retry(func, retries=3, backoff=0.5):
+    """Call `func()`, retrying it up to `retries` times on transient errors
+
+    The n-th retry happens after about `backoff` * 2^n seconds; the
+    delay is randomized to keep concurrent clients from retrying all
+    at the same time.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as err:
+            if attempt >= retries or not is_transient(err):
+                raise
+            delay = backoff * 2**attempt * random.uniform(0.5, 1.5)
+            log.debug("Request failed (%s), retrying in %.2fs", err, delay)
+            time.sleep(delay)
+            attempt += 1
+
+
+def cluster_connect(conffile, rados_id):
     cluster = rados.Rados(conffile=conffile, rados_id=rados_id)
     cluster.connect()
-    ioctx = cluster.open_ioctx(pool)
-    return ioctx
+    return cluster
+
+
+def make_cinder_client(sess):
+    return cinder_client.Client('2', session=sess)
+
+
+def make_nova_client(sess):
+    from novaclient import client as nova_client
+    return nova_client.Client('2', session=sess)
+
+
+def make_glance_client(sess):
+    from glanceclient import client as glance_client
+    return glance_client.Client('2', session=sess)
+
+
+def cinder_volume_exists(cclient, uuid):
+    try:
+        cclient.volumes.get(uuid)
+        return True
+    except cex.NotFound:
+        return False
+
+
+def nova_server_exists(nclient, uuid):
+    from novaclient import exceptions as nex
+    try:
+        nclient.servers.get(uuid)
+        return True
+    except nex.NotFound:
+        return False
+
+
+def glance_image_exists(gclient, uuid):
+    from glanceclient import exc as gex
+    try:
+        gclient.images.get(uuid)
+        return True
+    except gex.HTTPNotFound:
+        return False
+
+
+def _list_pages(list_page, page, retries, what):
+    """Returns the set of IDs of the items returned by `list_page`
+
+    `list_page(marker, limit)` is called until it returns no items.
+    """
+    uuids = set()
+    marker = None
+    while True:
+        items = retry(lambda: list_page(marker, page), retries)
+        # The server may return less than `page` items per request
+        # (cfr. osapi_max_limit), so stop only on an empty page.
+        if not items:
+            return uuids
+        uuids.update(item.id for item in items)
+        marker = items[-1].id
+        log.debug("Got %d %s so far", len(uuids), what)
+
+
+def list_cinder_volumes(cclient, page=1000, retries=3):
+    """Returns the set of UUIDs of all the cinder volumes, of all tenants
+
+    Volumes are listed without details, `page` volumes per request.
+    """
+    return _list_pages(
+        lambda marker, limit: cclient.volumes.list(
+            detailed=False, search_opts={'all_tenants': 1},
+            marker=marker, limit=limit),
+        page, retries, 'cinder volumes')
+
+
+def list_nova_servers(nclient, page=1000, retries=3):
+    """Returns the set of UUIDs of all the nova servers, of all tenants"""
+    return _list_pages(
+        lambda marker, limit: nclient.servers.list(
+            detailed=False, search_opts={'all_tenants': 1},
+            marker=marker, limit=limit),
+        page, retries, 'nova servers')
+
+
+def list_glance_images(gclient, page=1000, retries=3):
+    """Returns the set of UUIDs of all the glance images"""
+    return _list_pages(
+        lambda marker, limit: list(gclient.images.list(
+            page_size=limit, limit=limit, marker=marker)),
+        page, retries, 'glance images')
+
+
+# How to create a client, list all the resources and look up a single
+# resource of each service.
+SERVICES = {
+    'cinder': (make_cinder_client, list_cinder_volumes, cinder_volume_exists),
+    'nova': (make_nova_client, list_nova_servers, nova_server_exists),
+    'glance': (make_glance_client, list_glance_images, glance_image_exists),
+}
+
+
+def _pack_uuids(uuids):
+    """Returns `uuids` as a string of 16 bytes per UUID
+
+    IDs which are not UUIDs are returned in a separate list.
+    """
+    packed = []
+    others = []
+    for uuid in uuids:
+        try:
+            packed.append(uuidlib.UUID(uuid).bytes)
+        except ValueError:
+            others.append(uuid)
+    return str.join('', packed), others
+
+
+def _unpack_uuids(packed, others):
+    uuids = set(others)
+    uuids.update(str(uuidlib.UUID(bytes=packed[i:i + 16]))
+                 for i in xrange(0, len(packed), 16))
+    return uuids
+
+
+def load_inventory_cache(path, auth_url):
+    """Returns the inventory cache stored in `path`, or an empty one
+
+    The cache maps each service to the time its inventory was fetched
+    and the packed inventory. Caches of a different cloud are ignored.
+    """
+    try:
+        with open(path, 'rb') as fd:
+            cache = pickle.load(fd)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        cache = None
+    if (not cache or cache.get('version') != INVENTORY_CACHE_VERSION
+            or cache.get('auth_url') != auth_url):
+        cache = {'version': INVENTORY_CACHE_VERSION, 'auth_url': auth_url,
+                 'services': {}}
+    return cache
+
+
+def save_inventory_cache(path, cache):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fd:
+        pickle.dump(cache, fd, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+
+def cached_inventory(cache, service, ttl):
+    """Returns the inventory of `service` if younger than `ttl` seconds"""
+    entry = cache['services'].get(service)
+    if entry is None:
+        return None
+    fetched, packed, others = entry
+    if not 0 <= time.time() - fetched <= ttl:
+        return None
+    return _unpack_uuids(packed, others)
+
+
+def cache_inventory(cache, service, uuids):
+    cache['services'][service] = (time.time(),) + _pack_uuids(sorted(uuids))
+
+
+def lookup_uuids(exists, uuids, jobs=8, retries=3, rate=None, backoff=0.5):
+    """Returns the subset of `uuids` for which `exists(uuid)` is True
+
+    UUIDs are looked up one by one, with up to `jobs` concurrent
+    requests and no more than `rate` requests per second. The session
+    used by `exists` should allow `jobs` connections, cfr.
+    `make_session`.
+    """
+    limiter = RateLimiter(rate)
+
+    def lookup(uuid):
+        def get():
+            limiter.wait()
+            return exists(uuid)
+        return uuid, retry(get, retries, backoff)
+
+    existing = set()
+    pool = ThreadPool(jobs)
+    try:
+        for i, (uuid, found) in enumerate(
+                pool.imap_unordered(lookup, uuids)):
+            if found:
+                existing.add(uuid)
+            if i and i % 1000 == 0:
+                log.debug("Looked up %d UUIDs so far", i)
+    finally:
+        pool.terminate()
+        pool.join()
+    return existing
+
+
+def lookup_cinder_volumes(cclient, uuids, **kwargs):
+    """Returns the subset of `uuids` which are existing cinder volumes
+
+    Keyword arguments are passed to `lookup_uuids`.
+    """
+    return lookup_uuids(partial(cinder_volume_exists, cclient), uuids,
+                        **kwargs)
+
+
+def classify(name):
+    """Returns the (kind, service, uuid) of the rbd image `name`
+
+    Returns None for unrecognized images, for images already renamed
+    by glance (cfr. cleanup-deleted-os-images.py) and for images no
+    service can be asked about, cfr. `KINDS`.
+    """
+    if name.endswith('_to_be_deleted_by_glance'):
+        return None
+    for kind, regexp, service in KINDS:
+        match = regexp.match(name)
+        if match:
+            if service is None:
+                return None
+            return kind, service, match.group('uuid')
+    return None
+
+
+def list_rbd_images(cluster, pools):
+    """Returns a `RbdImage` for each recognized rbd image of `pools`
+
+    All the pools are listed over the same `cluster` connection.
+    """
+    rbd_inst = rbd.RBD()
+    images = []
+    for pool in pools:
+        ioctx = cluster.open_ioctx(pool)
+        try:
+            names = rbd_inst.list(ioctx)
+        finally:
+            ioctx.close()
+        found = 0
+        for name in names:
+            info = classify(name)
+            if info:
+                images.append(RbdImage(pool, name, *info))
+                found += 1
+        log.info("Got information about %d images (%d recognized) in pool %s",
+                 len(names), found, pool)
+    return images
+
+
+def find_orphans(images, inventories):
+    """Returns the `images` whose UUID is not in the inventory of their service
+
+    `inventories` maps each service to a container of the UUIDs of its
+    resources.
+    """
+    orphans = []
+    for image in images:
+        if image.uuid in inventories[image.service]:
+            log.debug("%s %s exists.", image.kind, image.uuid)
+        else:
+            log.debug("rbd image %s/%s should be deleted",
+                      image.pool, image.name)
+            orphans.append(image)
+    return orphans
+
+
+def reconcile(cluster, sess, pools, services=None, per_volume=False,
+              verify=True, page=1000, jobs=8, retries=3, rate=None,
+              cache=None, ttl=3600):
+    """Returns the `RbdImage` of the rbd images of `pools` which do not
+    belong to any resource of `services`
+
+    Images owned by other services are not checked. By default all the
+    services owning some of the images are checked.
+
+    With `per_volume` every UUID is looked up individually, otherwise
+    the inventory of each service is fetched with a paginated listing
+    and, if `verify` is set, the candidate orphans are looked up again
+    individually.
+
+    Listed inventories are stored in `cache` (cfr.
+    `load_inventory_cache`), and taken from it if younger than `ttl`
+    seconds; in this case the candidate orphans are always looked up
+    again.
+    """
+    # List rbd images first: resources created while fetching the
+    # inventories will then not be reported as orphans.
+    images = list_rbd_images(cluster, pools)
+    if services is not None:
+        images = [image for image in images if image.service in services]
+
+    uuids = {}
+    for image in images:
+        uuids.setdefault(image.service, set()).add(image.uuid)
+
+    clients = {}
+    inventories = {}
+    to_verify = set(uuids) if verify and not per_volume else set()
+    for service in sorted(uuids):
+        make_client, list_all, exists = SERVICES[service]
+        clients[service] = client = make_client(sess)
+        if per_volume:
+            inventories[service] = lookup_uuids(
+                partial(exists, client), uuids[service], jobs=jobs,
+                retries=retries, rate=rate)
+            continue
+        if cache is not None:
+            inventories[service] = cached_inventory(cache, service, ttl)
+        if inventories.get(service) is not None:
+            log.info("Using cached inventory of %s", service)
+            to_verify.add(service)
+        else:
+            inventories[service] = list_all(client, page=page,
+                                            retries=retries)
+            if cache is not None:
+                cache_inventory(cache, service, inventories[service])
+        log.info("Got information about %d %s resources",
+                 len(inventories[service]), service)
+    orphans = find_orphans(images, inventories)
+
+    if to_verify:
+        # The paginated listing is not atomic, and cached inventories
+        # may be stale: make sure the candidates really do not exist
+        # before reporting them.
+        existing = {}
+        for service in sorted(set(image.service for image in orphans)):
+            if service not in to_verify:
+                existing[service] = set()
+                continue
+            exists = SERVICES[service][2]
+            existing[service] = lookup_uuids(
+                partial(exists, clients[service]),
+                set(image.uuid for image in orphans
+                    if image.service == service),
+                jobs=jobs, retries=retries, rate=rate)
+        orphans = [image for image in orphans
+                   if image.uuid not in existing[image.service]]
+    return orphans
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        import fakeopenstack
+        self.cloud = fakeopenstack.FakeOpenStack(volumes=300, seed=1,
+                                                 max_limit=50)
+        self.opts = argparse.Namespace(
+            os_auth_url=self.cloud.start(), os_username='admin',
+            os_password='admin', os_project_name='admin',
+            os_user_domain_name='default', os_project_domain_name='default')
+
+    def tearDown(self):
+        self.cloud.stop()
+
+    def test_lookup_matches_listing(self):
+        cclient = cinder_client.Client('2', session=make_session(self.opts))
+        inventory = list_cinder_volumes(cclient, page=100)
+        self.assertEqual(inventory, set(self.cloud.volumes))
+
+        # one volume out of three has no cinder volume
+        uuids = list(self.cloud.volumes)[::2]
+        uuids += ['%08d-0000-0000-0000-000000000000' % i for i in range(50)]
+        sess = make_session(self.opts, pool_size=8)
+        cclient = cinder_client.Client('2', session=sess)
+        existing = lookup_cinder_volumes(cclient, uuids, jobs=8)
+        self.assertEqual(existing, inventory.intersection(uuids))
+        # connections are reused
+        self.assertTrue(self.cloud.connections <= 2 + 8)
+
+    def test_retries(self):
+        self.cloud.error_rate = 0.3
+        cclient = cinder_client.Client('2', session=make_session(self.opts))
+        uuids = list(self.cloud.volumes)[:40]
+        existing = lookup_cinder_volumes(cclient, uuids, jobs=4, retries=10,
+                                         backoff=0.01)
+        self.assertEqual(existing, set(uuids))
+        self.assertTrue(self.cloud.requests['volume'] > len(uuids))
+
+        self.cloud.error_rate = 1
+        self.assertRaises(cex.ClientException, lookup_cinder_volumes,
+                          cclient, uuids[:1], retries=1, backoff=0.01)
+
+    def test_reconcile(self):
+        import fakeceph
+        cluster = fakeceph.FakeCluster()
+        cluster.populate('cinder', 60, seed=1)
+        cluster.populate('nova', 60, deleted=0.2, seed=2)
+        cluster.create('nova', 'unrelated')
+        images = {}
+        for pool in ('cinder', 'nova'):
+            for name in cluster.pools[pool]:
+                info = classify(name)
+                if info:
+                    images[name] = (pool,) + info
+        self.assertEqual(set(kind for pool, kind, service, uuid
+                             in images.values()),
+                         set(['volume', 'instance', 'image']))
+
+        # every third resource was deleted from openstack
+        resources = dict((service, []) for service in SERVICES)
+        expected = []
+        for i, (name, (pool, kind, service, uuid)) in enumerate(
+                sorted(images.items())):
+            if i % 3:
+                resources[service].append(uuid)
+            else:
+                expected.append((pool, name))
+        self.cloud.resources['volume'].clear()
+        for service, key in (('cinder', 'volume'), ('nova', 'compute'),
+                             ('glance', 'image')):
+            self.cloud.resources[key].update(
+                (uuid, {'id': uuid, 'name': uuid})
+                for uuid in sorted(resources[service]))
+
+        sess = make_session(self.opts)
+        with cluster.patch(globals()):
+            connection = rados.Rados()
+            for per_volume in (False, True):
+                orphans = reconcile(connection, sess, ['cinder', 'nova'],
+                                    per_volume=per_volume, page=10)
+                self.assertEqual(
+                    sorted((image.pool, image.name) for image in orphans),
+                    sorted(expected))
+            orphans = reconcile(connection, sess, ['cinder', 'nova'],
+                                services=['cinder'])
+            self.assertTrue(orphans)
+            self.assertEqual(set(image.kind for image in orphans),
+                             set(['volume']))
+
+    def test_snapshot_of_deleted_instance(self):
+        import fakeceph
+        cluster = fakeceph.FakeCluster()
+        instance = str(uuidlib.uuid4())
+        disk = cluster.create('nova', instance + '_disk')
+        cluster.create_snap('nova', disk.name, 'snap', protected=True)
+        snapshot = '%s_disk_clone_%s' % (instance, uuidlib.uuid4().hex)
+        cluster.clone('nova', disk.name, 'snap', 'nova', snapshot)
+        # the instance was deleted, its snapshot is still a glance image
+        self.cloud.resources['compute'].clear()
+        self.cloud.resources['image'].clear()
+        sess = make_session(self.opts)
+        with cluster.patch(globals()):
+            for per_volume in (False, True):
+                orphans = reconcile(rados.Rados(), sess, ['nova'],
+                                    per_volume=per_volume)
+                self.assertEqual([image.name for image in orphans],
+                                 [disk.name])
+
+    def test_inventory_cache(self):
+        import fakeceph
+        import shutil
+        import tempfile
+        cluster = fakeceph.FakeCluster()
+        uuids = list(self.cloud.volumes)
+        for uuid in uuids[:20]:
+            cluster.create('cinder', 'volume-' + uuid)
+        tmpdir = tempfile.mkdtemp()
+        path = os.path.join(tmpdir, 'inventory')
+        sess = make_session(self.opts)
+
+        def run(ttl=3600):
+            cache = load_inventory_cache(path, self.opts.os_auth_url)
+            self.cloud.requests.clear()
+            orphans = reconcile(rados.Rados(), sess, ['cinder'],
+                                cache=cache, ttl=ttl, page=100)
+            save_inventory_cache(path, cache)
+            return sorted(image.name for image in orphans)
+
+        try:
+            with cluster.patch(globals()):
+                self.assertEqual(run(), [])
+                # 6 pages of 50 volumes, and an empty one
+                self.assertEqual(self.cloud.requests['volume'], 7)
+                self.assertEqual(
+                    load_inventory_cache(path, self.opts.os_auth_url)[
+                        'services']['cinder'][1],
+                    str.join('', sorted(uuidlib.UUID(uuid).bytes
+                                        for uuid in uuids)))
+                # no API request at all
+                self.assertEqual(run(), [])
+                self.assertEqual(self.cloud.requests['volume'], 0)
+
+                # orphans found on a cached inventory are checked again
+                del self.cloud.volumes[uuids[0]]
+                cluster.create('cinder', 'volume-' + uuids[20])
+                cluster.create('cinder',
+                               'volume-00000000-0000-0000-0000-000000000000')
+                self.assertEqual(
+                    run(), ['volume-00000000-0000-0000-0000-000000000000'])
+                self.assertEqual(self.cloud.requests['volume'], 1)
+
+                # expired
+                self.assertEqual(run(ttl=0), [
+                    'volume-00000000-0000-0000-0000-000000000000',
+                    'volume-' + uuids[0]])
+                self.assertTrue(self.cloud.requests['volume'] > 2)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(200)
+        start = time.time()
+        for i in range(21):
+            limiter.wait()
+        self.assertTrue(time.time() - start >= 0.1)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -108,9 +738,14 @@ if __name__ == "__main__":
                         action=EnvDefault,
                         envvar="OS_PROJECT_DOMAIN_NAME",
                         default='default')
-    parser.add_argument('-p', '--pool',
-                        default='cinder',
-                        help='Ceph pool to use. Default: %(default)s')
+    parser.add_argument('-p', '--pool', dest='pools', action='append',
+                        help='Ceph pool to check. Can be given multiple '
+                        'times. Default: cinder')
+    parser.add_argument('-s', '--service', dest='services', action='append',
+                        choices=sorted(SERVICES),
+                        help='Only check images owned by this OpenStack '
+                        'service. Can be given multiple times. '
+                        'Default: all services')
     parser.add_argument('-c', '--conf', metavar='FILE',
                         default='/etc/ceph/ceph.conf',
                         help='Ceph configuration file. '
@@ -120,32 +755,69 @@ if __name__ == "__main__":
                         help='Ceph user to use to connect. '
                         'Default: %(default)s')
 
+    parser.add_argument('--page-size', metavar='N', type=int,
+                        default=1000,
+                        help='Number of resources to fetch with each '
+                        'request. Default: %(default)s')
+    parser.add_argument('--no-verify', dest='verify', action='store_false',
+                        help='Do not check again, one by one, the resources '
+                        'missing from the inventories before reporting '
+                        'them.')
+    parser.add_argument('--per-volume', action='store_true',
+                        help='Look up every rbd image by UUID instead of '
+                        'listing the resources of all tenants.')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=8,
+                        help='Number of concurrent OpenStack requests. '
+                        'Default: %(default)s')
+    parser.add_argument('--max-rate', metavar='N', type=float, default=None,
+                        help='Send at most N OpenStack requests per second. '
+                        'Default: no limit.')
+    parser.add_argument('--retries', metavar='N', type=int, default=3,
+                        help='Retry OpenStack requests failing with transient '
+                        'errors up to N times. Default: %(default)s')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Save the inventories of the OpenStack '
+                        'services to FILE, and reuse them on the next runs. '
+                        'Not used with --per-volume.')
+    parser.add_argument('--cache-ttl', metavar='SECONDS', type=float,
+                        default=3600,
+                        help='Maximum age of the cached inventories. '
+                        'Default: %(default)s')
+    parser.add_argument('--refresh-cache', action='store_true',
+                        help='Ignore the cached inventories, fetch them '
+                        'again and update the cache.')
+    parser.add_argument('--run-tests', action='store_true', help='Run tests')
+
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='Increase verbosity')
-   
+
+    if '--run-tests' in sys.argv:
+        # tests do not need credentials
+        sys.argv = [sys.argv[0]]
+        unittest.main()
+        sys.exit(0)
+
     cfg = parser.parse_args()
     # Set verbosity
     verbosity = max(0, 3-cfg.verbose) * 10
     log.setLevel(verbosity)
 
-    ioctx = cluster_connect(cfg.pool, cfg.conf, cfg.user)
-    rbd_inst = rbd.RBD()
-    sess = make_session(cfg)
-    cclient = cinder_client.Client('2', session=sess)
-
-    volumenames = [vol for vol in rbd_inst.list(ioctx) if volume_re.match(vol)]
-    log.info("Got information about %d volumes", len(volumenames))
-    # Inizializza una lista
-    to_delete= []
-    for name in volumenames:
-        uuid = volume_re.search(name).group('uuid')
-        log.debug("Checking if cinder volume %s exists", uuid)
-        try:
-            cclient.volumes.get(uuid)
-            log.debug("Volume %s exists.", uuid)
-        except cex.NotFound:
-            log.debug("This %s rbd image should be deleted", uuid)
-            to_delete.append("rbd -p %s rm %s" % (cfg.pool, name))
+    cluster = cluster_connect(cfg.conf, cfg.user)
+    sess = make_session(cfg, pool_size=cfg.jobs)
+    cache = None
+    if cfg.cache:
+        cache = load_inventory_cache(cfg.cache, cfg.os_auth_url)
+        if cfg.refresh_cache:
+            cache['services'].clear()
+    orphans = reconcile(cluster, sess, cfg.pools or ['cinder'],
+                        services=cfg.services, per_volume=cfg.per_volume,
+                        verify=cfg.verify, page=cfg.page_size, jobs=cfg.jobs,
+                        retries=cfg.retries, rate=cfg.max_rate,
+                        cache=cache, ttl=cfg.cache_ttl)
+    if cache is not None:
+        save_inventory_cache(cfg.cache, cache)
+    to_delete = ["rbd -p %s rm %s" % (image.pool, image.name)
+                 for image in orphans]
 
     print "This is the list of commnads you should issue"
     print str.join('\n', to_delete) 
@@ -0,0 +1,1007 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2015, S3IT, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+"""
+Simulate the placement of the PGs of a pool on a crush map.
+
+This module is used by `make-crushmap.py` to show how the PGs of a
+pool would be spread over the OSDs by a rewritten map, before it is
+injected. `Simulator` compiles a map parsed by `make-crushmap.py` and
+follows the CRUSH mapper of Ceph (src/crush/mapper.c): rjenkins1
+hashes, straw, straw2 and uniform buckets, firstn and indep steps,
+the tunables of the map, device classes and choose_args weight sets.
+All the PGs of a pool go through each step at once, as numpy
+arrays::
+
+    sim = Simulator(m)
+    osds = sim.map_pgs('ssd', pg_num=4096, size=3, pool=1)
+    report(sim, 'ssd', osds, sys.stderr)
+
+All the OSDs are assumed to be up and in, with a reweight of 1.
+
+Like in Ceph, every item of each bucket a PG goes through is hashed,
+for each replica and retry, so the time depends on the width of the
+buckets more than on the number of OSDs: the 131072 PGs of a pool
+are placed in a few seconds on 1000 hosts in racks of 32 hosts, but
+take about a minute on a flat root of 1000 hosts, where each PG
+needs 3000 hashes.
+"""
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from decimal import Decimal, getcontext
+import imp
+import io
+import math
+import os
+import re
+import unittest
+
+import numpy as np
+
+import crushbin
+
+# CRUSH_ITEM_NONE, and the placeholder of not yet chosen indep items
+NONE = 0x7fffffff
+UNDEF = 0x7ffffffe
+
+STRAW, STRAW2, UNIFORM = 'straw', 'straw2', 'uniform'
+
+# items of several lanes are hashed together, up to this many at once
+CHUNK = 1 << 16
+
+_HASH_SEED = 1315423911
+
+
+def _mix(a, b, c, tmp):
+    # crush_hashmix(), in place
+    for x, y, z, shift in ((a, b, c, -13), (b, c, a, 8), (c, a, b, -13),
+                           (a, b, c, -12), (b, c, a, 16), (c, a, b, -5),
+                           (a, b, c, -3), (b, c, a, 10), (c, a, b, -15)):
+        x -= y
+        x -= z
+        if shift < 0:
+            np.right_shift(z, np.uint32(-shift), out=tmp)
+        else:
+            np.left_shift(z, np.uint32(shift), out=tmp)
+        x ^= tmp
+
+
+def _uint32(*args):
+    # flat copies, the mixes are done in place
+    return [np.array(arg, dtype=np.uint32).ravel() for arg in
+            np.broadcast_arrays(*[np.asarray(arg, np.int64) for arg in args])]
+
+
+def hash32_2(a, b):
+    """crush_hash32_rjenkins1_2() of the arrays `a` and `b`"""
+    shape = np.broadcast(a, b).shape
+    a, b = _uint32(a, b)
+    h = np.uint32(_HASH_SEED) ^ a ^ b
+    x = np.full(a.shape, 231232, np.uint32)
+    y = np.full(a.shape, 1232, np.uint32)
+    tmp = np.empty(a.shape, np.uint32)
+    _mix(a, b, h, tmp)
+    _mix(x, a, h, tmp)
+    _mix(b, y, h, tmp)
+    return h.reshape(shape)
+
+
+def hash32_3(a, b, c):
+    """crush_hash32_rjenkins1_3() of the arrays `a`, `b` and `c`"""
+    shape = np.broadcast(a, b, c).shape
+    a, b, c = _uint32(a, b, c)
+    h = np.uint32(_HASH_SEED) ^ a ^ b ^ c
+    x = np.full(a.shape, 231232, np.uint32)
+    y = np.full(a.shape, 1232, np.uint32)
+    tmp = np.empty(a.shape, np.uint32)
+    _mix(a, b, h, tmp)
+    _mix(c, x, h, tmp)
+    _mix(y, a, h, tmp)
+    _mix(b, x, h, tmp)
+    _mix(y, c, h, tmp)
+    return h.reshape(shape)
+
+
+def _ln_tables():
+    # the tables of src/crush/crush_ln_table.h
+    getcontext().prec = 50
+    log2 = Decimal(2).ln()
+    rh_lh, ll = [], []
+    for k in range(129):
+        rh_lh.append((2 ** 49 * 128 + 128 + k) // (2 * (128 + k)))
+        rh_lh.append(int((Decimal(2 ** 48) * (1 + Decimal(k) / 128).ln()
+                          / log2).to_integral_value()))
+    for k in range(256):
+        ll.append(int((Decimal(2 ** 48) * (1 + Decimal(k) / 2 ** 15).ln()
+                       / log2).to_integral_value()))
+    return rh_lh, ll
+
+
+def crush_ln(xin, tables=None):
+    """2^44 * log2(xin + 1), as computed by crush_ln()"""
+    rh_lh, ll = tables or _ln_tables()
+    x = xin + 1
+    iexpon = 15
+    if not x & 0x18000:
+        bits = 16 - (x & 0x1ffff).bit_length()
+        x <<= bits
+        iexpon = 15 - bits
+    index1 = (x >> 8) << 1
+    rh = rh_lh[index1 - 256]
+    lh = rh_lh[index1 + 1 - 256]
+    xl64 = ((x * rh) & 0xffffffffffffffff) >> 48
+    lh += ll[xl64 & 0xff]
+    return (iexpon << 44) + (lh >> 4)
+
+
+_LN = []
+
+
+def _ln():
+    # 2^48 - crush_ln(u) of every 16 bits hash `u`: minus the straw2
+    # draw before the division by the weight
+    if not _LN:
+        tables = _ln_tables()
+        _LN.append(np.array([0x1000000000000 - crush_ln(u, tables)
+                             for u in range(0x10000)], dtype=np.int64))
+    return _LN[0]
+
+
+class _Group(object):
+    """Buckets with the same algorithm and about the same size
+
+    The items of the buckets are the rows of padded matrices, so that
+    lanes in different buckets of a group can choose at the same time.
+    """
+
+    def __init__(self, alg, buckets, positions):
+        self.alg = alg
+        width = max(len(bucket['items']) for bucket in buckets) or 1
+        shape = (len(buckets), width)
+        self.items = np.zeros(shape, np.int64)
+        self.hash_ids = np.zeros(shape, np.int64)
+        self.weights = np.zeros((positions,) + shape, np.int64)
+        self.positions = np.ones(len(buckets), np.int64)
+        self.ids = np.array([bucket['id'] for bucket in buckets], np.int64)
+        self.sizes = np.array([len(b['items']) for b in buckets], np.int64)
+        for row, bucket in enumerate(buckets):
+            size = len(bucket['items'])
+            self.items[row, :size] = bucket['items']
+            if alg == STRAW:
+                self.weights[:, row, :size] = bucket['straws']
+            else:
+                self.weights[:, row, :size] = bucket['weights']
+            self.hash_ids[row, :size] = bucket['items']
+            args = bucket.get('choose_args', {})
+            if args.get('ids'):
+                self.hash_ids[row, :size] = args['ids']
+            if args.get('weight_set') and alg == STRAW2:
+                for pos, weights in enumerate(args['weight_set']):
+                    self.weights[pos, row, :size] = weights
+                self.positions[row] = len(args['weight_set'])
+        if alg == STRAW2:
+            # items without weight, padding included, are never chosen
+            self.unused = self.weights == 0
+            if not self.unused.any():
+                self.unused = None
+            self.weights = np.maximum(self.weights, 1)
+
+    def choose(self, rows, x, r, position):
+        """Items chosen by the lanes in the buckets at `rows`"""
+        if self.alg == UNIFORM:
+            return self.perm_choose(rows, x, r)
+        chosen = np.empty(len(rows), np.int64)
+        step = max(1, CHUNK // self.items.shape[1])
+        for start in range(0, len(rows), step):
+            part = slice(start, start + step)
+            chosen[part] = self._choose(rows[part], x[part], r[part],
+                                        position[part])
+        return chosen
+
+    def _choose(self, rows, x, r, position):
+        if self.alg == STRAW2:
+            u = hash32_3(x[:, None], self.hash_ids[rows], r[:, None])
+            pos = np.minimum(position, self.positions[rows] - 1)
+            # minus the draw: C divisions round towards zero, and the
+            # dividend is positive here
+            cost = _ln()[u & 0xffff] // self.weights[pos, rows]
+            if self.unused is not None:
+                cost[self.unused[pos, rows]] = np.iinfo(np.int64).max
+            # the first of the highest draws wins, as in the C code
+            best = cost.argmin(axis=1)
+        else:
+            u = hash32_3(x[:, None], self.items[rows], r[:, None])
+            draw = (u & 0xffff).astype(np.int64) * self.weights[0, rows]
+            best = draw.argmax(axis=1)
+        return self.items[rows, best]
+
+    def perm_choose(self, rows, x, r):
+        """Items chosen with bucket_perm_choose()"""
+        chosen = np.empty(len(rows), np.int64)
+        for row in np.unique(rows):
+            lanes = np.nonzero(rows == row)[0]
+            size = self.sizes[row]
+            pr = r[lanes] % size
+            perm = np.tile(np.arange(size), (len(lanes), 1))
+            for p in range(min(pr.max() + 1, size - 1)):
+                todo = np.nonzero(pr >= p)[0]
+                i = hash32_3(x[lanes[todo]], self.ids[row], p) % (size - p)
+                a, b = perm[todo, p], perm[todo, p + i]
+                perm[todo, p], perm[todo, p + i] = b, a
+            chosen[lanes] = self.items[row, perm[np.arange(len(lanes)), pr]]
+        return chosen
+
+
+class Simulator(object):
+    """CRUSH mapper for a `CrushMap` of `make-crushmap.py`
+
+    `choose_args` is the key of the weight sets of the map to use, if
+    any.
+    """
+
+    def __init__(self, m, choose_args=None):
+        self.tunables = dict(crushbin.LEGACY_TUNABLES)
+        for name, value in m.tunables.items():
+            self.tunables[name] = int(value)
+        self.type_ids = dict((name, id) for id, name in m.types.items())
+        self.device_ids = dict((name, id) for id, name in m.devices.items())
+        self.devices = dict(m.devices)
+        self.max_devices = max(m.devices) + 1 if m.devices else 0
+
+        # bucket id -> dict of name, type, alg, items, weights...
+        self.buckets = {}
+        self.bucket_ids = {}
+        ids = [b.id for b in m.buckets.values() if b.id is not None]
+        ids += [id for b in m.buckets.values() for cls, id in b.class_ids]
+        self._next_id = min(ids + [0]) - 1
+        for bucket in m.buckets.values():
+            self.bucket_ids[bucket.name] = (
+                bucket.id if bucket.id is not None else self._new_id())
+        for name in m.buckets:
+            self._compile(m, name)
+        for bucket in m.buckets.values():
+            for cls, id in bucket.class_ids:
+                self._shadow(m, bucket.name, cls)
+
+        self.rules = {}
+        for name, rule in m.rules.items():
+            steps = []
+            for step in rule['step']:
+                if step[0] == 'take':
+                    if len(step) > 2:
+                        id = self._shadow(m, step[1], step[3])
+                    elif step[1] in self.bucket_ids:
+                        id = self.bucket_ids[step[1]]
+                    else:
+                        id = self.device_ids[step[1]]
+                    steps.append(('take', id))
+                elif step[0] in ('choose', 'chooseleaf'):
+                    steps.append((step[0], step[1], int(step[2]),
+                                  self.type_ids[step[4]]))
+                elif step[0] == 'emit':
+                    steps.append(('emit',))
+                else:
+                    steps.append((step[0], int(step[1])))
+            self.rules[name] = steps
+
+        if choose_args is not None:
+            for args in m.choose_args[choose_args]:
+                bucket = self.buckets[args['bucket_id']]
+                bucket['choose_args'] = dict(
+                    ids=args.get('ids'),
+                    weight_set=[[crushbin.fixed_weight(wt) for wt in weights]
+                                for weights in args.get('weight_set', [])])
+        self._index()
+
+    def _new_id(self):
+        id = self._next_id
+        self._next_id -= 1
+        return id
+
+    def _compile(self, m, name):
+        id = self.bucket_ids[name]
+        if id in self.buckets:
+            return self.buckets[id]
+        source = m.buckets[name]
+        if source.hash != '0':
+            raise ValueError("bucket %s: hash %s is not supported"
+                             % (name, source.hash))
+        if source.alg not in (STRAW, STRAW2, UNIFORM):
+            raise ValueError("bucket %s: %s buckets are not supported"
+                             % (name, source.alg))
+        items, weights = [], []
+        for item, weight in source.items.items():
+            if item in m.buckets:
+                child = self._compile(m, item)
+                items.append(child['id'])
+                default = child['weight']
+            else:
+                items.append(self.device_ids[item])
+                default = 0x10000
+            weights.append(default if weight is None
+                           else crushbin.fixed_weight(weight))
+        return self._add_bucket(id, name, self.type_ids[source.type],
+                                source.alg, items, weights)
+
+    def _add_bucket(self, id, name, type, alg, items, weights):
+        bucket = self.buckets[id] = dict(
+            id=id, name=name, type=type, alg=alg, items=items,
+            weights=weights, weight=sum(weights))
+        if alg == STRAW:
+            bucket['straws'] = crushbin.calc_straws(
+                weights, self.tunables['straw_calc_version'])
+        return bucket
+
+    def _shadow(self, m, name, cls):
+        """Id of the shadow bucket of `name` for the devices of class `cls`"""
+        key = '%s~%s' % (name, cls)
+        if key in self.bucket_ids:
+            return self.bucket_ids[key]
+        source = m.buckets[name]
+        id = dict(source.class_ids).get(cls)
+        self.bucket_ids[key] = id if id is not None else self._new_id()
+        original = self.buckets[self.bucket_ids[name]]
+        items, weights = [], []
+        for item, weight in zip(original['items'], original['weights']):
+            if item >= 0:
+                if m.classes.get(self.devices[item]) != cls:
+                    continue
+            else:
+                child = self.buckets[self._shadow(
+                    m, self.buckets[item]['name'], cls)]
+                item, weight = child['id'], child['weight']
+            items.append(item)
+            weights.append(weight)
+        self._add_bucket(self.bucket_ids[key], key, original['type'],
+                         original['alg'], items, weights)
+        return self.bucket_ids[key]
+
+    def _index(self):
+        # per bucket arrays, indexed by -1-id, and groups of buckets
+        count = -min(self.buckets) if self.buckets else 0
+        self._type = np.full(count, -1, np.int64)
+        self._size = np.zeros(count, np.int64)
+        self._alg = np.zeros(count, np.int64)
+        self._group = np.full(count, -1, np.int64)
+        self._row = np.zeros(count, np.int64)
+        grouped = {}
+        for id, bucket in self.buckets.items():
+            size = len(bucket['items'])
+            self._type[-1 - id] = bucket['type']
+            self._size[-1 - id] = size
+            self._alg[-1 - id] = bucket['alg'] == UNIFORM
+            if bucket['alg'] == UNIFORM:
+                # each one has its own permutations
+                key = (UNIFORM, id)
+            else:
+                # every item of the group is hashed, padding included:
+                # keep it below 1/8 of the width
+                quantum = 1 << max(0, size.bit_length() - 4)
+                key = (bucket['alg'], -(-size // quantum) * quantum)
+            grouped.setdefault(key, []).append(bucket)
+        self._groups = []
+        for (alg, _), buckets in sorted(grouped.items()):
+            positions = max(
+                len(b.get('choose_args', {}).get('weight_set') or [0])
+                for b in buckets)
+            for row, bucket in enumerate(buckets):
+                self._group[-1 - bucket['id']] = len(self._groups)
+                self._row[-1 - bucket['id']] = row
+            self._groups.append(_Group(alg, buckets, positions))
+        # single bucket groups for bucket_perm_choose(), made when needed
+        self._perm = {}
+
+    def _is_bucket(self, items):
+        index = np.clip(-1 - items, 0, len(self._type) - 1)
+        return (items < 0) & (-1 - items < len(self._type)) & (
+            self._type[index] >= 0)
+
+    def _type_of(self, items):
+        types = np.zeros(len(items), np.int64)
+        buckets = items < 0
+        types[buckets] = self._type[-1 - items[buckets]]
+        return types
+
+    def _choose(self, cur, x, r, position, fallback=None):
+        """crush_bucket_choose() of each lane in the bucket `cur`"""
+        b = -1 - cur
+        chosen = np.empty(len(cur), np.int64)
+        group = self._group[b].copy()
+        if fallback is not None:
+            group[fallback] = -1
+        for g in np.unique(group):
+            lanes = np.nonzero(group == g)[0]
+            if g >= 0:
+                chosen[lanes] = self._groups[g].choose(
+                    self._row[b[lanes]], x[lanes], r[lanes], position[lanes])
+                continue
+            # bucket_perm_choose() of the local fallback retries
+            for id in np.unique(cur[lanes]):
+                some = lanes[cur[lanes] == id]
+                if id not in self._perm:
+                    self._perm[id] = _Group(UNIFORM, [self.buckets[id]], 1)
+                chosen[some] = self._perm[id].perm_choose(
+                    np.zeros(len(some), np.int64), x[some], r[some])
+        return chosen
+
+    def _firstn_rep(self, x, start, r0, outpos, type, tries, recurse_tries,
+                    leaf, out, out2, opts):
+        """One replica of crush_choose_firstn() for each lane
+
+        Returns the chosen items and leaves, NONE where nothing was
+        chosen. `r0` is rep + parent_r, `out` and `out2` are the items
+        and the leaves already chosen (NONE padded).
+        """
+        n = len(x)
+        item = np.full(n, NONE, np.int64)
+        leaves = np.full(n, NONE, np.int64)
+        ftotal = np.zeros(n, np.int64)
+        flocal = np.zeros(n, np.int64)
+        start = np.asarray(start, np.int64)
+        r0 = np.broadcast_to(np.asarray(r0, np.int64), (n,))
+        cur = start.copy()
+        pending = np.arange(n)
+        local_tries = opts['choose_local_tries']
+        fallback_tries = opts['choose_local_fallback_tries']
+        while len(pending):
+            lcur = cur[pending]
+            r = r0[pending] + ftotal[pending]
+            size = self._size[-1 - lcur]
+            fallback = None
+            if fallback_tries > 0:
+                fallback = ((flocal[pending] >= size >> 1) &
+                            (flocal[pending] > fallback_tries))
+            empty = size == 0
+            chosen = np.full(len(pending), NONE, np.int64)
+            some = np.nonzero(~empty)[0]
+            chosen[some] = self._choose(
+                lcur[some], x[pending[some]], r[some],
+                outpos[pending[some]],
+                None if fallback is None else fallback[some])
+            itype = self._type_of(np.where(empty, 0, chosen))
+            found = ~empty & (itype == type)
+            deeper = ~empty & (itype != type) & self._is_bucket(chosen)
+            cur[pending[deeper]] = chosen[deeper]
+            collide = found & (out[pending] == chosen[:, None]).any(axis=1)
+            reject = empty.copy()
+            if leaf:
+                inner = np.nonzero(found & ~collide & (chosen < 0))[0]
+                if len(inner):
+                    lanes = pending[inner]
+                    vary_r = opts['chooseleaf_vary_r']
+                    sub_r = r[inner] >> (vary_r - 1) if vary_r else 0
+                    base = 0 if opts['chooseleaf_stable'] else outpos[lanes]
+                    got, _ = self._firstn_rep(
+                        x[lanes], chosen[inner], base + sub_r, outpos[lanes],
+                        0, recurse_tries, 0, False, out2[lanes], None, opts)
+                    reject[inner] = got == NONE
+                    leaves[lanes] = got
+                direct = found & ~collide & (chosen >= 0)
+                leaves[pending[direct]] = chosen[direct]
+            done = found & ~collide & ~reject
+            item[pending[done]] = chosen[done]
+            failed = reject | collide
+            ftotal[pending[failed]] += 1
+            flocal[pending[failed]] += 1
+            lf = flocal[pending]
+            retry_bucket = failed & (
+                (collide & (lf <= local_tries)) |
+                ((fallback_tries > 0) & (lf <= size + fallback_tries)))
+            retry_descent = (failed & ~retry_bucket &
+                             (ftotal[pending] < tries))
+            again = pending[retry_descent]
+            cur[again] = start[again]
+            flocal[again] = 0
+            pending = pending[deeper | retry_bucket | retry_descent]
+        return item, leaves
+
+    def _firstn(self, x, start, numrep, type, out_size, leaf, tries,
+                recurse_tries, opts):
+        n = len(x)
+        out = np.full((n, numrep), NONE, np.int64)
+        out2 = np.full((n, numrep), NONE, np.int64)
+        outpos = np.zeros(n, np.int64)
+        for rep in range(numrep):
+            lanes = np.nonzero(outpos < out_size)[0]
+            if not len(lanes):
+                break
+            item, leaves = self._firstn_rep(
+                x[lanes], start[lanes], np.full(len(lanes), rep, np.int64),
+                outpos[lanes], type, tries, recurse_tries, leaf,
+                out[lanes], out2[lanes], opts)
+            ok = item != NONE
+            lanes = lanes[ok]
+            out[lanes, outpos[lanes]] = item[ok]
+            out2[lanes, outpos[lanes]] = leaves[ok]
+            outpos[lanes] += 1
+        return out, out2, outpos
+
+    def _indep_descend(self, x, start, rep, parent_r, ftotal, numrep, type,
+                       position, out):
+        """Descent of crush_choose_indep() for each lane
+
+        Returns the chosen items, NONE if the lane must give up and
+        UNDEF if it can try again, and the r they were chosen with.
+        """
+        n = len(x)
+        item = np.full(n, UNDEF, np.int64)
+        last_r = np.zeros(n, np.int64)
+        cur = np.array(start, np.int64)
+        pending = np.arange(n)
+        while len(pending):
+            lcur = cur[pending]
+            size = self._size[-1 - lcur]
+            uniform = (self._alg[-1 - lcur] == 1) & (size % numrep == 0)
+            r = (rep[pending] + parent_r[pending] +
+                 np.where(uniform, numrep + 1, numrep) * ftotal)
+            some = np.nonzero(size > 0)[0]
+            pending = pending[some]
+            chosen = self._choose(lcur[some], x[pending], r[some],
+                                  position[pending])
+            last_r[pending] = r[some]
+            itype = self._type_of(chosen)
+            deeper = (itype != type) & self._is_bucket(chosen)
+            cur[pending[deeper]] = chosen[deeper]
+            bad = (itype != type) & ~deeper
+            item[pending[bad]] = NONE
+            found = (itype == type) & ~(
+                out[pending] == chosen[:, None]).any(axis=1)
+            item[pending[found]] = chosen[found]
+            pending = pending[deeper]
+        return item, last_r
+
+    def _indep(self, x, start, left, numrep, type, leaf, tries,
+               recurse_tries, opts):
+        n = len(x)
+        out = np.full((n, numrep), UNDEF, np.int64)
+        out2 = np.full((n, numrep), UNDEF, np.int64)
+        for rep in range(numrep):
+            out[left <= rep, rep] = NONE
+        zeros = np.zeros(n, np.int64)
+        for ftotal in range(tries):
+            for rep in range(numrep):
+                lanes = np.nonzero(out[:, rep] == UNDEF)[0]
+                if not len(lanes):
+                    continue
+                reps = np.full(len(lanes), rep, np.int64)
+                item, r = self._indep_descend(
+                    x[lanes], start[lanes], reps, zeros[lanes], ftotal,
+                    numrep, type, zeros[lanes], out[lanes])
+                out2[lanes[item == NONE], rep] = NONE
+                if leaf:
+                    inner = np.nonzero((item != NONE) & (item != UNDEF) &
+                                       (item < 0))[0]
+                    direct = (item != UNDEF) & (item >= 0) & (item != NONE)
+                    out2[lanes[direct], rep] = item[direct]
+                    got = self._indep_leaf(
+                        x[lanes[inner]], item[inner], reps[inner], r[inner],
+                        numrep, recurse_tries)
+                    # no leaf: try again, unless out of tries
+                    item[inner[got == NONE]] = UNDEF
+                    out2[lanes[inner], rep] = got
+                done = item != UNDEF
+                out[lanes[done], rep] = item[done]
+        out[out == UNDEF] = NONE
+        out2[out2 == UNDEF] = NONE
+        return out, out2
+
+    def _indep_leaf(self, x, start, rep, parent_r, numrep, tries):
+        # nested crush_choose_indep() for a single leaf, with the r
+        # `start` was chosen with as parent r
+        n = len(x)
+        leaves = np.full(n, UNDEF, np.int64)
+        empty = np.full((n, 1), UNDEF, np.int64)
+        for ftotal in range(tries):
+            lanes = np.nonzero(leaves == UNDEF)[0]
+            if not len(lanes):
+                break
+            leaves[lanes], _ = self._indep_descend(
+                x[lanes], start[lanes], rep[lanes], parent_r[lanes],
+                ftotal, numrep, 0, rep[lanes], empty[lanes])
+        leaves[leaves == UNDEF] = NONE
+        return leaves
+
+    def do_rule(self, rule, x, result_max):
+        """Items chosen by `rule` for each input of `x`, see crush_do_rule()
+
+        Returns a matrix of `result_max` columns, with NONE where no
+        item was chosen.
+        """
+        x = np.asarray(x, np.int64)
+        n = len(x)
+        opts = dict(self.tunables)
+        choose_tries = opts['choose_total_tries'] + 1
+        leaf_tries = 0
+        result = np.full((n, result_max), NONE, np.int64)
+        size = np.zeros(n, np.int64)
+        w = np.zeros((n, 0), np.int64)
+        wsize = np.zeros(n, np.int64)
+        for step in self.rules[rule]:
+            op = step[0]
+            if op == 'take':
+                w = np.full((n, 1), step[1], np.int64)
+                wsize = np.ones(n, np.int64)
+            elif op == 'set_choose_tries':
+                if step[1] > 0:
+                    choose_tries = step[1]
+            elif op == 'set_chooseleaf_tries':
+                if step[1] > 0:
+                    leaf_tries = step[1]
+            elif op in ('set_choose_local_tries',
+                        'set_choose_local_fallback_tries',
+                        'set_chooseleaf_vary_r', 'set_chooseleaf_stable'):
+                if step[1] >= 0:
+                    opts[op[4:]] = step[1]
+            elif op == 'emit':
+                for i in range(w.shape[1]):
+                    lanes = np.nonzero((i < wsize) & (size < result_max))[0]
+                    result[lanes, size[lanes]] = w[lanes, i]
+                    size[lanes] += 1
+                wsize[:] = 0
+            elif op in ('choose', 'chooseleaf'):
+                w, wsize = self._choose_step(
+                    step, x, w, wsize, result_max, choose_tries, leaf_tries,
+                    opts)
+            else:
+                raise ValueError("rule %s: step %s is not supported"
+                                 % (rule, op))
+        return result
+
+    def _choose_step(self, step, x, w, wsize, result_max, choose_tries,
+                     leaf_tries, opts):
+        op, mode, numrep, type = step
+        leaf = op == 'chooseleaf'
+        n = len(x)
+        o = np.full((n, result_max), NONE, np.int64)
+        c = np.full((n, result_max), NONE, np.int64)
+        osize = np.zeros(n, np.int64)
+        if numrep <= 0:
+            numrep += result_max
+            if numrep <= 0:
+                return o, osize
+        for i in range(w.shape[1]):
+            lanes = np.nonzero((i < wsize) & self._is_bucket(w[:, i]))[0]
+            if not len(lanes):
+                continue
+            lx, start = x[lanes], w[lanes, i]
+            if mode == 'firstn':
+                if leaf_tries:
+                    recurse_tries = leaf_tries
+                elif opts['chooseleaf_descend_once']:
+                    recurse_tries = 1
+                else:
+                    recurse_tries = choose_tries
+                out, out2, count = self._firstn(
+                    lx, start, numrep, type, result_max - osize[lanes], leaf,
+                    choose_tries, recurse_tries, opts)
+            else:
+                count = np.minimum(numrep, result_max - osize[lanes])
+                out, out2 = self._indep(
+                    lx, start, count, numrep, type, leaf, choose_tries,
+                    leaf_tries or 1, opts)
+            rows, cols = np.nonzero(np.arange(numrep) < count[:, None])
+            dest = osize[lanes[rows]] + cols
+            o[lanes[rows], dest] = out[rows, cols]
+            c[lanes[rows], dest] = out2[rows, cols]
+            osize[lanes] += count
+        return (c if leaf else o), osize
+
+    def map_pgs(self, rule, pg_num, size, pool=0):
+        """OSDs of the PGs 0..pg_num-1 of a pool, one row per PG"""
+        return self.do_rule(rule, pg_seeds(pg_num, pool), size)
+
+    def device_weights(self, rule):
+        """16.16 weights of the devices reachable by `rule`"""
+        weights = {}
+        for step in self.rules[rule]:
+            if step[0] != 'take':
+                continue
+            stack = [(step[1], 0x10000)]
+            while stack:
+                id, weight = stack.pop()
+                if id >= 0:
+                    weights[id] = weight
+                    continue
+                bucket = self.buckets[id]
+                stack.extend(zip(bucket['items'], bucket['weights']))
+        return weights
+
+
+def pg_seeds(pg_num, pool):
+    """Inputs of CRUSH for the PGs of a pool with the hashpspool flag"""
+    return hash32_2(np.arange(pg_num), pool).astype(np.int64)
+
+
+def report(sim, rule, osds, stream):
+    """Write the number of PGs of each OSD in `osds` to `stream`
+
+    `osds` is the result of `Simulator.map_pgs`. Each OSD is expected
+    to get a share of the PGs proportional to its crush weight among
+    the OSDs reachable by the rule; the deviation from that share is
+    what its utilization will be above or below the average.
+    """
+    weights = sim.device_weights(rule)
+    mapped = osds[(osds >= 0) & (osds != NONE)]
+    counts = np.bincount(mapped, minlength=sim.max_devices)
+    total = float(sum(weights.values()))
+    stream.write("rule %s: %d PGs x %d, %d mapped, %d missing, on %d OSDs\n"
+                 % (rule, osds.shape[0], osds.shape[1], len(mapped),
+                    osds.size - len(mapped), len(weights)))
+    stream.write("%8s %-16s %8s %8s %10s %9s\n" % (
+        'id', 'name', 'weight', 'pgs', 'expected', 'deviation'))
+    deviations = []
+    for id in sorted(set(weights) | set(np.nonzero(counts)[0])):
+        expected = len(mapped) * weights.get(id, 0) / total if total else 0
+        deviation = (counts[id] / expected - 1) * 100 if expected else 0
+        if expected:
+            deviations.append((deviation, id))
+        stream.write("%8d %-16s %8.3f %8d %10.1f %+8.1f%%\n" % (
+            id, sim.devices.get(id, '?'), weights.get(id, 0) / 65536.0,
+            counts[id], expected, deviation))
+    if deviations:
+        stream.write(
+            "max %+.1f%% (%s), min %+.1f%% (%s), stddev %.1f%%\n" % (
+                max(deviations)[0], sim.devices[max(deviations)[1]],
+                min(deviations)[0], sim.devices[min(deviations)[1]],
+                np.std([d for d, id in deviations])))
+
+
+TEST_MAP = """\
+tunable choose_local_tries 0
+tunable choose_local_fallback_tries 0
+tunable choose_total_tries 50
+tunable chooseleaf_descend_once 1
+tunable chooseleaf_vary_r 1
+tunable chooseleaf_stable 1
+tunable straw_calc_version 1
+tunable allowed_bucket_algs 54
+
+device 0 osd.0 class hdd
+device 1 osd.1 class hdd
+device 2 osd.2 class ssd
+device 3 osd.3 class hdd
+device 4 osd.4 class hdd
+device 5 osd.5 class ssd
+device 6 osd.6 class hdd
+device 7 osd.7 class hdd
+device 8 osd.8 class hdd
+device 9 osd.9 class hdd
+device 10 osd.10 class ssd
+device 11 osd.11 class hdd
+device 12 osd.12 class hdd
+device 13 osd.13 class ssd
+
+type 0 osd
+type 1 host
+type 3 rack
+type 11 root
+
+host node1 {
+	id -2
+	alg straw2
+	hash 0
+	item osd.0 weight 1.819
+	item osd.1 weight 1.819
+	item osd.2 weight 0.873
+}
+host node2 {
+	id -3
+	alg straw2
+	hash 0
+	item osd.3 weight 3.638
+	item osd.4 weight 3.638
+	item osd.5 weight 0.436
+}
+host node3 {
+	id -4
+	alg straw
+	hash 0
+	item osd.6 weight 1.819
+	item osd.7 weight 3.638
+	item osd.8 weight 1.819
+}
+host node4 {
+	id -5
+	alg uniform
+	hash 0
+	item osd.9 weight 1.000
+	item osd.10 weight 1.000
+	item osd.11 weight 1.000
+}
+host node5 {
+	id -6
+	alg straw2
+	hash 0
+	item osd.12 weight 5.458
+	item osd.13 weight 0.000
+}
+rack rack1 {
+	id -7
+	alg straw2
+	hash 0
+	item node1 weight 4.511
+	item node2 weight 7.712
+}
+rack rack2 {
+	id -8
+	alg straw2
+	hash 0
+	item node3 weight 7.276
+	item node4 weight 3.000
+	item node5 weight 5.458
+}
+root default {
+	id -1
+	alg straw2
+	hash 0
+	item rack1 weight 12.223
+	item rack2 weight 15.734
+}
+
+rule replicated_rule {
+	id 0
+	type replicated
+	min_size 1
+	max_size 10
+	step take default
+	step chooseleaf firstn 0 type host
+	step emit
+}
+rule ssd {
+	id 1
+	type replicated
+	min_size 1
+	max_size 10
+	step take default class ssd
+	step chooseleaf firstn 0 type host
+	step emit
+}
+rule ec {
+	id 2
+	type erasure
+	min_size 3
+	max_size 6
+	step set_chooseleaf_tries 5
+	step set_choose_tries 100
+	step take default class hdd
+	step choose indep 2 type rack
+	step chooseleaf indep 2 type host
+	step emit
+}
+"""
+
+# mappings of x 0-7 with 4 replicas, in the format of
+# `crushtool --test --show-mappings`; they were computed by a scalar,
+# item by item port of src/crush/mapper.c, not by crushtool, which was
+# not at hand: a check against crushtool itself is still to be done
+TEST_MAPPINGS = """\
+CRUSH rule 0 x 0 [3,6,11,12]
+CRUSH rule 0 x 1 [4,10,12,0]
+CRUSH rule 0 x 2 [7,1,4,12]
+CRUSH rule 0 x 3 [7,4,9,1]
+CRUSH rule 0 x 4 [12,9,1,5]
+CRUSH rule 0 x 5 [7,4,0,11]
+CRUSH rule 0 x 6 [3,12,8,10]
+CRUSH rule 0 x 7 [12,2,10,8]
+CRUSH rule 1 x 0 [10,2,5]
+CRUSH rule 1 x 1 [2,10,5]
+CRUSH rule 1 x 2 [5,2,10]
+CRUSH rule 1 x 3 [5,10,2]
+CRUSH rule 1 x 4 [5,2,10]
+CRUSH rule 1 x 5 [2,10,5]
+CRUSH rule 1 x 6 [2,10,5]
+CRUSH rule 1 x 7 [2,10,5]
+CRUSH rule 2 x 0 [7,12,3,0]
+CRUSH rule 2 x 1 [0,4,12,7]
+CRUSH rule 2 x 2 [12,7,4,0]
+CRUSH rule 2 x 3 [7,9,4,0]
+CRUSH rule 2 x 4 [12,7,1,3]
+CRUSH rule 2 x 5 [0,4,12,8]
+CRUSH rule 2 x 6 [6,12,1,4]
+CRUSH rule 2 x 7 [3,1,12,11]
+"""
+
+
+def _rjenkins(*args):
+    # crush_hash32_rjenkins1_2() and _3(), as written in src/crush/hash.c
+    def mix(a, b, c):
+        for shift in (13, -8, 13, 12, -16, 5, 3, -10, 15):
+            a = (a - b - c) & 0xffffffff
+            a ^= (c >> shift) if shift > 0 else (c << -shift) & 0xffffffff
+            a, b, c = b, c, a
+        return a, b, c
+    a, b, c = [arg & 0xffffffff for arg in args + (0,) * (3 - len(args))]
+    h = _HASH_SEED ^ a ^ b ^ c
+    x, y = 231232, 1232
+    if len(args) == 2:
+        a, b, h = mix(a, b, h)
+        x, a, h = mix(x, a, h)
+        b, y, h = mix(b, y, h)
+    else:
+        a, b, h = mix(a, b, h)
+        c, x, h = mix(c, x, h)
+        y, a, h = mix(y, a, h)
+        b, x, h = mix(b, x, h)
+        y, c, h = mix(y, c, h)
+    return h
+
+
+class TestCase(unittest.TestCase):
+    def test_hash(self):
+        self.assertEqual(hash32_2(0, 0), 430787817)
+        self.assertEqual(hash32_2(1234, -1), 3921499636)
+        self.assertEqual(hash32_3(0, 0, 0), 2050749362)
+        self.assertEqual(hash32_3(1, 2, 3), 1935332395)
+        self.assertEqual(hash32_3(4000000000, -1, 7), 1909171855)
+        # arrays, broadcast like the lanes and items of a bucket
+        x = np.array([0, 1, 7, 2 ** 31 - 1, 2 ** 32 - 1, -3])
+        ids = np.array([-1, -100, 0, 5, 2 ** 31])
+        self.assertEqual(hash32_2(x, 42).tolist(),
+                         [_rjenkins(int(i), 42) for i in x])
+        self.assertEqual(
+            hash32_3(x[:, None], ids, 3).tolist(),
+            [[_rjenkins(int(i), int(j), 3) for j in ids] for i in x])
+        self.assertEqual(pg_seeds(2, 1).tolist(),
+                         [_rjenkins(0, 1), _rjenkins(1, 1)])
+
+    def test_ln_tables(self):
+        # the first and last entries of src/crush/crush_ln_table.h
+        rh_lh, ll = _ln_tables()
+        self.assertEqual(rh_lh[:6], [
+            0x0001000000000000, 0x0000000000000000, 0x0000fe03f80fe040,
+            0x000002dfca16dde1, 0x0000fc0fc0fc0fc1, 0x000005b9e5a170b5])
+        self.assertEqual(rh_lh[-2:], [0x0000800000000000, 0x0001000000000000])
+        self.assertEqual(ll[:2], [0x0000000000000000, 0x00000002e2a60a00])
+
+    def test_crush_ln(self):
+        tables = _ln_tables()
+        # exact at powers of 2, so the straw2 draw of 0xffff is 0
+        for k in range(17):
+            self.assertEqual(crush_ln(2 ** k - 1, tables), k << 44)
+        self.assertEqual(_ln()[0xffff], 0)
+        # elsewhere within one step of the table of the mantissas
+        for u in range(0, 0x10000, 7):
+            self.assertLess(abs(crush_ln(u, tables) / float(1 << 44) -
+                                math.log(u + 1, 2)), math.log(129 / 128.0, 2))
+
+    def test_mappings(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'make-crushmap.py')
+        m = imp.load_source('make_crushmap', path).CrushMap()
+        m.parse(io.BytesIO(TEST_MAP))
+        sim = Simulator(m)
+        rules = dict((int(rule['id']), name) for name, rule in m.rules.items())
+        expected = {}
+        for line in TEST_MAPPINGS.splitlines():
+            rule, x, osds = re.match(
+                r'CRUSH rule (\d+) x (\d+) \[([\d,]*)\]', line).groups()
+            expected.setdefault(rules[int(rule)], {})[int(x)] = [
+                int(osd) for osd in osds.split(',')]
+        for rule, mappings in expected.items():
+            x = sorted(mappings)
+            got = sim.do_rule(rule, x, 4)
+            self.assertEqual(
+                [[osd for osd in row if osd != NONE] for row in got.tolist()],
+                [mappings[i] for i in x])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,589 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2015, S3IT, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+"""
+In-process stand-in for the `rados` and `rbd` python modules.
+
+It implements the subset of the librados/librbd API used by the tools
+in this repository, on top of an in-memory `FakeCluster` which can be
+populated with pools of synthetic images. Every API call is counted,
+and can optionally be delayed by a fixed latency to mimic the round
+trip to a real cluster.
+
+Typical usage, to run one of the tools without a cluster::
+
+    import fakeceph
+    cluster = fakeceph.FakeCluster(latency=0.001)
+    cluster.populate('cinder', images=10000, depth=3, fanout=2)
+    cluster.install()   # registers this module as `rados` and `rbd`
+
+    tool = imp.load_source('tool', 'cleanup-deleted-os-images.py')
+    ...
+    print(cluster.calls)
+
+`FakeCluster.patch` can be used instead of `install` when the tool
+module has already been imported.
+"""
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+import bisect
+import functools
+import random
+import struct
+import sys
+import threading
+import time
+
+
+# The cluster used by `Rados` objects. Set by `FakeCluster.install`
+# and `FakeCluster.patch`.
+_current = None
+
+DELETE_SUFFIX = '_to_be_deleted_by_glance'
+
+RBD_FEATURE_LAYERING = 1
+
+
+class Error(Exception):
+    pass
+
+
+class ObjectNotFound(Error):
+    pass
+
+
+class ImageNotFound(Error):
+    pass
+
+
+class ImageExists(Error):
+    pass
+
+
+class ImageBusy(Error):
+    pass
+
+
+class ImageHasSnapshots(Error):
+    pass
+
+
+class InvalidArgument(Error):
+    pass
+
+
+class ReadOnlyImage(Error):
+    pass
+
+
+def _api(name):
+    """Count calls to the decorated method, and delay them"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if getattr(self, '_closed', False):
+                # like python-rbd
+                raise InvalidArgument("RBD image is closed")
+            self._cluster.called(name)
+            return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _ImageState(object):
+    __slots__ = ('name', 'id', 'size', 'snaps', 'parent', 'children',
+                 'mtime')
+
+    def __init__(self, name, id, size, parent=None):
+        self.name = name
+        self.id = id
+        self.size = size
+        # snapshot name -> {'id', 'size', 'protected'}
+        self.snaps = OrderedDict()
+        # (pool, image, snapshot) or None
+        self.parent = parent
+        # snapshot name -> list of (pool, image)
+        self.children = {}
+        self.mtime = 0
+
+
+class FakeCluster(object):
+    """In-memory pools of rbd images
+
+    `latency` is the time, in seconds, each API call takes. Calls made
+    from different threads are delayed concurrently, as they would on
+    a real cluster.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.pools = {}
+        # (pool, image id) -> image
+        self.ids = {}
+        self.pool_ids = {}
+        self.calls = Counter()
+        # currently open rbd.Image handles, and their maximum
+        self.open_images = 0
+        self.peak_open_images = 0
+        self._lock = threading.Lock()
+        self._next_id = 0
+        # incremented at every change, to invalidate cached omaps
+        self._version = 0
+        self._omaps = {}
+
+    def called(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _touch(self, image):
+        with self._lock:
+            image.mtime = time.time()
+            self._version += 1
+
+    def _changed(self):
+        with self._lock:
+            self._version += 1
+
+    def pool(self, pool):
+        if pool not in self.pools:
+            self.pools[pool] = OrderedDict()
+            self.pool_ids[pool] = len(self.pool_ids) + 1
+        return self.pools[pool]
+
+    def image(self, pool, name):
+        try:
+            return self.pools[pool][name]
+        except KeyError:
+            raise ImageNotFound("%s/%s" % (pool, name))
+
+    def create(self, pool, name, size=2**30, parent=None):
+        images = self.pool(pool)
+        if name in images:
+            raise ImageExists("%s/%s" % (pool, name))
+        image_id = '%012x' % self._new_id()
+        image = images[name] = _ImageState(name, image_id, size, parent)
+        self.ids[pool, image_id] = image
+        if parent is not None:
+            parentpool, parentname, snapname = parent
+            self.image(parentpool, parentname).children[snapname].append(
+                (pool, name))
+        self._touch(image)
+        return image
+
+    def _new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def create_snap(self, pool, name, snapname, protected=False):
+        image = self.image(pool, name)
+        image.snaps[snapname] = {'id': self._new_id(),
+                                 'size': image.size,
+                                 'protected': protected}
+        image.children[snapname] = []
+        self._touch(image)
+
+    def clone(self, pool, name, snapname, clone_pool, clone_name):
+        if not self.image(pool, name).snaps[snapname]['protected']:
+            raise InvalidArgument("%s/%s@%s is not protected"
+                                  % (pool, name, snapname))
+        size = self.image(pool, name).snaps[snapname]['size']
+        return self.create(clone_pool, clone_name, size,
+                           parent=(pool, name, snapname))
+
+    def rename(self, pool, src, dst):
+        images = self.pool(pool)
+        if dst in images:
+            raise ImageExists("%s/%s" % (pool, dst))
+        image = self.image(pool, src)
+        del images[src]
+        image.name = dst
+        images[dst] = image
+        # the header is not modified by a rename, but the links from
+        # parent and children are
+        if image.parent is not None:
+            parentpool, parentname, snapname = image.parent
+            children = self.image(parentpool, parentname).children[snapname]
+            children[children.index((pool, src))] = (pool, dst)
+        for snapname, children in image.children.items():
+            for childpool, childname in children:
+                child = self.image(childpool, childname)
+                child.parent = (pool, dst, snapname)
+        self._changed()
+
+    def remove(self, pool, name):
+        image = self.image(pool, name)
+        if image.snaps:
+            raise ImageHasSnapshots("%s/%s" % (pool, name))
+        if image.parent is not None:
+            parentpool, parentname, snapname = image.parent
+            self.image(parentpool, parentname).children[snapname].remove(
+                (pool, name))
+        del self.pools[pool][name]
+        del self.ids[pool, image.id]
+        self._changed()
+
+    def populate(self, pool, images, depth=3, fanout=2, snapshots=1,
+                 deleted=0.0, seed=None):
+        """Add `images` synthetic images to `pool`
+
+        Images are organized in clone trees. Each tree has a glance
+        image at its root; every image up to `depth` levels below has
+        `snapshots` protected snapshots, each one with `fanout` clones.
+        Clones are named like nova ephemeral disks, cinder volumes or
+        VM snapshots, in turn. A fraction `deleted` of the images is
+        renamed as if they had been deleted by glance.
+        """
+        rnd = random.Random(seed)
+
+        def uuid():
+            return '%08x-%04x-%04x-%04x-%012x' % (
+                rnd.getrandbits(32), rnd.getrandbits(16), rnd.getrandbits(16),
+                rnd.getrandbits(16), rnd.getrandbits(48))
+
+        kinds = [
+            lambda: uuid() + '_disk',
+            lambda: 'volume-' + uuid(),
+            lambda: '%s_disk_clone_%032x' % (uuid(), rnd.getrandbits(128)),
+        ]
+
+        created = []
+        while len(created) < images:
+            root = self.create(pool, uuid())
+            created.append(root)
+            frontier = [root]
+            for level in range(depth):
+                clones = []
+                for parent in frontier:
+                    for snap in range(snapshots):
+                        snapname = 'snap%d' % snap
+                        self.create_snap(pool, parent.name, snapname,
+                                         protected=True)
+                        for i in range(fanout):
+                            if len(created) >= images:
+                                break
+                            name = kinds[len(created) % len(kinds)]()
+                            clone = self.clone(pool, parent.name, snapname,
+                                               pool, name)
+                            created.append(clone)
+                            clones.append(clone)
+                frontier = clones
+
+        for image in created:
+            if rnd.random() < deleted:
+                self.rename(pool, image.name, image.name + DELETE_SUFFIX)
+        return [image.name for image in created]
+
+    def omap(self, pool, oid):
+        """Returns the sorted omap items of the rbd metadata object `oid`
+
+        Only `rbd_directory`, `rbd_children` and `rbd_header.<id>`
+        are supported, with the same encoding used by cls_rbd.
+        """
+        cached = self._omaps.get((pool, oid))
+        if cached is not None and cached[0] == self._version:
+            return cached[1]
+        images = self.pools.get(pool, {})
+        if oid == 'rbd_directory':
+            omap = {}
+            for image in images.values():
+                omap['name_' + image.name] = _encode_string(image.id)
+                omap['id_' + image.id] = _encode_string(image.name)
+        elif oid == 'rbd_children':
+            children = {}
+            for image in images.values():
+                if image.parent is None:
+                    continue
+                parentpool, parentname, snapname = image.parent
+                parent = self.image(parentpool, parentname)
+                key = (struct.pack('<q', self.pool_ids[parentpool])
+                       + _encode_string(parent.id)
+                       + struct.pack('<Q', parent.snaps[snapname]['id']))
+                children.setdefault(key, []).append(image.id)
+            if not children:
+                raise ObjectNotFound(oid)
+            omap = dict((key, struct.pack('<I', len(ids))
+                         + str.join('', [_encode_string(i) for i in sorted(ids)]))
+                        for key, ids in children.items())
+        elif oid.startswith('rbd_header.'):
+            image = self.ids.get((pool, oid[len('rbd_header.'):]))
+            if image is None:
+                raise ObjectNotFound(oid)
+            omap = {'size': struct.pack('<Q', image.size)}
+            for name, snap in image.snaps.items():
+                # cls_rbd_snap: ENCODE_START header, id, name, image_size
+                body = (struct.pack('<Q', snap['id']) + _encode_string(name)
+                        + struct.pack('<Q', snap['size']))
+                omap['snapshot_%016x' % snap['id']] = (
+                    struct.pack('<BBI', 4, 1, len(body)) + body)
+        else:
+            raise ObjectNotFound(oid)
+        items = sorted(omap.items())
+        self._omaps[pool, oid] = (self._version, items)
+        return items
+
+    def install(self):
+        """Register this module as `rados` and `rbd` in `sys.modules`"""
+        global _current
+        _current = self
+        sys.modules['rados'] = sys.modules['rbd'] = sys.modules[__name__]
+
+    @contextmanager
+    def patch(self, namespace):
+        """Temporarily replace `rados` and `rbd` in `namespace`
+
+        `namespace` is usually the ``globals()`` of an already
+        imported tool.
+        """
+        global _current
+        saved = dict((name, namespace[name]) for name in ('rados', 'rbd')
+                     if name in namespace)
+        previous, _current = _current, self
+        namespace['rados'] = namespace['rbd'] = sys.modules[__name__]
+        try:
+            yield self
+        finally:
+            _current = previous
+            for name in ('rados', 'rbd'):
+                namespace.pop(name, None)
+            namespace.update(saved)
+
+
+def _encode_string(value):
+    return struct.pack('<I', len(value)) + value
+
+
+# rados API
+
+class ReadOpCtx(object):
+    def __init__(self):
+        self._ops = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _OmapIterator(object):
+    def __init__(self):
+        self._items = []
+
+    def __iter__(self):
+        return iter(self._items)
+
+
+class Rados(object):
+    def __init__(self, conffile=None, rados_id=None, **kwargs):
+        self._cluster = _current
+
+    @_api('connect')
+    def connect(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    @_api('open_ioctx')
+    def open_ioctx(self, pool):
+        if pool not in self._cluster.pools:
+            raise ObjectNotFound(pool)
+        return Ioctx(self._cluster, pool)
+
+
+class Ioctx(object):
+    def __init__(self, cluster, pool):
+        self._cluster = cluster
+        self.pool = pool
+
+    def close(self):
+        pass
+
+    def get_pool_id(self):
+        return self._cluster.pool_ids[self.pool]
+
+    def get_omap_vals(self, read_op, start_after, filter_prefix, max_return):
+        items = _OmapIterator()
+        read_op._ops.append((items, start_after, filter_prefix, max_return))
+        return items, 0
+
+    @_api('operate_read_op')
+    def operate_read_op(self, read_op, oid, flag=0):
+        omap = self._cluster.omap(self.pool, oid)
+        keys = [key for key, value in omap]
+        for items, start_after, prefix, max_return in read_op._ops:
+            start = bisect.bisect_right(keys, start_after) if start_after else 0
+            items._items = []
+            for key, value in omap[start:]:
+                if len(items._items) >= max_return:
+                    break
+                if key.startswith(prefix):
+                    items._items.append((key, value))
+        read_op._ops = []
+
+    @_api('read')
+    def read(self, key, length=8192, offset=0):
+        if key.startswith('rbd_id.'):
+            try:
+                image = self._cluster.image(self.pool, key[len('rbd_id.'):])
+            except ImageNotFound:
+                raise ObjectNotFound(key)
+            data = struct.pack('<I', len(image.id)) + image.id
+            return data[offset:offset + length]
+        raise ObjectNotFound(key)
+
+    @_api('stat')
+    def stat(self, key):
+        if key.startswith('rbd_header.'):
+            image = self._cluster.ids.get((self.pool,
+                                           key[len('rbd_header.'):]))
+            if image is not None:
+                # like librados, only whole seconds
+                return 0, time.localtime(image.mtime)
+        raise ObjectNotFound(key)
+
+
+# rbd API
+
+class RBD(object):
+    def __init__(self):
+        self._cluster = _current
+
+    @_api('list')
+    def list(self, ioctx):
+        return list(self._cluster.pool(ioctx.pool))
+
+    @_api('remove')
+    def remove(self, ioctx, name):
+        self._cluster.remove(ioctx.pool, name)
+
+    @_api('rename')
+    def rename(self, ioctx, src, dst):
+        self._cluster.rename(ioctx.pool, src, dst)
+
+    @_api('clone')
+    def clone(self, p_ioctx, p_name, p_snapname, c_ioctx, c_name,
+              features=None, order=None):
+        self._cluster.clone(p_ioctx.pool, p_name, p_snapname,
+                            c_ioctx.pool, c_name)
+
+
+class Image(object):
+    def __init__(self, ioctx, name, snapshot=None, read_only=False):
+        self._cluster = ioctx._cluster
+        self._cluster.called('open')
+        self._pool = ioctx.pool
+        self._image = self._cluster.image(ioctx.pool, name)
+        if snapshot is not None and snapshot not in self._image.snaps:
+            raise ImageNotFound("%s/%s@%s" % (ioctx.pool, name, snapshot))
+        self._snapshot = snapshot
+        self._read_only = read_only or snapshot is not None
+        self._closed = False
+        with self._cluster._lock:
+            self._cluster.open_images += 1
+            self._cluster.peak_open_images = max(
+                self._cluster.peak_open_images, self._cluster.open_images)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            with self._cluster._lock:
+                self._cluster.open_images -= 1
+
+    def _check_writable(self):
+        if self._read_only:
+            raise ReadOnlyImage(self._image.name)
+
+    @_api('id')
+    def id(self):
+        return self._image.id
+
+    @_api('size')
+    def size(self):
+        return self._image.size
+
+    @_api('features')
+    def features(self):
+        return RBD_FEATURE_LAYERING
+
+    @_api('list_snaps')
+    def list_snaps(self):
+        return [{'id': snap['id'], 'size': snap['size'], 'name': name}
+                for name, snap in self._image.snaps.items()]
+
+    @_api('list_children')
+    def list_children(self):
+        if self._snapshot is None:
+            return []
+        return list(self._image.children[self._snapshot])
+
+    @_api('parent_info')
+    def parent_info(self):
+        if self._image.parent is None:
+            raise ImageNotFound("%s has no parent" % self._image.name)
+        return self._image.parent
+
+    @_api('create_snap')
+    def create_snap(self, name):
+        self._check_writable()
+        self._cluster.create_snap(self._pool, self._image.name, name)
+
+    @_api('is_protected_snap')
+    def is_protected_snap(self, name):
+        return self._image.snaps[name]['protected']
+
+    @_api('protect_snap')
+    def protect_snap(self, name):
+        self._check_writable()
+        self._image.snaps[name]['protected'] = True
+        self._cluster._touch(self._image)
+
+    @_api('unprotect_snap')
+    def unprotect_snap(self, name):
+        self._check_writable()
+        if not self._image.snaps[name]['protected']:
+            raise InvalidArgument("%s@%s is not protected"
+                                  % (self._image.name, name))
+        if self._image.children[name]:
+            raise ImageBusy("%s@%s has clones" % (self._image.name, name))
+        self._image.snaps[name]['protected'] = False
+        self._cluster._touch(self._image)
+
+    @_api('remove_snap')
+    def remove_snap(self, name):
+        self._check_writable()
+        if self._image.snaps[name]['protected']:
+            raise ImageBusy("%s@%s is protected" % (self._image.name, name))
+        del self._image.snaps[name]
+        del self._image.children[name]
+        self._cluster._touch(self._image)
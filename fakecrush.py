@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2015, S3IT, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+"""
+Write a synthetic crush map, in the text format of `crushtool -d`.
+
+The map has a `default` root with `rows` rows, each one with `racks`
+racks of `hosts` hosts of `osds` OSDs. The first `ssds` OSDs of each
+host are SSDs, the others are HDDs. Like in a cluster grown over the
+years, all the HDDs of a host have the same size, but different hosts
+have different HDD and SSD sizes, so hosts have exactly two different
+weights and `make-crushmap.py` can tell SSDs from HDDs.
+
+Weights are in TiB, unless scaled down with `--scale`: crush cannot
+represent bucket weights above 65535, which a root of a few tens of
+thousands of today's drives already exceeds.
+
+Typical usage, to try make-crushmap.py on a large map::
+
+    ./fakecrush.py --rows 4 --racks 10 --hosts 25 --osds 10 \\
+        | ./make-crushmap.py > new.txt
+"""
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import argparse
+import random
+import sys
+
+# weights of the drives bought over the years, in TiB
+HDD_WEIGHTS = (1.819, 3.638, 5.458, 7.277, 9.096)
+SSD_WEIGHTS = (0.218, 0.436, 0.873)
+
+TYPES = ('osd', 'host', 'rack', 'row', 'root')
+
+TUNABLES = (
+    ('choose_local_tries', 0),
+    ('choose_local_fallback_tries', 0),
+    ('choose_total_tries', 50),
+    ('chooseleaf_descend_once', 1),
+    ('chooseleaf_vary_r', 1),
+    ('chooseleaf_stable', 1),
+    ('straw_calc_version', 1),
+    ('allowed_bucket_algs', 54),
+)
+
+
+def generate(stream, rows=1, racks=1, hosts=1, osds=1, ssds=1,
+             classes=False, alg='straw2', scale=1.0, seed=None):
+    """Write the synthetic crush map to `stream`
+
+    Returns the number of OSDs of the map. With `classes` the devices
+    get their class in the map, otherwise their class can only be
+    guessed from their weight. Weights are multiplied by `scale`. The
+    same `seed` gives the same map.
+    """
+    rnd = random.Random(seed)
+    ssds = min(ssds, osds)
+    # drive sizes of each host
+    sizes = [(round(rnd.choice(SSD_WEIGHTS) * scale, 3),
+              round(rnd.choice(HDD_WEIGHTS) * scale, 3))
+             for i in range(rows * racks * hosts)]
+
+    stream.write("# begin crush map\n")
+    for name, value in TUNABLES:
+        stream.write("tunable %s %d\n" % (name, value))
+
+    stream.write("\n# devices\n")
+    for i in range(rows * racks * hosts * osds):
+        if classes:
+            stream.write("device %d osd.%d class %s\n" % (
+                i, i, 'ssd' if i % osds < ssds else 'hdd'))
+        else:
+            stream.write("device %d osd.%d\n" % (i, i))
+
+    stream.write("\n# types\n")
+    for i, name in enumerate(TYPES):
+        stream.write("type %d %s\n" % (i, name))
+
+    stream.write("\n# buckets\n")
+    ids = iter(range(-2, -2 - rows * racks * (hosts + 1) - rows, -1))
+
+    def bucket(kind, name, items):
+        stream.write("%s %s {\n" % (kind, name))
+        stream.write("\tid %d\t\t# do not change unnecessarily\n"
+                     % (next(ids) if kind != 'root' else -1))
+        stream.write("\t# weight %.3f\n" % sum(wt for item, wt in items))
+        stream.write("\talg %s\n\thash 0\t# rjenkins1\n" % alg)
+        for item, wt in items:
+            stream.write("\titem %s weight %.3f\n" % (item, wt))
+        stream.write("}\n")
+        return name, sum(wt for item, wt in items)
+
+    osd = 0
+    row_items = []
+    for row in range(rows):
+        rack_items = []
+        for rack in range(racks):
+            host_items = []
+            for host in range(hosts):
+                ssd, hdd = sizes[(row * racks + rack) * hosts + host]
+                items = []
+                for i in range(osds):
+                    items.append(('osd.%d' % osd, ssd if i < ssds else hdd))
+                    osd += 1
+                host_items.append(bucket(
+                    'host', 'node-r%d-k%d-h%d' % (row, rack, host), items))
+            rack_items.append(bucket(
+                'rack', 'rack-r%d-k%d' % (row, rack), host_items))
+        row_items.append(bucket('row', 'row-r%d' % row, rack_items))
+    bucket('root', 'default', row_items)
+
+    stream.write("\n# rules\n")
+    stream.write("rule replicated_rule {\n"
+                 "\tid 0\n"
+                 "\ttype replicated\n"
+                 "\tmin_size 1\n"
+                 "\tmax_size 10\n"
+                 "\tstep take default\n"
+                 "\tstep chooseleaf firstn 0 type host\n"
+                 "\tstep emit\n"
+                 "}\n")
+    stream.write("\n# end crush map\n")
+    return osd
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1,
+                        help='Rows of the map. Default: %(default)s')
+    parser.add_argument('--racks', type=int, default=4,
+                        help='Racks of each row. Default: %(default)s')
+    parser.add_argument('--hosts', type=int, default=8,
+                        help='Hosts of each rack. Default: %(default)s')
+    parser.add_argument('--osds', type=int, default=12,
+                        help='OSDs of each host. Default: %(default)s')
+    parser.add_argument('--ssds', type=int, default=1,
+                        help='SSDs among the OSDs of each host. '
+                        'Default: %(default)s')
+    parser.add_argument('--classes', action='store_true',
+                        help='Write the class of the devices.')
+    parser.add_argument('--alg', default='straw2',
+                        choices=('list', 'tree', 'straw', 'straw2'),
+                        help='Algorithm of the buckets. Default: %(default)s')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Factor applied to the weights of the drives. '
+                        'Default: %(default)s')
+    parser.add_argument('--seed', type=int,
+                        help='Seed of the random drive sizes.')
+    opts = parser.parse_args()
+
+    generate(sys.stdout, opts.rows, opts.racks, opts.hosts, opts.osds,
+             opts.ssds, opts.classes, opts.alg, opts.scale, opts.seed)
+
+
+if __name__ == '__main__':
+    main()
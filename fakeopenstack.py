@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2015, S3IT, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+"""
+Local stand-in for the Keystone, Cinder, Glance and Nova HTTP APIs.
+
+Only the calls used by the tools of this repository are implemented:
+password authentication (Keystone v3), listing (paginated, with or
+without details) and showing of volumes (Cinder v2), images (Glance
+v2) and servers (Nova v2.1). Any user and password are accepted.
+
+Each request can be delayed by a fixed latency, and a fraction of the
+requests can be made to fail with "503 Service Unavailable", to test
+retries. Requests and HTTP connections are counted.
+
+It can be used from python::
+
+    cloud = FakeOpenStack(volumes=40000)
+    auth_url = cloud.start()
+    ...
+    cloud.stop()
+
+or run as a standalone server::
+
+    python fakeopenstack.py --volumes 40000 --port 5000
+"""
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import BaseHTTPServer
+import bisect
+from collections import Counter, OrderedDict
+import SocketServer
+import argparse
+import json
+import random
+import threading
+import time
+import urlparse
+
+PROJECT_ID = 'f00dfeedf00dfeedf00dfeedf00dfeed'
+
+# Prefix of the endpoint of each service, and the name of the
+# collection it serves.
+SERVICES = {
+    'volume': ('volumev2', 'cinderv2', '/volume/v2/' + PROJECT_ID, 'volumes'),
+    'image': ('image', 'glance', '/image', 'images'),
+    'compute': ('compute', 'nova', '/compute/v2.1', 'servers'),
+}
+
+
+def make_uuid(rnd):
+    return '%08x-%04x-%04x-%04x-%012x' % (
+        rnd.getrandbits(32), rnd.getrandbits(16), rnd.getrandbits(16),
+        rnd.getrandbits(16), rnd.getrandbits(48))
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FakeOpenStack(object):
+    """In-memory OpenStack cloud, served over HTTP
+
+    `volumes`, `images` and `servers` are either the number of
+    resources to create with random UUIDs, or the list of their UUIDs.
+    `max_limit` is the maximum number of items returned by a single
+    list request, like `osapi_max_limit`.
+    """
+
+    def __init__(self, volumes=0, images=0, servers=0, latency=0.0,
+                 error_rate=0.0, max_limit=1000, seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_limit = max_limit
+        self._rnd = random.Random(seed)
+        self.resources = {}
+        for service, items in (('volume', volumes), ('image', images),
+                               ('compute', servers)):
+            if isinstance(items, int):
+                items = [make_uuid(self._rnd) for i in xrange(items)]
+            self.resources[service] = OrderedDict(
+                (uuid, {'id': uuid, 'name': 'fake-%s' % uuid})
+                for uuid in sorted(items))
+        self.requests = Counter()
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self.url = None
+
+    @property
+    def volumes(self):
+        return self.resources['volume']
+
+    @property
+    def images(self):
+        return self.resources['image']
+
+    @property
+    def servers(self):
+        return self.resources['compute']
+
+    def start(self, host='127.0.0.1', port=0):
+        """Start serving in a background thread, returns the auth URL"""
+        cloud = self
+
+        class Handler(_Handler):
+            pass
+        Handler.cloud = cloud
+
+        self._server = _Server((host, port), Handler)
+        self.url = 'http://%s:%d' % self._server.server_address
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        thread.start()
+        return self.url + '/v3'
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def count(self, key):
+        with self._lock:
+            self.requests[key] += 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._rnd.random() < self.error_rate
+
+    def catalog(self):
+        catalog = []
+        for service, (stype, name, prefix, collection) in SERVICES.items():
+            catalog.append({
+                'type': stype,
+                'name': name,
+                'id': name,
+                'endpoints': [
+                    {'id': '%s-%s' % (name, interface),
+                     'interface': interface,
+                     'region': 'RegionOne',
+                     'region_id': 'RegionOne',
+                     'url': self.url + prefix}
+                    for interface in ('public', 'internal', 'admin')],
+            })
+        return catalog
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep connections alive
+    protocol_version = 'HTTP/1.1'
+    # send each reply with a single write, or delayed ACKs slow down
+    # every request of a kept-alive connection
+    wbufsize = -1
+    disable_nagle_algorithm = True
+    cloud = None
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.cloud._lock:
+            self.cloud.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, data=None, headers=()):
+        body = json.dumps(data) if data is not None else ''
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _not_found(self, message='Not found'):
+        self._reply(404, {'itemNotFound': {'code': 404, 'message': message}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if self.path.rstrip('/') != '/v3/auth/tokens':
+            return self._not_found()
+        self.cloud.count('identity')
+        now = time.time()
+        token = {
+            'methods': ['password'],
+            'expires_at': time.strftime('%Y-%m-%dT%H:%M:%S.000000Z',
+                                        time.gmtime(now + 3600)),
+            'issued_at': time.strftime('%Y-%m-%dT%H:%M:%S.000000Z',
+                                       time.gmtime(now)),
+            'user': {'id': 'admin', 'name': 'admin',
+                     'domain': {'id': 'default', 'name': 'Default'}},
+            'project': {'id': PROJECT_ID, 'name': 'admin',
+                        'domain': {'id': 'default', 'name': 'Default'}},
+            'roles': [{'id': 'admin', 'name': 'admin'}],
+            'catalog': self.cloud.catalog(),
+        }
+        self._reply(201, {'token': token},
+                    headers=[('X-Subject-Token', 'fake-token')])
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query))
+        if url.path.startswith('/image/v2/schemas/'):
+            # glanceclient needs the schema of images; accept anything
+            name = url.path.rstrip('/').split('/')[-1]
+            return self._reply(200, {'name': name, 'properties': {},
+                                     'additionalProperties': True})
+        for service, (stype, name, prefix, collection) in SERVICES.items():
+            base = prefix + '/'
+            if service == 'image':
+                base += 'v2/'
+            if url.path.startswith(base + collection):
+                break
+        else:
+            return self._not_found()
+        rest = url.path[len(base + collection):].strip('/')
+
+        cloud = self.cloud
+        cloud.count(service)
+        if cloud.latency:
+            time.sleep(cloud.latency)
+        if cloud.should_fail():
+            return self._reply(503, {'serviceUnavailable': {
+                'code': 503, 'message': 'Injected failure'}})
+
+        items = cloud.resources[service]
+        if rest and rest != 'detail':
+            if rest not in items:
+                return self._not_found('%s %s could not be found.'
+                                       % (collection, rest))
+            key = collection[:-1]
+            return self._reply(200, {key: self._show(service, items[rest])})
+
+        limit = min(int(query.get('limit', cloud.max_limit)), cloud.max_limit)
+        uuids = items.keys()
+        start = 0
+        if query.get('marker'):
+            # items are sorted by UUID
+            start = bisect.bisect_right(uuids, query['marker'])
+        page = [self._show(service, items[uuid], detail=(rest == 'detail'))
+                for uuid in uuids[start:start + limit]]
+        data = {collection: page}
+        if len(page) == limit and start + limit < len(uuids):
+            query['marker'] = page[-1]['id']
+            query['limit'] = str(limit)
+            next_url = '%s?%s' % (url.path, '&'.join(
+                '%s=%s' % item for item in sorted(query.items())))
+            if service == 'image':
+                data['next'] = next_url[len(prefix):]
+            else:
+                data[collection + '_links'] = [
+                    {'rel': 'next', 'href': cloud.url + next_url}]
+        self._reply(200, data)
+
+    def _show(self, service, item, detail=True):
+        data = {'id': item['id'], 'name': item['name'], 'links': []}
+        if service == 'image':
+            data.update(status='active', visibility='public',
+                        tags=[], container_format='bare', disk_format='raw')
+        elif detail and service == 'volume':
+            data.update(status='available', size=1,
+                        attachments=[], metadata={})
+        elif detail and service == 'compute':
+            data.update(status='ACTIVE', tenant_id=PROJECT_ID,
+                        metadata={}, addresses={})
+        return data
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on. Default: %(default)s')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='Port to listen on. Default: %(default)s')
+    parser.add_argument('--volumes', type=int, default=1000,
+                        help='Number of cinder volumes. Default: %(default)s')
+    parser.add_argument('--images', type=int, default=100,
+                        help='Number of glance images. Default: %(default)s')
+    parser.add_argument('--servers', type=int, default=1000,
+                        help='Number of nova servers. Default: %(default)s')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds taken by each request. '
+                        'Default: %(default)s')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of requests failing with a 503 error. '
+                        'Default: %(default)s')
+    parser.add_argument('--max-limit', type=int, default=1000,
+                        help='Maximum number of items per page. '
+                        'Default: %(default)s')
+    opts = parser.parse_args()
+
+    cloud = FakeOpenStack(volumes=opts.volumes, images=opts.images,
+                          servers=opts.servers, latency=opts.latency,
+                          error_rate=opts.error_rate,
+                          max_limit=opts.max_limit)
+    auth_url = cloud.start(opts.host, opts.port)
+    print("export OS_AUTH_URL=%s OS_USERNAME=admin OS_PASSWORD=admin "
+          "OS_PROJECT_NAME=admin" % auth_url)
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        print("%d connections, requests: %s" % (
+            cloud.connections, dict(cloud.requests)))
+        cloud.stop()
@@ -1,223 +1,918 @@
 #! /usr/bin/env python
 
 from collections import OrderedDict
-from copy import deepcopy
+import argparse
+import io
 import os
+import re
 import sys
+import unittest
+
+import crushbin
 
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Split the hosts of the crush map read from stdin "
+        "into SSD and HDD hosts, and write the new map to stdout. The "
+        "input map can be compiled (`ceph osd getcrushmap`) or text "
+        "(`crushtool -d`).")
+    parser.add_argument('--binary', action='store_true',
+                        help='Write a compiled map, for '
+                        '`ceph osd setcrushmap`, instead of a text one.')
+    parser.add_argument('--simulate', metavar='RULE', action='append',
+                        default=[],
+                        help='Write to stderr how the PGs of a pool using '
+                        'RULE would be spread over the OSDs by the new map. '
+                        'Can be repeated. Needs numpy.')
+    parser.add_argument('--pg-num', type=int, default=4096,
+                        help='PGs of the simulated pool. '
+                        'Default: %(default)s')
+    parser.add_argument('--size', type=int, default=3,
+                        help='Replicas of the simulated pool. '
+                        'Default: %(default)s')
+    parser.add_argument('--pool', type=int, default=1,
+                        help='Id of the simulated pool. Default: %(default)s')
+    parser.add_argument('--run-tests', action='store_true', help='Run tests')
+    opts = parser.parse_args()
+
+    if opts.run_tests:
+        sys.argv = [sys.argv[0]]
+        unittest.main()
+
     # read Crush Map
     m = CrushMap()
-    m.parse(sys.stdin)
+    data = sys.stdin.read()
+    if crushbin.is_compiled(data):
+        m.decode(data)
+    else:
+        m.parse(io.BytesIO(data))
 
     # alter map as needed
     m = split_hdd_and_ssd(m)
 
-    # pretty-print map back to output
-    m.pprint(sys.stdout)
+    # write map back to output
+    if opts.binary:
+        sys.stdout.write(m.encode())
+    else:
+        m.pprint(sys.stdout)
+
+    if opts.simulate:
+        simulate(m, opts.simulate, opts.pg_num, opts.size, opts.pool,
+                 sys.stderr)
+
+
+def simulate(m, rules, pg_num, size, pool, stream):
+    # numpy is only needed here
+    import crushsim
+    # the weight sets of the pool, if any, or the default ones
+    choose_args = None
+    for key in (pool, -1):
+        if key in m.choose_args:
+            choose_args = key
+            break
+    for rule in rules:
+        if rule not in m.rules:
+            raise ValueError("no rule %s in the crush map" % rule)
+    sim = crushsim.Simulator(m, choose_args)
+    for rule in rules:
+        osds = sim.map_pgs(rule, pg_num, size, pool)
+        crushsim.report(sim, rule, osds, stream)
 
 
 def split_hdd_and_ssd(m):
-    for name, data in m.hosts.items():
-        weights = set(data['item'].values())
-
-        if len(weights) == 2:
-            # SSD drives are smaller, hence they have a smaller weight
-            wt_ssd = min(weights)
-            wt_hdd = max(weights)
-
-            # create group of SSD OSDs
-            ssd = deepcopy(data)
-            ssd['id'] = m.new_id()
-            for osd, wt in ssd['item'].items():
-                if wt != wt_ssd:
-                    del ssd['item'][osd]
-            tot_wt_ssd = sum(wt for wt in ssd['item'].values())
-            m.hosts[name + '-ssd'] = ssd
-
-            # create group of HDD OSDs
-            hdd = deepcopy(data)
-            hdd['id'] = m.new_id()
-            for osd, wt in hdd['item'].items():
-                if wt != wt_hdd:
-                    del hdd['item'][osd]
-            tot_wt_hdd = sum(wt for wt in hdd['item'].values())
-            m.hosts[name + '-hdd'] = hdd
-
-            # now alter the original host to point to the two groups
-            m.hosts[name]['item'] = {
-                name + '-ssd': tot_wt_ssd,
-                name + '-hdd': tot_wt_hdd,
-            }
-
-    # Now, create a new root for SSDs
-    ssdroot = OrderedDict()
-    ssdroot['id'] = m.new_id()
-    ssdroot['alg'] = 'straw'
-    ssdroot['hash'] = '0'
-    ssdroot['item'] = {}
-    for name, data in m.hosts.items():
-        if name.endswith('-ssd'):
-            ssdroot['item'][name] = sum(wt for wt in data['item'].values())
-    m.roots['ssdroot'] = ssdroot
-
-    # and then, create a new root for spinning disks
-    hddroot = OrderedDict()
-    hddroot['id'] = m.new_id()
-    hddroot['alg'] = 'straw'
-    hddroot['hash'] = '0'
-    hddroot['item'] = {}
-    for name, data in m.hosts.items():
-        if name.endswith('-hdd'):
-            hddroot['item'][name] = sum(wt for wt in data['item'].values())
-    m.roots['hddroot'] = hddroot
-
-    # Finally, create two new ruleset for ssd and spinning disks
-    ssdrule = OrderedDict()
-    ssdrule['#name'] = 'ssd'
-    ssdrule['ruleset'] = 1 + max(int(rule['ruleset']) for rule in m.rules.values())
-    ssdrule['type'] = 'replicated'
-    ssdrule['min_size'] = 1
-    ssdrule['max_size'] = 10
-    ssdrule['step'] = OrderedDict((
-        ('take', 'ssdroot'),
-        ('chooseleaf', 'firstn 0 type host'),
-        ('emit', '')
-    ))
-    m.rules['ssd'] = ssdrule
-
+    # SSD drives are smaller, hence they have a smaller weight
+    tags = classes_by_weight(m, ('ssd', 'hdd'))
+    return split_by_class(m, tags, ('ssd', 'hdd'), rules=('ssd',))
+
+
+def classes_by_weight(m, classes):
+    """Returns the class of the devices, guessed from their weight
+
+    The devices of the hosts with exactly len(classes) different
+    weights get the class at the same position in `classes` as their
+    weight among the weights of the host, in increasing order, unless
+    they already have a class in the map.
+    """
+    tags = dict(m.classes)
+    for host in m.hosts.values():
+        weights = sorted(set(host.items.values()))
+        if len(weights) != len(classes):
+            continue
+        for item, wt in host.items.items():
+            if item not in m.buckets and item not in tags:
+                tags[item] = classes[weights.index(wt)]
+    return tags
+
+
+def split_by_class(m, tags=None, classes=None, rules=()):
+    """Split the hosts with devices of several classes
+
+    `tags` maps devices to their class, by default the classes of the
+    map. Devices of each class are moved to a new host `HOST-CLASS`, which
+    takes their place in the original host, and which is added to a
+    new root `CLASSroot`. Hosts and roots are created in the order of
+    `classes` (all classes, sorted, by default). A replicated rule
+    named after the class is added for each of `rules`. The map is
+    changed in place, in a single pass over the hosts. Hosts, roots and
+    rules which already exist, e.g. because the map was already split,
+    are reused.
+    """
+    def bucket(kind, name, *args):
+        if name not in m.buckets:
+            return m.new_bucket(kind, name, *args)
+        if m.buckets[name].type != kind:
+            raise ValueError("cannot split the map: bucket %s is a %s, "
+                             "not a %s" % (name, m.buckets[name].type, kind))
+        return m.buckets[name]
+
+    if tags is None:
+        tags = m.classes
+    if classes is None:
+        classes = sorted(set(tags.values()))
+    split = dict((cls, []) for cls in classes)
+    for name, host in m.hosts.items():
+        by_class = OrderedDict((cls, []) for cls in classes)
+        for item in host.items:
+            cls = tags.get(item)
+            if cls in by_class:
+                by_class[cls].append(item)
+        by_class = [(cls, items) for cls, items in by_class.items() if items]
+        if len(by_class) < 2:
+            continue
+        for cls, items in by_class:
+            child = bucket('host', '%s-%s' % (name, cls), host.alg, host.hash)
+            for item in items:
+                m.move_item(item, child.name)
+            m.add_item(name, child.name, child.weight())
+            split[cls].append(child)
+
+    for cls in classes:
+        root = bucket('root', '%sroot' % cls)
+        for child in split[cls]:
+            root.items[child.name] = child.weight()
+
+    # rules have an `id` since Luminous, only a `ruleset` before
+    key = 'ruleset'
+    if not m.rules or any('id' in rule for rule in m.rules.values()):
+        key = 'id'
+    ruleset = max([int(rule[k]) for rule in m.rules.values()
+                   for k in ('id', 'ruleset') if k in rule] or [-1])
+    for cls in rules:
+        if cls in m.rules:
+            continue
+        ruleset += 1
+        rule = OrderedDict()
+        rule['#name'] = cls
+        rule[key] = ruleset
+        rule['type'] = 'replicated'
+        rule['min_size'] = 1
+        rule['max_size'] = 10
+        rule['step'] = [
+            ['take', '%sroot' % cls],
+            ['chooseleaf', 'firstn', '0', 'type', 'host'],
+            ['emit'],
+        ]
+        m.rules[cls] = rule
     return m
 
 
+class Bucket(object):
+    __slots__ = ['name', 'type', 'id', 'class_ids', 'alg', 'hash', 'items',
+                 'pos']
+
+    def __init__(self, name, type, id=None, alg='straw', hash='0'):
+        self.name = name
+        self.type = type
+        self.id = id
+        # (class, id) of the shadow buckets
+        self.class_ids = []
+        self.alg = alg
+        self.hash = hash
+        # item name -> weight (None if not given) and position
+        self.items = OrderedDict()
+        self.pos = {}
+
+    def weight(self):
+        return sum(wt for wt in self.items.values() if wt is not None)
+
+
 class CrushMap(object):
     def __init__(self):
-        self._ids = set()
-        self.tunables = {}
+        # ids are negative, new ones are allocated below all the others
+        self._next_id = -1
+        self.tunables = OrderedDict()
+        # device id -> name, and device name -> class
         self.devices = {}
+        self.classes = {}
         self.types = {}
-        self.hosts = OrderedDict()
-        self.roots = {}
-        self.rules = {}
+        # buckets of any type, in the order they were defined
+        self.buckets = OrderedDict()
+        # item name -> name of the bucket it belongs to
+        self.parents = {}
+        self.rules = OrderedDict()
+        self.choose_args = OrderedDict()
+        # decimals of the weights written by `pprint`: crushtool writes
+        # 5 since Mimic, 3 before
+        self.precision = 5
+        self._weight_text = {}
+
+    @property
+    def hosts(self):
+        return self.buckets_of_type('host')
+
+    @property
+    def roots(self):
+        return self.buckets_of_type('root')
+
+    def buckets_of_type(self, kind):
+        return OrderedDict((name, bucket)
+                           for name, bucket in self.buckets.items()
+                           if bucket.type == kind)
 
     def parse(self, stream):
         # do the actual parsing
-        input = _PartsIterator(stream)
-        for parts in input:
-            if 'tunable' == parts[0]:
-                self.tunables[parts[1]] = parts[2]
-            elif 'device' == parts[0]:
-                self.devices[parts[1]] = parts[2]
-            elif 'type' == parts[0]:
-                self.types[parts[1]] = parts[2]
-            elif 'host' == parts[0]:
-                self.hosts[parts[1]] = self._parse_host_or_root(parts[1], input)
-            elif 'root' == parts[0]:
-                self.roots[parts[1]] = self._parse_host_or_root(parts[1], input)
-            elif 'rule' == parts[0]:
-                self.rules[parts[1]] = self._parse_rule(parts[1], input)
-
-    def _parse_host_or_root(self, name, input):
-        data = OrderedDict((
-            ('#name', name),
-            ('id', '-999'),
-            ('item', {})))
-        for parts in input:
-            if '}' == parts[0]:
-                return data
-            elif 'id' == parts[0]:
-                id = int(parts[1])
-                self._ids.add(id)
-                data['id'] = id
-            elif 'item' == parts[0]:
-                data['item'][parts[1]] = float(parts[3])
+        input = _Tokens(stream.read())
+        while input:
+            word = input.next()
+            if 'tunable' == word:
+                name = input.next()
+                self.tunables[name] = input.next()
+            elif 'device' == word:
+                self._parse_devices(input)
+            elif 'type' == word:
+                id = input.next_int()
+                self.types[id] = input.next()
+            elif 'rule' == word:
+                name = input.next()
+                self.rules[name] = self._parse_rule(name, input)
+            elif 'choose_args' == word:
+                id = input.next_int()
+                self.choose_args[id] = self._parse_choose_args(input)
+            elif word in self.types.values():
+                name = input.next()
+                self.buckets[name] = self._parse_bucket(word, name, input)
+            else:
+                input.error("unknown keyword %r" % word)
+        # write weights back as they were read
+        if 'weight' in input.tokens:
+            weight = input.tokens[input.tokens.index('weight') + 1]
+            self.precision = len(weight.partition('.')[2])
+
+    def _parse_bucket(self, kind, name, input):
+        bucket = Bucket(name, kind)
+        input.expect('{')
+        while not input.accept('}'):
+            word = input.next()
+            if 'id' == word:
+                id = input.next_int()
+                self._use_id(id)
+                if input.accept('class'):
+                    bucket.class_ids.append((input.next(), id))
+                else:
+                    bucket.id = id
+            elif 'item' == word:
+                self._parse_items(bucket, input)
+            elif 'alg' == word:
+                bucket.alg = input.next()
+            elif 'hash' == word:
+                bucket.hash = input.next()
             else:
-                data[parts[0]] = parts[1]
+                input.error("unknown bucket attribute %r" % word)
+        return bucket
+
+    # Devices and items make up most of a map, and are parsed
+    # without going through `_Tokens` methods for each token
+    def _parse_devices(self, input):
+        tokens, i = input.tokens, input.pos
+        devices, classes = self.devices, self.classes
+        try:
+            while True:
+                id, name = int(tokens[i]), tokens[i + 1]
+                devices[id] = name
+                i += 2
+                if tokens[i] == 'class':
+                    classes[name] = tokens[i + 1]
+                    i += 2
+                if tokens[i] != 'device':
+                    break
+                i += 1
+        except (ValueError, IndexError):
+            input.pos = i
+            input.error("invalid device")
+        input.pos = i
+
+    def _parse_items(self, bucket, input):
+        tokens, i = input.tokens, input.pos
+        items, parents = bucket.items, self.parents
+        try:
+            while True:
+                item = tokens[i]
+                i += 1
+                parents.setdefault(item, bucket.name)
+                if tokens[i] == 'weight':
+                    items[item] = float(tokens[i + 1])
+                    i += 2
+                else:
+                    items[item] = None
+                if tokens[i] == 'pos':
+                    bucket.pos[item] = int(tokens[i + 1])
+                    i += 2
+                if tokens[i] != 'item':
+                    break
+                i += 1
+        except (ValueError, IndexError):
+            input.pos = i
+            input.error("invalid item")
+        input.pos = i
+
+    # number of arguments of rule steps, other than `take` which can
+    # also have a class
+    _STEP_ARGS = {
+        'emit': 0,
+        'choose': 4,
+        'chooseleaf': 4,
+    }
 
     def _parse_rule(self, name, input):
-        rules = OrderedDict((('#name', name), ('step',OrderedDict())))
-        for parts in input:
-            if '}' == parts[0]:
-                return rules
-            elif 'step' == parts[0]:
-                rules['step'][parts[1]] = str.join(' ', parts[2:])
+        rules = OrderedDict((('#name', name), ('step', [])))
+        input.expect('{')
+        while not input.accept('}'):
+            word = input.next()
+            if 'step' == word:
+                op = input.next()
+                step = [op]
+                if 'take' == op:
+                    step.append(input.next())
+                    if input.accept('class'):
+                        step.extend(['class', input.next()])
+                elif op.startswith('set_'):
+                    step.append(input.next())
+                elif op in self._STEP_ARGS:
+                    for i in range(self._STEP_ARGS[op]):
+                        step.append(input.next())
+                else:
+                    input.error("unknown rule step %r" % op)
+                rules['step'].append(step)
             else:
-                rules[parts[0]] = str.join(' ', parts[1:])
+                rules[word] = input.next()
+        return rules
+
+    def _parse_choose_args(self, input):
+        # list of OrderedDicts, with keys bucket_id, weight_set
+        # (list of lists of weights) and ids (list of ids)
+        args = []
+        input.expect('{')
+        while not input.accept('}'):
+            input.expect('{')
+            data = OrderedDict()
+            while not input.accept('}'):
+                word = input.next()
+                if 'bucket_id' == word:
+                    data[word] = input.next_int()
+                elif 'weight_set' == word:
+                    input.expect('[')
+                    data[word] = []
+                    while not input.accept(']'):
+                        input.expect('[')
+                        data[word].append(input.list_until(']', float))
+                elif 'ids' == word:
+                    input.expect('[')
+                    data[word] = input.list_until(']', int)
+                else:
+                    input.error("unknown choose_args attribute %r" % word)
+            args.append(data)
+        return args
+
+    def decode(self, data):
+        """Read the compiled map `data`, see `crushbin.decode`"""
+        c = crushbin.decode(data)
+        names, types = c['names'], c['types']
+        class_name = c['class_name']
+        shadows = dict((id, (original, class_name[cls]))
+                       for original, ids in c['class_bucket'].items()
+                       for cls, id in ids.items())
+
+        for name, value in c['tunables'].items():
+            if value != crushbin.LEGACY_TUNABLES[name]:
+                self.tunables[name] = str(value)
+        for id in range(c['max_devices']):
+            if id in names:
+                self.devices[id] = names[id]
+                if id in c['class_map']:
+                    self.classes[names[id]] = class_name[c['class_map'][id]]
+        self.types.update(types)
+
+        for index in range(c['max_buckets']):
+            id = -1 - index
+            if id not in c['buckets'] or id in shadows:
+                continue
+            info = c['buckets'][id]
+            bucket = self.buckets[names[id]] = Bucket(
+                names[id], types[info['type']], id, info['alg'],
+                str(info['hash']))
+            self._use_id(id)
+            for cls, shadow in sorted(c['class_bucket'].get(id, {}).items()):
+                bucket.class_ids.append((class_name[cls], shadow))
+                self._use_id(shadow)
+            for i, (item, weight) in enumerate(zip(info['items'],
+                                                   info['weights'])):
+                self.add_item(bucket.name, names[item], weight / 65536.0)
+                if info['alg'] in ('uniform', 'tree'):
+                    bucket.pos[names[item]] = i
+
+        for index, info in sorted(c['rules'].items()):
+            rule = OrderedDict((('#name', info['name']), ('id', str(index))))
+            if info['ruleset'] != index:
+                rule['ruleset'] = str(info['ruleset'])
+            rule['type'] = crushbin.RULE_TYPES.get(info['type'],
+                                                   str(info['type']))
+            rule['min_size'] = str(info['min_size'])
+            rule['max_size'] = str(info['max_size'])
+            rule['step'] = []
+            for op, arg1, arg2 in info['steps']:
+                step = list(crushbin.STEPS.get(op, ('noop',)))
+                if step[0] == 'take':
+                    if arg1 in shadows:
+                        step.extend([names[shadows[arg1][0]], 'class',
+                                     shadows[arg1][1]])
+                    else:
+                        step.append(names[arg1])
+                elif step[0] in ('choose', 'chooseleaf'):
+                    step.extend([str(arg1), 'type', types[arg2]])
+                elif step[0].startswith('set_'):
+                    step.append(str(arg1))
+                elif step[0] == 'noop':
+                    continue
+                rule['step'].append(step)
+            self.rules[info['name']] = rule
+
+        for key, args in c['choose_args'].items():
+            self.choose_args[key] = []
+            for index, (weight_sets, ids) in sorted(args.items()):
+                arg = OrderedDict(bucket_id=-1 - index)
+                if weight_sets:
+                    arg['weight_set'] = [[wt / 65536.0 for wt in weights]
+                                         for weights in weight_sets]
+                if ids:
+                    arg['ids'] = ids
+                self.choose_args[key].append(arg)
+
+    def encode(self):
+        """The map compiled, as `crushtool -c` would"""
+        return crushbin.encode(crushbin.compile_map(self))
+
+    def _use_id(self, id):
+        if id <= self._next_id:
+            self._next_id = id - 1
 
     def new_id(self):
-        id = min(self._ids) - 1
-        self._ids.add(id)
+        id = self._next_id
+        self._next_id -= 1
         return id
 
+    def new_bucket(self, kind, name, alg='straw', hash='0'):
+        if name in self.buckets:
+            raise ValueError("bucket %s already exists" % name)
+        bucket = self.buckets[name] = Bucket(name, kind, self.new_id(),
+                                             alg, hash)
+        return bucket
+
+    def ordered_buckets(self):
+        """Buckets, each one after the buckets it holds"""
+        done = set()
+        ordered = []
+        for name in self.buckets:
+            stack = [(name, False)]
+            while stack:
+                name, expanded = stack.pop()
+                if name in done:
+                    continue
+                if expanded:
+                    done.add(name)
+                    ordered.append(self.buckets[name])
+                    continue
+                stack.append((name, True))
+                for item in reversed(self.buckets[name].items):
+                    if item in self.buckets:
+                        stack.append((item, False))
+        return ordered
+
+    def parent(self, item):
+        return self.parents.get(item)
+
+    def add_item(self, bucket, item, weight=None):
+        self.buckets[bucket].items[item] = weight
+        self.parents.setdefault(item, bucket)
+
+    def remove_item(self, bucket, item):
+        """Remove `item` from `bucket`, returns its weight"""
+        weight = self.buckets[bucket].items.pop(item)
+        self.buckets[bucket].pos.pop(item, None)
+        if self.parents.get(item) == bucket:
+            del self.parents[item]
+        return weight
+
+    def move_item(self, item, bucket):
+        """Move `item` from the bucket it is in to `bucket`"""
+        weight = self.remove_item(self.parents[item], item)
+        self.add_item(bucket, item, weight)
+
     def pprint(self, stream=sys.stdout):
+        # same layout as `crushtool -d`
+        self._weight_text.clear()
         stream.write("# begin crush map\n")
-        for k, v in sorted(self.tunables.items(), key=(lambda it: it[0])):
+        for k, v in self.tunables.items():
             stream.write("tunable %s %s\n" % (k, v))
         stream.write('\n')
 
         stream.write("# devices\n")
-        for k, v in sorted(self.devices.items(), key=(lambda it: int(it[0]))):
-            stream.write("device %s %s\n" % (k, v))
+        for k, v in sorted(self.devices.items()):
+            if v in self.classes:
+                stream.write("device %d %s class %s\n"
+                             % (k, v, self.classes[v]))
+            else:
+                stream.write("device %d %s\n" % (k, v))
         stream.write('\n')
 
         stream.write("# types\n")
-        for k, v in sorted(self.types.items(), key=(lambda it: int(it[0]))):
-            stream.write("type %s %s\n" % (k, v))
+        for k, v in sorted(self.types.items()):
+            stream.write("type %d %s\n" % (k, v))
         stream.write('\n')
 
         stream.write("# buckets\n")
-        for k, v in reversed(self.hosts.items()):
-            self._pprint_host_or_root("host", stream, k, v)
-            stream.write('\n')
+        # buckets must be defined before they are used as items
+        for bucket in self.ordered_buckets():
+            self._pprint_bucket(stream, bucket)
         stream.write('\n')
 
-        for k, v in sorted(self.roots.items(), key=(lambda it: -it[1]['id'])):
-            self._pprint_host_or_root("root", stream, k, v)
-            stream.write('\n')
-
         stream.write("# rules\n")
         for k, v in self.rules.items():
             self._pprint_rule(stream, k, v)
+        stream.write('\n')
+
+        if self.choose_args:
+            stream.write("# choose_args\n")
+            for k, v in self.choose_args.items():
+                self._pprint_choose_args(stream, k, v)
             stream.write('\n')
 
         stream.write("# end crush map\n")
 
-    def _pprint_host_or_root(self, kind, stream, name, data):
-        stream.write("%s %s {\n" % (kind, name))
-        #stream.write("  id %d\n" % (data['id'],))
-        for k, v in data.items():
-            if 'item' == k:
-                continue
-            stream.write("\t%s %s\n" % (k, v))
-        for k, v in data['item'].items():
-            stream.write('\titem %s weight %s\n' % (k, v))
+    def format_weight(self, weight):
+        """`weight` with `precision` decimals, or with more if needed
+        to compile it to the same 16.16 fixed point value"""
+        text = self._weight_text.get(weight)
+        if text is None:
+            fixed = crushbin.fixed_weight(weight)
+            for digits in range(self.precision, 17):
+                text = '%.*f' % (digits, weight)
+                if crushbin.fixed_weight(float(text)) == fixed:
+                    break
+            self._weight_text[weight] = text
+        return text
+
+    def _pprint_bucket(self, stream, bucket):
+        stream.write("%s %s {\n" % (bucket.type, bucket.name))
+        if bucket.id is not None:
+            stream.write("\tid %d\t\t# do not change unnecessarily\n"
+                         % bucket.id)
+        for k, v in bucket.class_ids:
+            stream.write("\tid %d class %s\t\t# do not change unnecessarily\n"
+                         % (v, k))
+        # crushtool adds up weights in 16.16 fixed point
+        stream.write("\t# weight %.*f\n" % (self.precision, sum(
+            crushbin.fixed_weight(wt) for wt in bucket.items.values()
+            if wt is not None) / float(0x10000)))
+        stream.write("\talg %s\n" % bucket.alg)
+        if bucket.hash == '0':
+            stream.write("\thash 0\t# rjenkins1\n")
+        else:
+            stream.write("\thash %s\n" % bucket.hash)
+        for k, v in bucket.items.items():
+            stream.write("\titem %s" % k)
+            if v is not None:
+                stream.write(" weight %s" % self.format_weight(v))
+            if k in bucket.pos:
+                stream.write(" pos %d" % bucket.pos[k])
+            stream.write("\n")
         stream.write('}\n')
 
     def _pprint_rule(self, stream, name, data):
         stream.write("rule %s {\n" % (name,))
         for k, v in data.items():
-            if 'step' == k:
+            if k in ('#name', 'step'):
                 continue
             stream.write("\t%s %s\n" % (k, v))
-        for k, v in data['step'].items():
-            stream.write('\tstep %s %s\n' % (k, v))
+        for step in data['step']:
+            stream.write('\tstep %s\n' % str.join(' ', step))
         stream.write('}\n')
 
+    def _pprint_choose_args(self, stream, id, args):
+        stream.write("choose_args %d {\n" % id)
+        for data in args:
+            stream.write("  {\n")
+            for k, v in data.items():
+                if 'bucket_id' == k:
+                    stream.write("    bucket_id %d\n" % v)
+                elif 'weight_set' == k:
+                    stream.write("    weight_set [\n")
+                    for weights in v:
+                        stream.write("      [ %s ]\n" % str.join(
+                            ' ', [self.format_weight(wt) for wt in weights]))
+                    stream.write("    ]\n")
+                elif 'ids' == k:
+                    stream.write("    ids [ %s ]\n"
+                                 % str.join(' ', [str(id) for id in v]))
+            stream.write("  }\n")
+        stream.write("}\n")
+
+
+class _Tokens(object):
+    _COMMENT = re.compile(r'#[^\n]*')
+
+    def __init__(self, text):
+        # words, braces and brackets, once comments have been removed
+        text = self._COMMENT.sub('', text)
+        for char in '{}[]':
+            text = text.replace(char, ' %s ' % char)
+        self._text = text
+        self.tokens = text.split()
+        self.pos = 0
+
+    def __nonzero__(self):
+        return self.pos < len(self.tokens)
+
+    def peek(self):
+        if self.pos >= len(self.tokens):
+            self.error("unexpected end of input")
+        return self.tokens[self.pos]
 
-class _PartsIterator(object):
-    def __init__(self, stream):
-        self._stream = stream
-    def __iter__(self):
-        return self
     def next(self):
-        # advance to next non-blank and non-comment line
-        line = ''
-        while line == '' or line.startswith('#'):
-            line = self._stream.next()
-            line = line.strip()
-        parts = line.split()
-        return parts
-
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def next_int(self):
+        token = self.peek()
+        try:
+            value = int(token)
+        except ValueError:
+            self.error("expected an integer, got %r" % token)
+        self.pos += 1
+        return value
+
+    def next_float(self):
+        token = self.peek()
+        try:
+            value = float(token)
+        except ValueError:
+            self.error("expected a number, got %r" % token)
+        self.pos += 1
+        return value
+
+    def accept(self, token):
+        if self.pos < len(self.tokens) and self.tokens[self.pos] == token:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, token):
+        if not self.accept(token):
+            self.error("expected %r, got %r" % (
+                token, self.tokens[self.pos] if self else 'end of input'))
+
+    def list_until(self, end, convert):
+        values = []
+        while not self.accept(end):
+            values.append(convert(self.next()))
+        return values
+
+    def error(self, message):
+        # only needed on errors: find the line of the current token
+        count = 0
+        for line, text in enumerate(self._text.split('\n'), 1):
+            count += len(text.split())
+            if count > self.pos:
+                break
+        raise ValueError("line %d: %s" % (line, message))
+
+
+# `crushtool -d` of Mimic and later: weights with 5 decimals
+MIMIC_MAP = """\
+# begin crush map
+tunable choose_local_tries 0
+tunable choose_local_fallback_tries 0
+tunable choose_total_tries 50
+tunable chooseleaf_descend_once 1
+tunable chooseleaf_vary_r 1
+tunable chooseleaf_stable 1
+tunable straw_calc_version 1
+tunable allowed_bucket_algs 54
+
+# devices
+device 0 osd.0 class hdd
+device 1 osd.1 class hdd
+device 2 osd.2 class ssd
+device 3 osd.3 class hdd
+device 4 osd.4 class hdd
+device 5 osd.5 class ssd
+
+# types
+type 0 osd
+type 1 host
+type 2 chassis
+type 3 rack
+type 4 row
+type 5 pdu
+type 6 pod
+type 7 room
+type 8 datacenter
+type 9 zone
+type 10 region
+type 11 root
+
+# buckets
+host node1 {
+	id -3		# do not change unnecessarily
+	id -4 class hdd		# do not change unnecessarily
+	id -5 class ssd		# do not change unnecessarily
+	# weight 4.51178
+	alg straw2
+	hash 0	# rjenkins1
+	item osd.0 weight 1.81940
+	item osd.1 weight 1.81940
+	item osd.2 weight 0.87299
+}
+host node2 {
+	id -6		# do not change unnecessarily
+	id -7 class hdd		# do not change unnecessarily
+	id -8 class ssd		# do not change unnecessarily
+	# weight 4.51178
+	alg straw2
+	hash 0	# rjenkins1
+	item osd.3 weight 1.81940
+	item osd.4 weight 1.81940
+	item osd.5 weight 0.87299
+}
+root default {
+	id -1		# do not change unnecessarily
+	id -2 class hdd		# do not change unnecessarily
+	id -9 class ssd		# do not change unnecessarily
+	# weight 9.02356
+	alg straw2
+	hash 0	# rjenkins1
+	item node1 weight 4.51178
+	item node2 weight 4.51178
+}
+
+# rules
+rule replicated_rule {
+	id 0
+	type replicated
+	min_size 1
+	max_size 10
+	step take default class hdd
+	step chooseleaf firstn 0 type host
+	step emit
+}
+
+# choose_args
+choose_args 1 {
+  {
+    bucket_id -1
+    weight_set [
+      [ 4.51178 1.15967 ]
+    ]
+  }
+}
+
+# end crush map
+"""
+
+
+# `crushtool -d` of Luminous: weights with 3 decimals
+LUMINOUS_MAP = """\
+# begin crush map
+tunable choose_local_tries 0
+tunable choose_local_fallback_tries 0
+tunable choose_total_tries 50
+tunable chooseleaf_descend_once 1
+tunable chooseleaf_vary_r 1
+tunable chooseleaf_stable 1
+tunable straw_calc_version 1
+tunable allowed_bucket_algs 54
+
+# devices
+device 0 osd.0 class hdd
+device 1 osd.1 class hdd
+device 2 osd.2 class ssd
+
+# types
+type 0 osd
+type 1 host
+type 2 root
+
+# buckets
+host node1 {
+	id -2		# do not change unnecessarily
+	id -3 class hdd		# do not change unnecessarily
+	id -4 class ssd		# do not change unnecessarily
+	# weight 4.511
+	alg straw2
+	hash 0	# rjenkins1
+	item osd.0 weight 1.819
+	item osd.1 weight 1.819
+	item osd.2 weight 0.873
+}
+root default {
+	id -1		# do not change unnecessarily
+	id -5 class hdd		# do not change unnecessarily
+	id -6 class ssd		# do not change unnecessarily
+	# weight 4.511
+	alg straw2
+	hash 0	# rjenkins1
+	item node1 weight 4.511
+}
+
+# rules
+rule replicated_rule {
+	id 0
+	type replicated
+	min_size 1
+	max_size 10
+	step take default
+	step chooseleaf firstn 0 type host
+	step emit
+}
+
+# end crush map
+"""
+
+
+class TestCase(unittest.TestCase):
+    def roundtrip(self, text):
+        m = CrushMap()
+        m.parse(io.BytesIO(text))
+        output = io.BytesIO()
+        m.pprint(output)
+        return m, output.getvalue()
+
+    def test_roundtrip(self):
+        m, text = self.roundtrip(MIMIC_MAP)
+        self.assertEqual(text, MIMIC_MAP)
+        self.assertEqual(m.precision, 5)
+
+    def test_roundtrip_luminous(self):
+        m, text = self.roundtrip(LUMINOUS_MAP)
+        self.assertEqual(text, LUMINOUS_MAP)
+        self.assertEqual(m.precision, 3)
+
+    def test_roundtrip_compiled(self):
+        m = CrushMap()
+        m.parse(io.BytesIO(MIMIC_MAP))
+        decoded = CrushMap()
+        decoded.decode(m.encode())
+        output = io.BytesIO()
+        decoded.pprint(output)
+        self.assertEqual(output.getvalue(), MIMIC_MAP)
+
+    def test_format_weight(self):
+        m = CrushMap()
+        m.precision = 3
+        self.assertEqual(m.format_weight(1.819), '1.819')
+        # 1.819 would compile to 119209, not to 119236
+        self.assertEqual(m.format_weight(119236 / 65536.0), '1.8194')
+        for fixed in range(0, 0x10000 * 4, 997):
+            text = m.format_weight(fixed / 65536.0)
+            self.assertEqual(crushbin.fixed_weight(float(text)), fixed)
+
+
+    def test_split_twice(self):
+        m = split_hdd_and_ssd(self.roundtrip(MIMIC_MAP)[0])
+        split = io.BytesIO()
+        m.pprint(split)
+        self.assertIn("host node1-ssd {", split.getvalue())
+        self.assertEqual(m.rules['ssd']['id'], 1)
+        self.assertNotIn('ruleset', m.rules['ssd'])
+        # splitting the split map reuses its hosts, roots and rules
+        m = split_hdd_and_ssd(self.roundtrip(split.getvalue())[0])
+        output = io.BytesIO()
+        m.pprint(output)
+        self.assertEqual(output.getvalue(), split.getvalue())
+
+    def test_split_ruleset(self):
+        # rules of maps older than Luminous only have a ruleset
+        text = LUMINOUS_MAP.replace('\tid 0\n', '\truleset 3\n')
+        m = split_hdd_and_ssd(self.roundtrip(text)[0])
+        self.assertEqual(m.rules['ssd']['ruleset'], 4)
+        self.assertNotIn('id', m.rules['ssd'])
+
+    def test_split_conflict(self):
+        m = self.roundtrip(MIMIC_MAP)[0]
+        m.new_bucket('host', 'ssdroot')
+        with self.assertRaisesRegexp(ValueError, 'ssdroot is a host'):
+            split_hdd_and_ssd(m)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,605 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2015, S3IT, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+"""
+Answer lineage questions about RBD images out of a persistent index.
+
+The index is built once from a crawl of the pool (or from a crawl
+saved with `--save-crawl` by rbd-image-tree or
+cleanup-deleted-os-images.py) and saved to a file. Then, without
+crawling the cluster again:
+
+ancestors IMAGE...
+    list the snapshots IMAGE has been cloned from, up to the root of
+    its tree
+descendants IMAGE...
+    list all the images cloned, directly or not, from IMAGE (or from
+    a snapshot of it, with `IMAGE@SNAP`)
+safe-to-delete IMAGE...
+    tell whether IMAGE can be deleted together with all its
+    descendants, i.e. whether all of them have been deleted by glance
+    (`*_to_be_deleted_by_glance`), like cleanup-deleted-os-images.py
+    does
+
+Images are given as `POOL/NAME`, or just `NAME` for images of POOL.
+
+The index is kept up to date with:
+
+update
+    list the crawled pools again, drop the images which are gone and
+    add the new ones (including images renamed by glance)
+update IMAGE...
+    query the given images again, e.g. after new clones have been
+    created in a pool which is not crawled, or an image was flattened
+
+Each tree of images is labelled with the pre-order position of every
+image and of the last of its descendants, so that the descendants of
+an image are a contiguous range of positions. Answering a query does
+not depend on the size of the pool, and after an update only the
+trees which have changed are labelled again.
+"""
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+import argparse
+import cPickle as pickle
+import gc
+from multiprocessing.pool import ThreadPool
+import logging
+import os
+import sys
+import unittest
+
+import rados
+import rbd
+
+import rbdgraph
+from rbdgraph import DELETE_SUFFIX, qualified_name
+
+log = logging.getLogger()
+log.addHandler(logging.StreamHandler())
+
+INDEX_VERSION = 1
+
+
+class TestCase(unittest.TestCase):
+    def _cluster(self, seed):
+        import fakeceph
+        cluster = fakeceph.FakeCluster()
+        cluster.populate('cinder', 400, depth=4, fanout=2, deleted=0.5,
+                         seed=seed)
+        return cluster
+
+    def _crawl(self, cluster, jobs=1):
+        with cluster.patch(globals()), cluster.patch(vars(rbdgraph)):
+            index = build_index(rados.Rados(), ['cinder'], jobs=jobs)
+        return index
+
+    def _expected(self, index):
+        """Ancestors, descendants and safe images, the slow way"""
+        import networkx as nx
+        graph = nx.DiGraph()
+        for key in index:
+            graph.add_node(key)
+            parent = index.parent(key)
+            if parent and parent[:2] in index:
+                graph.add_edge(parent[:2], key)
+        deletable = set(key for key in graph
+                        if all(name.endswith(DELETE_SUFFIX)
+                               for pool, name in
+                               nx.descendants(graph, key) | set([key])))
+        return dict((key, (set(nx.ancestors(graph, key)),
+                           set(nx.descendants(graph, key)),
+                           key in deletable))
+                    for key in graph)
+
+    def _check(self, index):
+        expected = self._expected(index)
+        self.assertTrue(any(safe for a, d, safe in expected.values()))
+        for key, (ancestors, descendants, safe) in expected.items():
+            self.assertEqual(set(a[:2] for a in index.ancestors(key)),
+                             ancestors)
+            self.assertEqual(set(index.descendants(key)), descendants)
+            self.assertEqual(not index.blockers(key), safe)
+            for other in list(ancestors)[:3] + list(descendants)[:3]:
+                self.assertEqual(index.is_ancestor(other, key),
+                                 other in ancestors)
+
+    def test_queries(self):
+        index = self._crawl(self._cluster(1), jobs=4)
+        self.assertEqual(len(index), 400)
+        self._check(index)
+        # snapshots of an image split its descendants
+        key = next(key for key in index if len(index.descendants(key)) > 4)
+        snaps = [snap for snap, protected in index.snapshots(key)]
+        self.assertEqual(
+            sorted(sum([index.descendants(key, snap) for snap in snaps], [])),
+            sorted(index.descendants(key)))
+
+    def test_incremental_update(self):
+        import shutil
+        import tempfile
+        cluster = self._cluster(2)
+        index = self._crawl(cluster)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'index')
+            save_index(path, index)
+            index = load_index(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        # a deleted leaf, a new clone and a tree deleted by glance
+        leaf = next(key for key in index if not index.snapshots(key))
+        parent = next(key for key in index if index.snapshots(key)
+                      and not index.is_ancestor(key, leaf))
+        cluster.remove('cinder', leaf[1])
+        snap = index.snapshots(parent)[0][0]
+        cluster.clone('cinder', parent[1], snap, 'cinder', 'volume-new')
+        for key in [parent, ('cinder', 'volume-new')] + \
+                index.descendants(parent):
+            if not key[1].endswith(DELETE_SUFFIX):
+                cluster.rename('cinder', key[1], key[1] + DELETE_SUFFIX)
+        with cluster.patch(globals()), cluster.patch(vars(rbdgraph)):
+            update_index(index, rados.Rados(), jobs=2)
+        self.assertFalse(leaf in index)
+        self.assertTrue(('cinder', 'volume-new' + DELETE_SUFFIX) in index)
+        if not parent[1].endswith(DELETE_SUFFIX):
+            parent = ('cinder', parent[1] + DELETE_SUFFIX)
+        self.assertFalse(index.blockers(parent))
+        fresh = self._crawl(cluster)
+        self.assertEqual(sorted(index), sorted(fresh))
+        for key in fresh:
+            self.assertEqual(index.descendants(key), fresh.descendants(key))
+        self._check(index)
+
+
+class LineageIndex(object):
+    """Ancestors and descendants of RBD images
+
+    Images are identified by (pool, name) pairs. The index is filled
+    with the `rbdgraph.ImageInfo` of the images; clones listed by an
+    image but which have not been crawled (e.g. because they are in a
+    different pool) are indexed too, as images whose snapshots are not
+    known.
+
+    Every tree is labelled with the position of its images in a
+    pre-order visit, clones grouped by snapshot, and the position of
+    the last descendant of every image. Changes to the index mark the
+    affected trees, which are labelled again by the next query.
+    """
+
+    def __init__(self, pools=()):
+        # pools which have been crawled
+        self.pools = list(pools)
+        # key -> (pool, name, snapshot) of its parent, or None
+        self._parent = {}
+        # key -> list of (snapshot, protected), None if not crawled
+        self._snapshots = {}
+        # key -> set of (snapshot, clone key), also for keys which are
+        # not indexed (yet)
+        self._children = {}
+        # key -> (root key, first position, last position)
+        self._labels = {}
+        # root key -> (keys in pre-order, number of images not deleted
+        # by glance before each position)
+        self._trees = {}
+        self._dirty = set()
+
+    def __len__(self):
+        return len(self._parent)
+
+    def __contains__(self, key):
+        return key in self._parent
+
+    def __iter__(self):
+        return iter(self._parent)
+
+    def add(self, info):
+        """Add or replace the image described by `info`"""
+        key = (info.pool, info.name)
+        self._set_parent(key, info.parent)
+        self._snapshots[key] = list(info.snapshots)
+        # clones already indexed become part of the tree of this image
+        for snapshot, child in self._children.get(key, ()):
+            self._dirty.add(child)
+        for snapshot, protected in info.snapshots:
+            for child in info.children.get(snapshot, []):
+                child = tuple(child)
+                if child not in self._parent:
+                    self._snapshots[child] = None
+                self._set_parent(child, key + (snapshot,))
+
+    def remove(self, key):
+        """Remove image `key`; its clones, if any, become roots"""
+        if key not in self._parent:
+            return
+        self._set_parent(key, None)
+        del self._parent[key]
+        del self._snapshots[key]
+        self._dirty.discard(key)
+        self._labels.pop(key, None)
+        self._trees.pop(key, None)
+        for snapshot, child in self._children.get(key, ()):
+            self._dirty.add(child)
+
+    def _set_parent(self, key, parent):
+        old = self._parent.get(key)
+        if key in self._labels:
+            self._dirty.add(self._labels[key][0])
+        if old is not None:
+            self._children[old[:2]].discard((old[2], key))
+            if not self._children[old[:2]]:
+                del self._children[old[:2]]
+        if parent is not None:
+            parent = tuple(parent)
+            self._children.setdefault(parent[:2], set()).add((parent[2], key))
+        self._parent[key] = parent
+        self._dirty.add(key)
+
+    def _root(self, key):
+        while True:
+            parent = self._parent[key]
+            if parent is None or parent[:2] not in self._parent:
+                return key
+            key = parent[:2]
+
+    def _clones(self, key, snapshot=None):
+        return sorted((snap, child)
+                      for snap, child in self._children.get(key, ())
+                      if child in self._parent
+                      and (snapshot is None or snap == snapshot))
+
+    def _relabel(self):
+        roots = set()
+        for key in self._dirty:
+            if key in self._parent:
+                roots.add(self._root(key))
+            else:
+                self._trees.pop(key, None)
+        self._dirty.clear()
+        for root in roots:
+            order = []
+            kept = [0]
+            first = {}
+            stack = [root]
+            while stack:
+                key = stack.pop()
+                first[key] = len(order)
+                order.append(key)
+                kept.append(kept[-1] + (not key[1].endswith(DELETE_SUFFIX)))
+                stack.extend(child for snap, child
+                             in reversed(self._clones(key)))
+            # the last descendant of an image is the one before the
+            # next image which is not a descendant of it
+            last = {}
+            for key in reversed(order):
+                clones = self._clones(key)
+                last[key] = last[clones[-1][1]] if clones else first[key]
+            for key in order:
+                old = self._labels.get(key)
+                if old is not None and old[0] != root:
+                    self._trees.pop(old[0], None)
+                self._labels[key] = (root, first[key], last[key])
+            self._trees[root] = (order, kept)
+
+    def _label(self, key):
+        if key not in self._parent:
+            raise KeyError("Image %s is not indexed" % qualified_name(*key))
+        if self._dirty:
+            self._relabel()
+        return self._labels[key]
+
+    def parent(self, key):
+        """(pool, name, snapshot) of the parent of `key`, or None"""
+        return self._parent[key]
+
+    def snapshots(self, key):
+        """List of (snapshot, protected) of `key`, None if not crawled"""
+        return self._snapshots[key]
+
+    def ancestors(self, key):
+        """Returns the (pool, name, snapshot) of the ancestors of `key`
+
+        The parent comes first. Parents which are not indexed are
+        included, but their own parents are not known.
+        """
+        self._label(key)
+        ancestors = []
+        parent = self._parent[key]
+        while parent is not None:
+            ancestors.append(parent)
+            if parent[:2] not in self._parent:
+                break
+            parent = self._parent[parent[:2]]
+        return ancestors
+
+    def descendants(self, key, snapshot=None):
+        """Returns the keys of the descendants of `key`, in pre-order
+
+        If `snapshot` is given, only the descendants of the clones of
+        that snapshot are returned.
+        """
+        root, first, last = self._label(key)
+        order = self._trees[root][0]
+        if snapshot is None:
+            return order[first + 1:last + 1]
+        clones = self._clones(key, snapshot)
+        if not clones:
+            return []
+        return order[self._labels[clones[0][1]][1]:
+                     self._labels[clones[-1][1]][2] + 1]
+
+    def is_ancestor(self, key, other):
+        """Whether `other` has been cloned, directly or not, from `key`"""
+        root, first, last = self._label(key)
+        other_root, other_first, other_last = self._label(other)
+        return root == other_root and first < other_first <= last
+
+    def blockers(self, key):
+        """Returns `key` and its descendants not deleted by glance
+
+        If the list is empty, `key` can be deleted together with all
+        its descendants. The images are only listed when there are
+        any, so checking is as quick as labels are.
+        """
+        root, first, last = self._label(key)
+        order, kept = self._trees[root]
+        if kept[last + 1] == kept[first]:
+            return []
+        return [order[i] for i in xrange(first, last + 1)
+                if kept[i + 1] > kept[i]]
+
+    def state(self):
+        """Returns the content of the index, labels included"""
+        if self._dirty:
+            self._relabel()
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls()
+        index.__dict__.update(state)
+        return index
+
+
+def load_index(path):
+    """Returns the `LineageIndex` stored in `path`, or None"""
+    # the index is made of millions of small objects, which the garbage
+    # collector would scan over and over while they are loaded
+    gc.disable()
+    try:
+        with open(path, 'rb') as fd:
+            data = pickle.load(fd)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return None
+    finally:
+        gc.enable()
+    if data.get('version') != INDEX_VERSION:
+        log.warning("Ignoring index %s: written by a different version",
+                    path)
+        return None
+    return LineageIndex.from_state(data['index'])
+
+
+def save_index(path, index):
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as fd:
+        pickle.dump({'version': INDEX_VERSION, 'index': index.state()}, fd,
+                    pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp, path)
+
+
+def index_infos(infos, pools):
+    """Returns the `LineageIndex` of `infos`, a crawl of `pools`"""
+    index = LineageIndex(pools)
+    for info in infos:
+        index.add(info)
+    return index
+
+
+def build_index(cluster, pools, jobs=1, max_open=128, record=None):
+    """Crawl all the images of `pools` and returns their `LineageIndex`
+
+    Only parents and clones in `pools` are followed. If `record` is
+    given, the crawl is also written to it, cfr. `rbdgraph.record_crawl`.
+    """
+    ioctxs = rbdgraph.IoctxPool(cluster)
+    images = rbdgraph.ImageCache(ioctxs, max_open)
+    try:
+        roots = [(pool, name) for pool in pools
+                 for name in rbd.RBD().list(ioctxs.get(pool))]
+        infos = rbdgraph.crawl(images, roots, lambda pool: pool in pools,
+                               jobs)
+        if record is not None:
+            infos = rbdgraph.record_crawl(infos, record)
+        return index_infos(infos, pools)
+    finally:
+        images.close()
+        ioctxs.close()
+
+
+def update_index(index, cluster, keys=None, jobs=1, max_open=128):
+    """Update `index` with the changes of the cluster
+
+    If `keys` is None, the crawled pools are listed: images which are
+    gone are removed, and new images are queried and added. Otherwise
+    only the images `keys` are queried again, and removed if they do
+    not exist anymore. Returns the number of images added or updated
+    and the number of images removed.
+    """
+    ioctxs = rbdgraph.IoctxPool(cluster)
+    images = rbdgraph.ImageCache(ioctxs, max_open)
+    removed = []
+    if keys is None:
+        keys = []
+        for pool in index.pools:
+            names = set(rbd.RBD().list(ioctxs.get(pool)))
+            known = set(key[1] for key in index
+                        if key[0] == pool and index.snapshots(key) is not None)
+            removed.extend((pool, name) for name in known - names)
+            keys.extend((pool, name) for name in sorted(names - known))
+    # images renamed by glance are removed first, so that their clones
+    # are moved under the new name when it is added
+    for key in removed:
+        index.remove(key)
+
+    def query(key):
+        try:
+            return rbdgraph.query_image(images, key)
+        except rbd.ImageNotFound:
+            return None
+
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    try:
+        infos = pool.map(query, keys) if pool else map(query, keys)
+    finally:
+        images.close()
+        ioctxs.close()
+        if pool:
+            pool.terminate()
+            pool.join()
+    updated = 0
+    for key, info in zip(keys, infos):
+        if info is None:
+            index.remove(key)
+            removed.append(key)
+        else:
+            index.add(info)
+            updated += 1
+    return updated, len(removed)
+
+
+def parse_image(value, pool):
+    """Returns the (pool, name) of `value`, like ``POOL/NAME`` or ``NAME``"""
+    if '/' in value:
+        return tuple(value.split('/', 1))
+    return (pool, value)
+
+
+if __name__ == "__main__":
+    if '--run-tests' in sys.argv:
+        sys.argv = [sys.argv[0]]
+        unittest.main()
+
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command',
+                        choices=['build', 'update', 'ancestors',
+                                 'descendants', 'safe-to-delete'])
+    parser.add_argument('images', nargs='*', metavar='IMAGE',
+                        help="Images to query, as POOL/NAME or NAME, "
+                        "optionally followed by @SNAPSHOT for descendants")
+    parser.add_argument('-i', '--index', metavar='FILE',
+                        default='rbd-lineage.index',
+                        help="Index file. Default: %(default)s")
+    parser.add_argument('-p', '--pool', action='append', dest='pools',
+                        help="Pools to crawl with build, can be repeated. "
+                        "Default: cinder")
+    parser.add_argument('--id', '--user', dest='user', default='admin',
+                        help="Ceph user to use. Default: %(default)s")
+    parser.add_argument('-c', '--config',
+                        default='/etc/ceph/ceph.conf',
+                        help="Ceph configuration file. Default: %(default)s")
+    parser.add_argument('-j', '--jobs', metavar='N', type=int, default=1,
+                        help="Number of images queried concurrently. "
+                        "Default: %(default)s")
+    parser.add_argument('--save-crawl', metavar='FILE',
+                        help="With build, also save the crawled images to "
+                        "FILE, as rbd-image-tree --save-crawl does")
+    parser.add_argument('--load-crawl', metavar='FILE',
+                        help="With build, do not connect to the cluster, "
+                        "but index the images saved to FILE with "
+                        "--save-crawl")
+    parser.add_argument('--run-tests', action='store_true', help='Run tests')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Increase verbosity')
+    opts = parser.parse_args()
+    opts.pools = opts.pools or ['cinder']
+    if opts.command in ('ancestors', 'descendants', 'safe-to-delete') \
+       and not opts.images:
+        parser.error("%s needs at least one IMAGE" % opts.command)
+    if (opts.save_crawl or opts.load_crawl) and opts.command != 'build':
+        parser.error("--save-crawl and --load-crawl only work with build")
+
+    # Set verbosity
+    verbosity = max(0, 3-opts.verbose) * 10
+    log.setLevel(verbosity)
+
+    def connect():
+        cluster = rados.Rados(conffile=opts.config, rados_id=opts.user)
+        cluster.connect()
+        return cluster
+
+    if opts.command == 'build':
+        if opts.load_crawl:
+            with open(opts.load_crawl) as fd:
+                index = index_infos(rbdgraph.read_crawl(fd), opts.pools)
+        else:
+            record = open(opts.save_crawl, 'w') if opts.save_crawl else None
+            try:
+                index = build_index(connect(), opts.pools, opts.jobs,
+                                    record=record)
+            finally:
+                if record:
+                    record.close()
+        save_index(opts.index, index)
+        print("Indexed %d images to %s" % (len(index), opts.index))
+        sys.exit(0)
+
+    index = load_index(opts.index)
+    if index is None:
+        parser.error("No index in %s, create it with build" % opts.index)
+    if opts.command == 'update':
+        keys = [parse_image(image, index.pools[0])
+                for image in opts.images] or None
+        updated, removed = update_index(index, connect(), keys, opts.jobs)
+        save_index(opts.index, index)
+        print("%d images updated, %d removed" % (updated, removed))
+        sys.exit(0)
+
+    unsafe = False
+    for image in opts.images:
+        image, _, snapshot = image.partition('@')
+        key = parse_image(image, index.pools[0])
+        if key not in index:
+            print("%s: not indexed" % qualified_name(*key))
+            unsafe = True
+            continue
+        if opts.command == 'ancestors':
+            for parent in index.ancestors(key):
+                print(qualified_name(*parent))
+        elif opts.command == 'descendants':
+            for child in index.descendants(key, snapshot or None):
+                print(qualified_name(*child))
+        else:
+            blockers = index.blockers(key)
+            if blockers:
+                unsafe = True
+                print("%s: not safe to delete, %d images are not deleted "
+                      "by glance: %s" % (
+                          qualified_name(*key), len(blockers),
+                          str.join(' ', [qualified_name(*b)
+                                         for b in blockers[:10]])
+                          + (' ...' if len(blockers) > 10 else '')))
+            else:
+                print("%s: safe to delete, with %d descendants" % (
+                    qualified_name(*key), len(index.descendants(key))))
+    sys.exit(1 if unsafe else 0)
@@ -0,0 +1,542 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-#
+#
+#
+# Copyright (C) 2015, S3IT, University of Zurich. All rights reserved.
+#
+#
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+"""
+Crawl the clone trees of RBD images.
+
+This module is shared by `rbd-image-tree` and
+`cleanup-deleted-os-images.py`. The result of a crawl is a sequence of
+`ImageInfo` records, one for each image, holding everything the tools
+need: size, features, snapshots (and whether they are protected), the
+clones of each snapshot and the parent of the image. Records can be
+turned into the nodes and edges of any graph object with `add_image`
+(`pgv.AGraph`, `networkx.DiGraph` or any object with the same
+`add_node`/`add_edge` methods), and saved to or loaded from a file
+with `record_crawl` and `read_crawl`, so that one crawl can feed
+several tools::
+
+    ioctxs = IoctxPool(cluster)
+    images = ImageCache(ioctxs)
+    roots = [('cinder', name) for name in rbd.RBD().list(ioctxs.get('cinder'))]
+    with open('crawl.jsonl', 'w') as stream:
+        for info in record_crawl(crawl(images, roots, jobs=8), stream):
+            add_image(graph, info)
+    images.close()
+
+Images are identified by (pool, name) pairs.
+"""
+__docformat__ = 'reStructuredText'
+__author__ = 'Antonio Messina <antonio.s.messina@gmail.com>'
+
+from collections import Counter, OrderedDict, namedtuple
+from multiprocessing.pool import ThreadPool
+import json
+import logging
+import re
+import threading
+import unittest
+
+import rbd
+
+log = logging.getLogger(__name__)
+
+DELETE_SUFFIX = '_to_be_deleted_by_glance'
+
+uuid_re = '[0-9a-z]{8}-[0-9a-z]{4}-[0-9a-z]{4}-[0-9a-z]{4}-[0-9a-z]{12}'
+
+re_image = re.compile('^(?P<uuid>%s)$' % uuid_re)
+re_vol = re.compile('^volume-(?P<uuid>%s)' % uuid_re)
+re_ephemeral = re.compile('^(?P<uuid>%s)_disk' % uuid_re)
+re_image_snapshot = re.compile('^(?P<uuid>%s)_disk_clone_[0-9a-z]{32}' % uuid_re)
+
+ImageInfo = namedtuple('ImageInfo', [
+    'pool', 'name', 'size', 'features',
+    # list of (snapshot, protected)
+    'snapshots',
+    # snapshot -> list of (pool, name) of its clones
+    'children',
+    # (pool, name, snapshot) or None
+    'parent',
+])
+
+
+def attrs_by_name(name):
+    """Guess what image `name` is from its name"""
+    attrs = {}
+    if name.endswith(DELETE_SUFFIX):
+        attrs['to_be_deleted_by_glance'] = True
+        name = name[:-len(DELETE_SUFFIX)]
+    else:
+        attrs['to_be_deleted_by_glance'] = False
+    for attr, regexp in [
+            ('image', re_image),
+            ('volume', re_vol),
+            ('instance', re_ephemeral),
+            ('image_snapshot', re_image_snapshot),
+            ]:
+        attrs[attr] = True if regexp.match(name) else False
+    if attrs['image_snapshot']:
+        # Glance snapshots are also sort of images
+        attrs['image'] = True
+        attrs['instance'] = False
+    return attrs
+
+
+def image_attrs(info):
+    """Returns the attributes of the node of image `info`"""
+    attrs = attrs_by_name(info.name)
+    attrs.update(pool=info.pool, size=info.size, features=info.features)
+    return attrs
+
+
+def snapshot_attrs(info, snapshot, protected):
+    """Returns the attributes of the node of a snapshot of image `info`"""
+    return {
+        'pool': info.pool,
+        'protected': protected,
+        'to_be_deleted_by_glance': (info.name.endswith(DELETE_SUFFIX) or
+                                    snapshot.endswith(DELETE_SUFFIX)),
+    }
+
+
+def qualified_name(pool, name, snapshot=None):
+    """Default name of the nodes: ``pool/name`` or ``pool/name@snapshot``"""
+    if snapshot is None:
+        return '%s/%s' % (pool, name)
+    return '%s/%s@%s' % (pool, name, snapshot)
+
+
+class IoctxPool(object):
+    """The `rados.Ioctx` of each pool of `cluster`, opened when needed
+
+    Already opened ioctxs can be passed as a dictionary `ioctxs`; they
+    are not closed by `close()`.
+    """
+
+    def __init__(self, cluster, ioctxs=None):
+        self.cluster = cluster
+        self._ioctxs = {}
+        self._given = dict(ioctxs or {})
+        self._lock = threading.Lock()
+
+    def get(self, pool):
+        if pool in self._given:
+            return self._given[pool]
+        with self._lock:
+            ioctx = self._ioctxs.get(pool)
+            if ioctx is None:
+                log.debug("Opening pool %s", pool)
+                ioctx = self._ioctxs[pool] = self.cluster.open_ioctx(pool)
+            return ioctx
+
+    def close(self):
+        with self._lock:
+            while self._ioctxs:
+                self._ioctxs.popitem()[1].close()
+
+
+class ImageCache(object):
+    """Open `rbd.Image` handles of the images of any pool
+
+    Images are identified by (pool, name) pairs, and opened with the
+    ioctx of their pool taken from `ioctxs`, a `IoctxPool`.
+
+    At most `size` images are kept open: the least recently used ones
+    are closed when new images have to be opened. Images are used
+    between `acquire()` and `release()`, possibly by different threads,
+    and are never closed while in use.
+    """
+
+    def __init__(self, ioctxs, size=128):
+        self.ioctxs = ioctxs
+        self.size = size
+        self._images = OrderedDict()
+        self._busy = Counter()
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        with self._lock:
+            image = self._images.pop(key, None)
+            if image is not None:
+                self._images[key] = image
+                self._busy[key] += 1
+                return image
+        pool, name = key
+        image = rbd.Image(self.ioctxs.get(pool), name, read_only=True)
+        with self._lock:
+            if key in self._images:
+                # opened concurrently by another thread
+                image.close()
+                image = self._images[key]
+            else:
+                self._images[key] = image
+            self._busy[key] += 1
+            self._evict()
+        return image
+
+    def release(self, key):
+        with self._lock:
+            self._busy[key] -= 1
+            if not self._busy[key]:
+                del self._busy[key]
+            self._evict()
+
+    def _evict(self):
+        if len(self._images) <= self.size:
+            return
+        for key in list(self._images):
+            if key not in self._busy:
+                self._images.pop(key).close()
+                if len(self._images) <= self.size:
+                    return
+
+    def close(self):
+        with self._lock:
+            while self._images:
+                self._images.popitem()[1].close()
+
+
+def query_image(images, key):
+    """Returns the `ImageInfo` of image `key`"""
+    pool, name = key
+    image = images.acquire(key)
+    try:
+        size = image.size()
+        features = image.features()
+        snapshots = [(snap['name'], bool(image.is_protected_snap(snap['name'])))
+                     for snap in image.list_snaps()]
+        try:
+            parent = tuple(image.parent_info())
+        except rbd.ImageNotFound:
+            parent = None
+    finally:
+        images.release(key)
+    children = {}
+    for snapshot, protected in snapshots:
+        snap = rbd.Image(images.ioctxs.get(pool), name, snapshot=snapshot,
+                         read_only=True)
+        try:
+            children[snapshot] = [tuple(child) for child in snap.list_children()]
+        finally:
+            snap.close()
+    return ImageInfo(pool, name, size, features, snapshots, children, parent)
+
+
+def crawl(images, roots, follow=lambda pool: True, jobs=1, max_depth=None):
+    """Yields the `ImageInfo` of the images of the trees of `roots`
+
+    Starting from `roots`, a list of (pool, name) pairs, clones are
+    followed downwards and parents upwards, breadth first, at most
+    `max_depth` levels away from `roots`. Only images in the pools for
+    which `follow(pool)` is true are crawled. The images of each level
+    are queried concurrently by `jobs` threads, using the handles of
+    `images` (a `ImageCache`). Each image is yielded once.
+    """
+    # (pool, image) -> (descend, ascend)
+    frontier = OrderedDict((tuple(key), (True, True)) for key in roots)
+    visited = set()
+    yielded = set()
+    pool = ThreadPool(jobs) if jobs > 1 else None
+    depth = 0
+    try:
+        while frontier:
+            level = []
+            for key, (descend, ascend) in frontier.items():
+                descend = descend and (key, 'descend') not in visited
+                ascend = ascend and (key, 'ascend') not in visited
+                if not (descend or ascend):
+                    continue
+                if descend:
+                    visited.add((key, 'descend'))
+                if ascend:
+                    visited.add((key, 'ascend'))
+                level.append((key, descend, ascend))
+
+            query = lambda item: query_image(images, item[0])
+            results = pool.imap(query, level) if pool else map(query, level)
+            frontier = OrderedDict()
+
+            def enqueue(key, descend, ascend):
+                old = frontier.get(key, (False, False))
+                frontier[key] = (old[0] or descend, old[1] or ascend)
+
+            for (key, descend, ascend), info in zip(level, results):
+                if key not in yielded:
+                    yielded.add(key)
+                    yield info
+                    if len(yielded) % 1000 == 0:
+                        log.info("Crawled %d images", len(yielded))
+                if descend:
+                    for snapshot, protected in info.snapshots:
+                        for child in info.children[snapshot]:
+                            if follow(child[0]):
+                                enqueue(child, True, False)
+                if ascend and info.parent:
+                    if follow(info.parent[0]):
+                        enqueue(info.parent[:2], False, True)
+                    else:
+                        log.warn("Ignoring parent %s of RBD volume %s as it "
+                                 "doesn't belong to the crawled pools",
+                                 qualified_name(*info.parent[:2]),
+                                 qualified_name(*key))
+
+            log.info("Depth %d: queried %d images, %d images in the next "
+                     "level", depth, len(level), len(frontier))
+            depth += 1
+            if max_depth is not None and depth > max_depth:
+                if frontier:
+                    log.warn("Stopping at depth %d, %d images not expanded",
+                             max_depth, len(frontier))
+                break
+    finally:
+        if pool:
+            pool.terminate()
+            pool.join()
+
+
+def find_root(images, key, follow=lambda pool: True):
+    """Returns the image at the root of the tree image `key` belongs to
+
+    Only parents in the pools for which `follow(pool)` is true are
+    followed.
+    """
+    while True:
+        image = images.acquire(key)
+        try:
+            parent = image.parent_info()
+        except rbd.ImageNotFound:
+            return key
+        finally:
+            images.release(key)
+        if not follow(parent[0]):
+            return key
+        key = (parent[0], parent[1])
+
+
+def add_image(graph, info, name=qualified_name, follow=lambda pool: True,
+              image_attrs=image_attrs, snapshot_attrs=snapshot_attrs):
+    """Add image `info` to `graph`
+
+    The node of the image and of each of its snapshots are added, with
+    edges image -> snapshot. Edges snapshot -> clone are added as soon
+    as both the snapshot and the clone are in the graph, whatever the
+    order in which images are added; clones which are never added, or
+    not in a pool for which `follow(pool)` is true, are left out.
+
+    Nodes are named by `name(pool, image, snapshot=None)`, and their
+    attributes are computed by `image_attrs(info)` and
+    `snapshot_attrs(info, snapshot, protected)`.
+    """
+    image = name(info.pool, info.name)
+    graph.add_node(image, **image_attrs(info))
+    for snapshot, protected in info.snapshots:
+        snapname = name(info.pool, info.name, snapshot)
+        graph.add_node(snapname, **snapshot_attrs(info, snapshot, protected))
+        graph.add_edge(image, snapname)
+        for child in info.children.get(snapshot, []):
+            clone = name(*child)
+            if follow(child[0]) and clone in graph:
+                graph.add_edge(snapname, clone)
+    if info.parent and follow(info.parent[0]):
+        snapname = name(*info.parent)
+        if snapname in graph:
+            graph.add_edge(snapname, image)
+
+
+def write_info(stream, info):
+    stream.write(json.dumps(info._asdict()) + '\n')
+
+
+def record_crawl(infos, stream):
+    """Write each of `infos` to `stream`, as JSON lines, and yield it"""
+    for info in infos:
+        write_info(stream, info)
+        yield info
+    stream.flush()
+
+
+def read_crawl(stream):
+    """Yields the `ImageInfo` records written by `record_crawl`"""
+    for line in stream:
+        data = json.loads(line)
+        yield ImageInfo(
+            pool=str(data['pool']),
+            name=str(data['name']),
+            size=data['size'],
+            features=data['features'],
+            snapshots=[(str(snap), protected)
+                       for snap, protected in data['snapshots']],
+            children=dict((str(snap), [(str(pool), str(name))
+                                       for pool, name in clones])
+                          for snap, clones in data['children'].items()),
+            parent=(tuple(str(item) for item in data['parent'])
+                    if data['parent'] else None))
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        import fakeceph
+        self.cluster = fakeceph.FakeCluster()
+        self.cluster.populate('cinder', 120, depth=3, fanout=2, deleted=0.3,
+                              seed=1)
+        self.cluster.create('cinder', 'lone')
+        self.patch = self.cluster.patch(globals())
+        self.patch.__enter__()
+        self.ioctxs = IoctxPool(fakeceph.Rados())
+
+    def tearDown(self):
+        self.ioctxs.close()
+        self.patch.__exit__(None, None, None)
+
+    def trees(self):
+        """Returns the set of (pool, name) of the tree of each image"""
+        images = self.cluster.pools['cinder']
+        neighbours = dict((name, set()) for name in images)
+        for name, image in images.items():
+            if image.parent is not None:
+                neighbours[name].add(image.parent[1])
+                neighbours[image.parent[1]].add(name)
+        trees = {}
+        for name in images:
+            if name in trees:
+                continue
+            tree, todo = set([name]), [name]
+            while todo:
+                for other in neighbours[todo.pop()] - tree:
+                    tree.add(other)
+                    todo.append(other)
+            tree = frozenset(('cinder', other) for other in tree)
+            for other in tree:
+                trees[other[1]] = tree
+        return trees
+
+    def test_image_cache_bound(self):
+        from multiprocessing.pool import ThreadPool
+        keys = [('cinder', name) for name in self.cluster.pools['cinder']]
+        images = ImageCache(self.ioctxs, size=5)
+        for key in keys * 2:
+            image = images.acquire(key)
+            self.assertFalse(image._closed)
+            images.release(key)
+        # the new image is opened before the oldest one is closed
+        self.assertEqual(self.cluster.peak_open_images, 5 + 1)
+
+        self.cluster.peak_open_images = 0
+
+        def use(key):
+            image = images.acquire(key)
+            try:
+                # an image in use is never closed
+                image.size()
+                return image._closed
+            finally:
+                images.release(key)
+
+        pool = ThreadPool(8)
+        try:
+            closed = pool.map(use, keys * 5)
+        finally:
+            pool.terminate()
+            pool.join()
+        self.assertFalse(any(closed))
+        self.assertTrue(self.cluster.peak_open_images <= 5 + 2 * 8)
+        self.assertTrue(len(images._images) <= 5)
+        self.assertFalse(images._busy)
+        images.close()
+        self.assertEqual(self.cluster.open_images, 0)
+
+    def lineage(self, name):
+        """Returns the (pool, name) of the ancestors and descendants of
+        image `name`, and of the image itself"""
+        image = self.cluster.image('cinder', name)
+        lineage = set([('cinder', name)])
+        while image.parent is not None:
+            lineage.add(image.parent[:2])
+            image = self.cluster.image(*image.parent[:2])
+        todo = [('cinder', name)]
+        while todo:
+            image = self.cluster.image(*todo.pop())
+            for clones in image.children.values():
+                lineage.update(clones)
+                todo.extend(clones)
+        return lineage
+
+    def test_crawl(self):
+        trees = self.trees()
+        for jobs in (1, 4):
+            images = ImageCache(self.ioctxs, size=3)
+            for name in sorted(trees)[::10]:
+                infos = list(crawl(images, [('cinder', name)], jobs=jobs))
+                keys = [(info.pool, info.name) for info in infos]
+                self.assertEqual(len(keys), len(set(keys)))
+                self.assertEqual(set(keys), self.lineage(name))
+                # the whole tree is crawled from its root
+                root = find_root(images, ('cinder', name))
+                infos = list(crawl(images, [root], jobs=jobs))
+                self.assertEqual(
+                    set((info.pool, info.name) for info in infos),
+                    trees[name])
+            infos = list(crawl(images, [('cinder', name) for name in trees],
+                               jobs=jobs))
+            self.assertEqual(sorted((info.pool, info.name) for info in infos),
+                             sorted(('cinder', name) for name in trees))
+            images.close()
+            self.assertEqual(self.cluster.open_images, 0)
+
+    def test_crawl_max_depth(self):
+        images = ImageCache(self.ioctxs)
+        root = [name for name, image in self.cluster.pools['cinder'].items()
+                if image.parent is None][0]
+        infos = list(crawl(images, [('cinder', root)], max_depth=0))
+        self.assertEqual([info.name for info in infos], [root])
+        infos = list(crawl(images, [('cinder', root)], max_depth=1))
+        self.assertEqual(
+            sorted(info.name for info in infos[1:]),
+            sorted(name for snapshot, protected in infos[0].snapshots
+                   for pool, name in infos[0].children[snapshot]))
+        images.close()
+
+    def test_find_root(self):
+        images = ImageCache(self.ioctxs, size=2)
+        for name, tree in self.trees().items():
+            root = find_root(images, ('cinder', name))
+            self.assertIn(root, tree)
+            self.assertEqual(self.cluster.image(*root).parent, None)
+            # parents in pools which are not followed are not crawled
+            self.assertEqual(find_root(images, ('cinder', name),
+                                       lambda pool: False),
+                             ('cinder', name))
+        images.close()
+        self.assertEqual(self.cluster.open_images, 0)
+
+    def test_record_crawl(self):
+        from StringIO import StringIO
+        images = ImageCache(self.ioctxs)
+        stream = StringIO()
+        infos = list(record_crawl(crawl(
+            images, [('cinder', name)
+                     for name in self.cluster.pools['cinder']]), stream))
+        images.close()
+        stream.seek(0)
+        self.assertEqual(list(read_crawl(stream)), infos)
+
+
+if __name__ == '__main__':
+    unittest.main()